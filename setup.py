@@ -15,6 +15,10 @@ install_requires = [
       'six',
 ]
 
+extras_require = {
+      'verify': ['cryptography'],
+}
+
 setup(name='pyeleven',
       version=version,
       description="p11 proxy",
@@ -35,6 +39,7 @@ setup(name='pyeleven',
       include_package_data=True,
       zip_safe=False,
       install_requires=install_requires,
+      extras_require=extras_require,
       entry_points={
           'console_scripts': ['pyeleven=pyeleven:main']
       },
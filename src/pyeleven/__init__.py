@@ -1,15 +1,28 @@
+import hashlib
 import logging
+import math
 import os
+import random
+import threading
+import time
 from base64 import b64decode, b64encode
+from concurrent.futures import TimeoutError as FutureTimeout
 
+import PyKCS11
 import six
 from PyKCS11 import PyKCS11Error
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, json
 from retrying import retry
 
-from pyeleven.pk11 import pkcs11, load_library, slots_for_label
-from pyeleven.pool import allocation
-from pyeleven.utils import mechanism, intarray2bytes, PKCS11Exception
+from pyeleven import metrics, mock, verify
+from pyeleven.dispatch import Dispatcher
+from pyeleven.pk11 import pkcs11, load_library, configure, tokens, slot_failure, transient_failure, settings, \
+    warm_up, inventory, signature_cache, modules, cluster_slots, cluster_supports_mechanism, slot_name, label_tokens, \
+    slot_stats, cert_cache, public_key_cache
+from pyeleven.pool import PoolTimeout, DEFAULT_RETRY_AFTER
+from pyeleven.utils import mechanism, mechanism_name, intarray2bytes, prehash, PKCS11Exception, PREHASH, \
+    SlotsUnavailable, LibraryUnavailable, UnsupportedMechanism, NotFound, key_type, ecdsa_raw2der, \
+    SIGNATURE_FORMATS, CERT_FORMATS, DETERMINISTIC
 
 __author__ = 'leifj'
 
@@ -17,6 +30,26 @@ app = Flask(__name__)
 app.debug = True
 app.config.from_pyfile(os.path.join(os.getcwd(), 'config.py'))
 max_retry = app.config.get('MAX_RETRY', 7)
+retry_wait_min = app.config.get('RETRY_WAIT_MIN', 10)  # milliseconds between retries
+retry_wait_max = app.config.get('RETRY_WAIT_MAX', 100)
+configure(sessions_per_slot=app.config.get('SESSIONS_PER_SLOT', 4),
+          label_cache_ttl=app.config.get('LABEL_CACHE_TTL', 60),
+          key_cache_ttl=app.config.get('KEY_CACHE_TTL', 300),
+          pool_timeout=app.config.get('POOL_TIMEOUT', 30),
+          max_waiting=app.config.get('MAX_WAITING', None),
+          inventory_ttl=app.config.get('INVENTORY_CACHE_TTL', 60),
+          inventory_error_ttl=app.config.get('INVENTORY_ERROR_TTL', 5),
+          breaker_failure_rate=app.config.get('BREAKER_FAILURE_RATE', 0.5),
+          breaker_min_requests=app.config.get('BREAKER_MIN_REQUESTS', 3),
+          breaker_window=app.config.get('BREAKER_WINDOW', 10),
+          breaker_reset_timeout=app.config.get('BREAKER_RESET_TIMEOUT', 30),
+          slot_strategy=app.config.get('SLOT_STRATEGY', 'p2c'),
+          signature_cache_size=app.config.get('SIGNATURE_CACHE_SIZE', 0),
+          signature_cache_ttl=app.config.get('SIGNATURE_CACHE_TTL', 300))
+for _name, _weight in modules(app.config.get('PKCS11MODULE') or ''):
+    if mock.is_mock(_name):  # MOCK_PKCS11 may configure the mock libraries of a cluster by name
+        _mock_config = app.config.get('MOCK_PKCS11', {})
+        mock.register(_name, **_mock_config.get(_name, _mock_config))
 
 
 def pin():
@@ -28,134 +61,760 @@ def secret_key():
 
 
 def library_name():
-    return str(app.config['PKCS11MODULE'])
+    """
+    :return: PKCS11MODULE - the path of the PKCS#11 library or, for a cluster, a tuple of (path, weight) pairs
+    """
+    name = app.config['PKCS11MODULE']
+    if isinstance(name, (list, tuple)):
+        return modules(name)
+    return str(name)
+
+
+def stream_threshold():
+    return int(app.config.get('STREAM_THRESHOLD', 1024 * 1024))
+
+
+def stream_chunk_size():
+    return int(app.config.get('STREAM_CHUNK_SIZE', 64 * 1024))
 
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+request_seconds = metrics.Histogram('pyeleven_request_seconds', 'HTTP request latency', ['endpoint', 'status'])
+sign_total = metrics.Counter('pyeleven_sign_total', 'Signing operations', ['slot', 'keyname', 'mech', 'result'])
+sign_seconds = metrics.Histogram('pyeleven_sign_seconds', 'Time spent signing on the token',
+                                 ['slot', 'keyname', 'mech'])
+sign_retries = metrics.Counter('pyeleven_sign_retries_total', 'Signing attempts retried after a retryable error',
+                               ['error'])
+
+
+@app.before_request
+def _start_timer():
+    g.start = time.time()
+
+
+@app.after_request
+def _observe_request(response):
+    if 'start' in g:
+        request_seconds.observe(time.time() - g.start, endpoint=request.endpoint, status=response.status_code)
+    return response
+
+
+@app.errorhandler(PoolTimeout)
+def _pool_timeout(ex):
+    logger.warning('No session for request: {!s}'.format(ex))
+    retry_after = ex.retry_after if ex.retry_after is not None else DEFAULT_RETRY_AFTER
+    return jsonify(dict(error=str(ex))), 503, {'Retry-After': str(max(int(math.ceil(retry_after)), 1))}
+
+
+@app.errorhandler(SlotsUnavailable)
+@app.errorhandler(LibraryUnavailable)
+def _slots_unavailable(ex):
+    logger.warning('No healthy slot: {!s}'.format(ex))
+    return jsonify(dict(error=str(ex))), 503, {'Retry-After': str(int(math.ceil(ex.retry_after)))}
+
+
+@app.errorhandler(UnsupportedMechanism)
+def _unsupported_mechanism(ex):
+    logger.warning('Unsupported mechanism: {!s}'.format(ex))
+    return jsonify(dict(error=str(ex))), 400
+
 
 @app.route("/info")
 def _info():
     return jsonify(dict(library=library_name()))
 
 
-def retryable_errors(ex):
-    return isinstance(ex, IOError) or isinstance(ex, PKCS11Exception)
+_ready = threading.Event()
+_warm_up_error = []
+_warm_up_lock = threading.RLock()
+_warm_up_pid = []  # the process the warm-up was started in - a process forked from it has to start its own
+
 
+def _warm_up():
+    """
+    Open sessions and look up the keys listed in WARMUP, retrying every WARMUP_RETRY seconds until it
+    succeeds, then mark the app as ready.
+    """
+    while True:
+        try:
+            for label, keynames in app.config.get('WARMUP', {}).items():
+                start = time.time()
+                n = warm_up(library_name(), label, keynames, pin(), sessions=app.config.get('WARMUP_SESSIONS', None))
+                logger.info('Warmed up {:d} sessions for {!r} in {:.3f}s'.format(n, label, time.time() - start))
+            break
+        except Exception as ex:
+            logger.warning('Warm-up failed: {!s}'.format(ex))
+            _warm_up_error[:] = [str(ex)]
+            time.sleep(app.config.get('WARMUP_RETRY', 5))
+    del _warm_up_error[:]
+    _ready.set()
+
+
+def start_warm_up():
+    """
+    Start warming up in a background thread - /ready reports success once it is done. Called on the first
+    request a process gets, or eg from a gunicorn post_fork hook to warm up before that.
+    """
+    with _warm_up_lock:
+        _warm_up_pid[:] = [os.getpid()]
+        _ready.clear()
+        t = threading.Thread(target=_warm_up)
+        t.daemon = True
+        t.start()
+    return t
+
+
+@app.before_request
+def _start_warm_up():
+    # not at import - sessions and threads don't survive the fork of a preloaded app into its workers
+    if _warm_up_pid != [os.getpid()]:
+        with _warm_up_lock:
+            if _warm_up_pid != [os.getpid()]:
+                start_warm_up()
+
+
+@app.route("/ready")
+def _ready_check():
+    if not _ready.is_set():
+        result = dict(ready=False)
+        if _warm_up_error:
+            result['error'] = _warm_up_error[0]
+        return jsonify(result), 503
+    return jsonify(dict(ready=True))
+
+
+@app.route("/metrics")
+def _metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
-@retry(stop_max_attempt_number=max_retry, retry_on_exception=retryable_errors, wait_random_min=100, wait_random_max=500)
+
+def retryable_errors(ex):
+    """
+    Failing slots are quarantined by their circuit breaker so a retry goes to a healthy slot - when there
+    is none left there is no point in retrying, nor when the label, key or certificate doesn't exist.
+    """
+    if isinstance(ex, (SlotsUnavailable, LibraryUnavailable, UnsupportedMechanism, NotFound)):
+        return False
+    if isinstance(ex, IOError) or isinstance(ex, PKCS11Exception) or slot_failure(ex) or transient_failure(ex):
+        _retry_error.name = type(ex).__name__
+        return True
+    return False
+
+
+# the retryable error of the last attempt in this thread - retrying also asks about the error of an attempt it
+# won't retry, so retries are counted when waiting for the next attempt
+_retry_error = threading.local()
+
+
+def _retry_wait(attempt, delay):
+    """
+    :return: milliseconds to wait before the next attempt
+    """
+    sign_retries.inc(error=getattr(_retry_error, 'name', None))
+    return random.randint(retry_wait_min, retry_wait_max)
+
+
+def _sign_data(si, key, keyname, data, mech, stream=None):
+    labels = dict(slot=slot_name(si.library_name, si.slot), keyname=keyname, mech=mechanism_name(mech))
+    start = time.time()
+    try:
+        if stream is not None:
+            signed = intarray2bytes(si.sign_stream(key, stream, mech, chunk_size=stream_chunk_size()))
+        else:
+            signed = intarray2bytes(si.session.sign(key, data, mech))
+    except Exception:
+        sign_total.inc(result='error', **labels)
+        raise
+    elapsed = time.time() - start
+    sign_seconds.observe(elapsed, **labels)
+    sign_total.inc(result='ok', **labels)
+    if stream is None:  # a stream is signed as fast as the client sends it - not a measure of the slot
+        slot_stats(si.library_name, si.slot).observe(elapsed)
+    return signed
+
+
+def _check_mechanism(label, mech):
+    """
+    :raise UnsupportedMechanism: if the (cached) mechanism lists of the slots for label show that none supports mech
+    """
+    name = mechanism_name(mech)
+    if not cluster_supports_mechanism(library_name(), label, name):
+        raise UnsupportedMechanism("{!s} is not supported by {!r}".format(name, label))
+
+
+def _find_key(si, label, keyname, include_cert=True, require_cert=False, key_type=None):
+    """
+    :return: the key handle and, if include_cert, the pk11.KeyInfo with the certificate or None if there is none
+    """
+    logger.debug('Looking for key with keyname {!r}'.format(keyname))
+    key, cert = si.find_key(keyname, find_cert=include_cert, key_type=key_type)
+    if key is None:
+        logger.warning('Found no key using label {!r}, keyname {!r}'.format(label, keyname))
+        raise NotFound("Key %s not found" % keyname)
+    if require_cert and cert is None:
+        logger.warning('Found no certificate using label {!r}, keyname {!r}'.format(label, keyname))
+        raise NotFound("Certificate for %s is required but missing" % keyname)
+    return key, si.key_info(keyname, key_type) if cert is not None else None
+
+
+def _dispatch_workers(label):
+    return len(cluster_slots(library_name(), label)) * settings['sessions_per_slot']
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def dispatcher():
+    """
+    :return: the Dispatcher signing requests in micro-batches if DISPATCH is set, otherwise None
+    """
+    global _dispatcher
+    if not app.config.get('DISPATCH', False):
+        return None
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(lambda label: pkcs11(library_name(), label, pin()), _find_key, _sign_data,
+                                     _dispatch_workers,
+                                     max_batch=int(app.config.get('DISPATCH_MAX_BATCH', 16)),
+                                     max_linger=float(app.config.get('DISPATCH_MAX_LINGER', 0.002)),
+                                     max_waiting=settings['max_waiting'])
+        return _dispatcher
+
+
+def _dispatch_sign(d, label, keyname, mech, data, include_cert=True, require_cert=False):
+    future = d.submit(label, keyname, mech, data, key_type=key_type(mech))
+    try:
+        signed, info, token = future.result(timeout=settings['pool_timeout'])
+    except FutureTimeout:
+        future.cancel()
+        raise PoolTimeout("No result from dispatcher after {!s}s".format(settings['pool_timeout']))
+    if require_cert and info is None:
+        logger.warning('Found no certificate using label {!r}, keyname {!r}'.format(label, keyname))
+        raise NotFound("Certificate for %s is required but missing" % keyname)
+    result = dict(slot=label, token=token, signed=signed)
+    if info and include_cert:
+        result['cert'] = info
+    return result
+
+
+@retry(stop_max_attempt_number=max_retry, retry_on_exception=retryable_errors, wait_func=_retry_wait)
 def _do_sign(label, keyname, mech, data, include_cert=True, require_cert=False):
     if require_cert:
         include_cert = True
 
+    _check_mechanism(label, mech)
+    d = dispatcher()
+    if d is not None:
+        return _dispatch_sign(d, label, keyname, mech, data, include_cert, require_cert)
+
     with pkcs11(library_name(), label, pin()) as si:
-        logger.debug('Looking for key with keyname {!r}'.format(keyname))
-        key, cert = si.find_key(keyname, find_cert=include_cert)
-        if key is None:
-            logger.warning('Found no key using label {!r}, keyname {!r}'.format(label, keyname))
-            raise PKCS11Exception("Key %s not found" % keyname)
-        if require_cert and cert is None:
-            logger.warning('Found no certificate using label {!r}, keyname {!r}'.format(label, keyname))
-            raise PKCS11Exception("Certificate for %s is required but missing" % keyname)
+        key, info = _find_key(si, label, keyname, include_cert, require_cert, key_type(mech))
         logger.debug('Signing {!s} bytes using key {!r}'.format(len(data), keyname))
-        result = dict(slot=label, signed=b64encode(intarray2bytes(si.session.sign(key, data, mech))).decode('utf-8'))
-        if cert and include_cert:
-            result['cert'] = cert
+        result = dict(slot=label, token=si.serial, signed=_sign_data(si, key, keyname, data, mech))
+        if info and include_cert:
+            result['cert'] = info
         return result
 
 
-@app.route("/<slot_or_label>/<keyname>/sign", methods=['POST'])
-def _sign(slot_or_label, keyname):
+def _cached_sign(label, keyname, mech, data, include_cert=True, require_cert=False):
+    """
+    _do_sign in front of the signature cache: signatures made using a deterministic mechanism are cached
+    by label, keyname, mechanism and SHA-256 of the data so that signing the same data again needs no session.
+    The cached signature is returned with the token that made it.
+    """
+    name = mechanism_name(mech)
+    cache = signature_cache()
+    if name not in DETERMINISTIC or not cache.maxsize:
+        return _do_sign(label, keyname, mech, data, include_cert=include_cert, require_cert=require_cert)
+
+    if isinstance(data, six.text_type):
+        key = (label, keyname, name, hashlib.sha256(data.encode('utf-8')).digest())
+    else:
+        key = (label, keyname, name, hashlib.sha256(data).digest())
+    cached = cache.get(key)
+    if cached is None:
+        result = _do_sign(label, keyname, mech, data, include_cert=True, require_cert=require_cert)
+        cached = (result['signed'], result.get('cert'), result.get('token'))
+        cache.put(key, cached)
+    signed, info, token = cached
+    if require_cert and info is None:
+        logger.warning('Found no certificate using label {!r}, keyname {!r}'.format(label, keyname))
+        raise NotFound("Certificate for %s is required but missing" % keyname)
+    result = dict(slot=label, token=token, signed=signed)
+    if info and (include_cert or require_cert):
+        result['cert'] = info
+    return result
+
+
+def _do_sign_stream(label, keyname, mech, stream, include_cert=True, require_cert=False):
+    """
+    Like _do_sign but signs data read from stream in chunks using multi-part signing. The stream can
+    only be read once so this is not retried.
+    """
+    if require_cert:
+        include_cert = True
+
+    _check_mechanism(label, mech)
+    with pkcs11(library_name(), label, pin()) as si:
+        key, info = _find_key(si, label, keyname, include_cert, require_cert, key_type(mech))
+        logger.debug('Signing stream using key {!r}'.format(keyname))
+        result = dict(slot=label, token=si.serial, signed=_sign_data(si, key, keyname, None, mech, stream=stream))
+        if info and include_cert:
+            result['cert'] = info
+        return result
+
 
+def _binary_request():
+    return request.mimetype == 'application/octet-stream'
+
+
+def _binary_mech():
+    return request.args.get('mech', request.headers.get('X-PKCS11-Mechanism', 'RSAPKCS1'))
+
+
+def _flag(name):
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _binary_sign_request():
+    """
+    :return: mechanism and data to sign for a binary request. With ?prehash=1 the body is hashed
+    locally as it is read and with ?digest=1 the body is the hash - in both cases only the hash is signed.
+    """
+    mech = _binary_mech()
+    if _flag('prehash'):
+        mech, data = prehash(mech, stream=request.stream)
+    elif _flag('digest'):
+        mech, data = prehash(mech, digest=request.get_data())
+    else:
+        data = request.get_data()
+    return mechanism(mech), data
+
+
+def _binary_sign(slot_or_label, keyname, include_cert=True, require_cert=False, cert_format='pem'):
+    """
+    Sign a binary request. Bodies that are chunked or larger than STREAM_THRESHOLD are streamed to the token
+    with multi-part signing when the mechanism is a hash-and-sign mechanism, otherwise they are read in full.
+    """
+    mech = _binary_mech()
+    encode = _signature_format(mechanism(mech), request.args.get('format'))
+    n = request.content_length
+    if mech in PREHASH and not _flag('prehash') and not _flag('digest') and (n is None or n > stream_threshold()):
+        logger.debug('Streaming {!r} bytes to sign using {!s}'.format(n, mech))
+        result = _do_sign_stream(slot_or_label, keyname, mechanism(mech), request.stream,
+                                 include_cert=include_cert, require_cert=require_cert)
+    else:
+        mech, data = _binary_sign_request()
+        result = _cached_sign(slot_or_label, keyname, mech, data, include_cert=include_cert,
+                              require_cert=require_cert)
+    return _binary_result(result, encode, cert_format)
+
+
+def _json_sign_request(decode=False):
+    """
+    :return: mechanism and data to sign for a JSON request. With 'prehash' set the data is hashed
+    locally and a caller computed hash can be given as 'digest' instead of 'data'.
+    """
     msg = request.get_json()
     if not type(msg) is dict:
         raise ValueError("request must be a dict")
 
-    logger.debug('Signing data with slot_or_label {!r} and keyname {!r}\n'.format(slot_or_label, keyname))
     msg.setdefault('mech', 'RSAPKCS1')
-    if 'data' not in msg:
+    if 'digest' in msg:
+        mech, data = prehash(msg['mech'], digest=b64decode(msg['digest']))
+    elif 'data' not in msg:
         raise ValueError("missing 'data' in request")
-    data = b64decode(msg['data'])
-    if six.PY3:
-        data = data.decode('utf-8')
-    mech = mechanism(msg['mech'])
-    result = _do_sign(slot_or_label, keyname, mech, data, require_cert=True)
+    elif msg.get('prehash', False):
+        mech, data = prehash(msg['mech'], data=b64decode(msg['data']))
+    else:
+        mech = msg['mech']
+        data = b64decode(msg['data'])
+        if decode and six.PY3:
+            data = data.decode('utf-8')
+    return mechanism(mech), data
+
+
+def _signature_format(mech, fmt):
+    """
+    :param mech: PyKCS11.Mechanism the data is signed with
+    :param fmt: requested signature format, one of SIGNATURE_FORMATS or None for the default (raw)
+    :return: function encoding a signature made using mech in the requested format
+    """
+    fmt = fmt or 'raw'
+    if fmt not in SIGNATURE_FORMATS:
+        raise ValueError("Unknown signature format {!r}".format(fmt))
+    if fmt == 'raw':
+        return lambda signed: signed
+    if not mechanism_name(mech).startswith('CKM_ECDSA'):
+        raise ValueError("Signature format {!r} is only available for ECDSA".format(fmt))
+    return ecdsa_raw2der
+
+
+def _cert_format(fmt):
+    """
+    :param fmt: how to return the certificate with a signature, one of CERT_FORMATS or None for the default (pem)
+    """
+    fmt = fmt or 'pem'
+    if fmt not in CERT_FORMATS:
+        raise ValueError("Unknown certificate format {!r}".format(fmt))
+    return fmt
+
+
+def _with_cert(result, cert_format):
+    """
+    :return: result with the KeyInfo in 'cert' replaced by the PEM certificate or by its SHA-256 fingerprint
+    as 'cert_fingerprint'
+    """
+    result = dict(result)
+    info = result.pop('cert', None)
+    if info is not None:
+        if cert_format == 'fingerprint':
+            result['cert_fingerprint'] = info.cert_fingerprint
+        else:
+            result['cert'] = info.cert_pem
+    return result
+
+
+def _json_result(result, encode=None, cert_format='pem'):
+    result = _with_cert(result, cert_format)
+    signed = result['signed'] if encode is None else encode(result['signed'])
+    result['signed'] = b64encode(signed).decode('utf-8')
     return jsonify(result)
 
 
+def _binary_result(result, encode=None, cert_format='pem'):
+    """
+    The raw signature as the response body. The slot, the serial number of the token that signed and the
+    (base64 DER) certificate or its fingerprint are returned in headers.
+    """
+    signed = result['signed'] if encode is None else encode(result['signed'])
+    response = Response(signed, mimetype='application/octet-stream')
+    response.headers['X-PKCS11-Slot'] = str(result['slot'])
+    if result.get('token') is not None:
+        response.headers['X-PKCS11-Token'] = str(result['token'])
+    info = result.get('cert')
+    if info is not None:
+        if cert_format == 'fingerprint':
+            response.headers['X-PKCS11-Certificate-Fingerprint'] = info.cert_fingerprint
+        else:
+            response.headers['X-PKCS11-Certificate'] = ''.join(info.cert_pem.splitlines()[1:-1])
+    return response
+
+
+@app.route("/<slot_or_label>/<keyname>/sign", methods=['POST'])
+def _sign(slot_or_label, keyname):
+
+    if _binary_request():
+        logger.debug('Signing binary data with slot_or_label {!r} and keyname {!r}'.format(slot_or_label, keyname))
+        return _binary_sign(slot_or_label, keyname, require_cert=True,
+                            cert_format=_cert_format(request.args.get('cert')))
+
+    logger.debug('Signing data with slot_or_label {!r} and keyname {!r}\n'.format(slot_or_label, keyname))
+    mech, data = _json_sign_request(decode=True)
+    encode = _signature_format(mech, request.get_json().get('format'))
+    cert_format = _cert_format(request.get_json().get('cert'))
+    result = _cached_sign(slot_or_label, keyname, mech, data, require_cert=True)
+    return _json_result(result, encode, cert_format)
+
+
 @app.route("/<slot_or_label>/<keyname>/rawsign", methods=['POST'])
 def _rawsign(slot_or_label, keyname):
 
+    if _binary_request():
+        return _binary_sign(slot_or_label, keyname, include_cert=False)
+
+    mech, data = _json_sign_request()
+    encode = _signature_format(mech, request.get_json().get('format'))
+    return _json_result(_cached_sign(slot_or_label, keyname, mech, data, include_cert=False), encode)
+
+
+@retry(stop_max_attempt_number=max_retry, retry_on_exception=retryable_errors, wait_func=_retry_wait)
+def _do_batch_sign(label, keyname, items, include_cert=True):
+    """
+    Sign a list of (mech, data) tuples using a single session and key lookup. Errors signing
+    an individual item are reported in its place in the result and do not cause the batch
+    to be retried - only failing to allocate a session or find the key, or an error that means
+    the session or slot is broken, does that.
+    """
+    key_types = set(key_type(mech) for mech, data in items)
+    kt = key_types.pop() if len(key_types) == 1 else None  # mixed key types: take any key with the keyname
+    with pkcs11(library_name(), label, pin()) as si:
+        key, info = _find_key(si, label, keyname, include_cert, key_type=kt)
+        logger.debug('Signing {:d} items using key {!r}'.format(len(items), keyname))
+        signed = []
+        for mech, data in items:
+            try:
+                signed.append(dict(signed=b64encode(_sign_data(si, key, keyname, data, mech)).decode('utf-8')))
+            except (PyKCS11Error, TypeError, ValueError) as ex:
+                if slot_failure(ex):  # drop the session and retry the batch on another one
+                    raise
+                logger.warning('Failed signing batch item using keyname {!r}: {!s}'.format(keyname, ex))
+                signed.append(dict(error=str(ex)))
+        result = dict(slot=label, token=si.serial, signed=signed)
+        if info and include_cert:
+            result['cert'] = info
+        return result
+
+
+@app.route("/<slot_or_label>/<keyname>/batchsign", methods=['POST'])
+def _batchsign(slot_or_label, keyname):
+
     msg = request.get_json()
     if not type(msg) is dict:
         raise ValueError("request must be a dict")
 
     msg.setdefault('mech', 'RSAPKCS1')
-    if 'data' not in msg:
+    if not type(msg.get('data')) is list:
+        raise ValueError("'data' in request must be a list")
+
+    results = []
+    items = []
+    for item in msg['data']:
+        if not type(item) is dict:
+            item = dict(data=item)
+        try:
+            mech = mechanism(item.get('mech', msg['mech']))
+            data = b64decode(item['data'])
+        except (KeyError, AttributeError, TypeError, ValueError) as ex:
+            results.append(dict(error="bad batch item: {!s}".format(ex)))
+            continue
+        try:
+            _check_mechanism(slot_or_label, mech)
+        except UnsupportedMechanism as ex:
+            results.append(dict(error=str(ex)))
+            continue
+        items.append((mech, data))
+        results.append(None)
+
+    cert = msg.get('cert', True)  # true, false or one of CERT_FORMATS
+    cert_format = _cert_format(cert if cert in CERT_FORMATS else None)
+    result = dict(slot=slot_or_label, signed=[])
+    if items:
+        result = _do_batch_sign(slot_or_label, keyname, items, include_cert=bool(cert))
+    signed = iter(result['signed'])
+    result['signed'] = [r if r is not None else next(signed) for r in results]
+    return jsonify(_with_cert(result, cert_format))
+
+
+def _cert_info(label, keyname, kt=None, token=None):
+    """
+    :param token: serial number of the token, the first token with label if None
+    :return: the pk11.KeyInfo with the certificate of keyname on a token with label - cached per token so that
+    it can be returned without allocating a session
+    """
+    tokens = label_tokens(library_name(), label)
+    if token is None:
+        token = next(iter(tokens))
+    if token not in tokens:
+        raise NotFound("No token {!r} with label {!r}".format(token, label))
+
+    def _load():
+        with pkcs11(library_name(), label, pin(), token=token) as si:
+            key, info = _find_key(si, label, keyname, require_cert=True, key_type=kt)
+        return info
+
+    return cert_cache().get((label, token, keyname, kt), _load)
+
+
+def _public_key(info):
+    """
+    :return: the public key from the certificate in a pk11.KeyInfo - cached so that verifying needs no session
+    """
+    return public_key_cache().get(info.cert_fingerprint, lambda: verify.public_key(info.cert_pem))
+
+
+def _verify_item(label, keyname, item, mech, fmt):
+    """
+    Verify using the key on the token given by its serial number as 'token' in item (as returned by sign),
+    or else using the key on each token with label until one of them verifies the signature.
+    """
+    if 'signature' not in item:
+        raise ValueError("missing 'signature' in request")
+    signature = b64decode(item['signature'])
+    if 'digest' in item:
+        data, digest = None, b64decode(item['digest'])
+    elif 'data' in item:
+        data, digest = b64decode(item['data']), None
+    else:
         raise ValueError("missing 'data' in request")
-    data = b64decode(msg['data'])
-    mech = mechanism(msg['mech'])
-    return jsonify(_do_sign(slot_or_label, keyname, mech, data, include_cert=False))
+    kt = key_type(mechanism(mech))
+    tokens = [item['token']] if item.get('token') is not None else list(label_tokens(library_name(), label))
+    tried = set()
+    for token in tokens:
+        info = _cert_info(label, keyname, kt, token)
+        if info.cert_fingerprint in tried:  # the tokens of a cluster usually hold the same key
+            continue
+        tried.add(info.cert_fingerprint)
+        if verify.verify(_public_key(info), mech, signature, data=data, digest=digest, fmt=fmt):
+            return True
+    return False
 
 
-@app.route("/<slot_or_label>", methods=['GET'])
-def _slot(slot_or_label):
-    lib = load_library(library_name())
-    slots = slots_for_label(slot_or_label, lib)
-    result = []
-    for slot in slots:
-        r = dict()
-        try:
-            r['mechanisms'] = lib.getMechanismList(slot)
-        except (PyKCS11Error, KeyError, ValueError, IOError) as ex:
-            r['mechanisms'] = {'error': str(ex)}
-        try:
-            r['slot'] = lib.getSlotInfo(slot).to_dict()
-        except (PyKCS11Error, KeyError, ValueError, IOError) as ex:
-            r['slot'] = {'error': str(ex)}
+def _verify_unavailable():
+    return jsonify(dict(error="verify needs the cryptography package")), 501
+
+
+@app.route("/<slot_or_label>/<keyname>/verify", methods=['POST'])
+def _verify(slot_or_label, keyname):
+    """
+    Verify a signature using the public key in the certificate for keyname, without using the token:
+
+        {'mech': 'SHA256RSAPKCS', 'data': base64(<signed data>), 'signature': base64(<signature>)}
+    """
+    if not verify.available():
+        return _verify_unavailable()
+
+    msg = request.get_json()
+    if not type(msg) is dict:
+        raise ValueError("request must be a dict")
+    mech = msg.get('mech', 'RSAPKCS1')
+    return jsonify(dict(slot=slot_or_label,
+                        valid=_verify_item(slot_or_label, keyname, msg, mech, msg.get('format'))))
+
+
+@app.route("/<slot_or_label>/<keyname>/batchverify", methods=['POST'])
+def _batchverify(slot_or_label, keyname):
+    """
+    Verify a list of signatures, each an object with 'data' (or 'digest') and 'signature' and optionally
+    its own 'mech' and 'format'. Errors are reported in place of the result for an item.
+    """
+    if not verify.available():
+        return _verify_unavailable()
+
+    msg = request.get_json()
+    if not type(msg) is dict:
+        raise ValueError("request must be a dict")
+    msg.setdefault('mech', 'RSAPKCS1')
+    if not type(msg.get('data')) is list:
+        raise ValueError("'data' in request must be a list")
+
+    results = []
+    for item in msg['data']:
         try:
-            r['token'] = lib.getTokenInfo(slot).to_dict()
-        except (PyKCS11Error,  KeyError, ValueError, IOError) as ex:
-            r['token'] = {'error': str(ex)}
+            if not type(item) is dict:
+                raise ValueError("batch item must be a dict")
+            valid = _verify_item(slot_or_label, keyname, item, item.get('mech', msg['mech']),
+                                 item.get('format', msg.get('format')))
+            results.append(dict(valid=valid))
+        except (KeyError, AttributeError, TypeError, ValueError) as ex:
+            results.append(dict(error="bad batch item: {!s}".format(ex)))
+    return jsonify(dict(slot=slot_or_label, verified=results))
+
+
+@app.route("/<slot_or_label>/<keyname>/cert", methods=['GET'])
+def _cert(slot_or_label, keyname):
+    """
+    The certificate for keyname, PEM encoded or with ?format=der DER encoded. The ETag is derived from the
+    SHA-256 fingerprint of the certificate (also in the X-PKCS11-Certificate-Fingerprint header) so clients
+    that got a fingerprint with a signature can tell if the certificate they have is current. A label can span
+    tokens with different keys - ?token=<serial> returns the certificate on the token a sign response named.
+    """
+    info = _cert_info(slot_or_label, keyname, token=request.args.get('token'))
+    if request.args.get('format', 'pem') == 'der':
+        response = Response(info.cert_der, mimetype='application/pkix-cert')
+        response.set_etag(info.cert_fingerprint + '-der')
+    else:
+        response = Response(info.cert_pem + "\n", mimetype='application/x-pem-file')
+        response.set_etag(info.cert_fingerprint)
+    response.headers['X-PKCS11-Certificate-Fingerprint'] = info.cert_fingerprint
+    response.headers['Cache-Control'] = 'public, max-age={:d}'.format(int(app.config.get('CERT_MAX_AGE', 300)))
+    return response.make_conditional(request)
+
+
+def _conditional(response):
+    """
+    Tag the response with an ETag and turn it into 304 Not Modified if it matches If-None-Match
+    """
+    response.add_etag()
+    return response.make_conditional(request)
 
-        result.append(r)
 
-    return jsonify(dict(slots=result))
+@app.route("/<slot_or_label>", methods=['GET'])
+def _slot(slot_or_label):
+    slots = cluster_slots(library_name(), slot_or_label)
+    return _conditional(jsonify(dict(slots=[inventory(load_library(name), slot) for name, slot in slots])))
+
+
+def _object_template():
+    """
+    :return: the find template for the class and label query parameters and the class
+    """
+    template = []
+    object_class = None
+    if request.args.get('class'):
+        name = 'CKO_' + request.args['class'].upper()
+        object_class = PyKCS11.CKO.get(name)
+        if not isinstance(object_class, int):
+            raise ValueError("unknown object class {!r}".format(request.args['class']))
+        template.append((PyKCS11.CKA_CLASS, object_class))
+    if request.args.get('label'):
+        template.append((PyKCS11.CKA_LABEL, request.args['label']))
+    return template, object_class
+
+
+def _cursor_session(slot_or_label, token):
+    """
+    :param token: serial number of the token a cursor is for, None for any token with slot_or_label
+    :return: a context manager yielding a session on the token
+    """
+    if token is not None and token not in label_tokens(library_name(), slot_or_label):
+        raise ValueError("cursor is for token {!r} which has no slot {!r}".format(token, slot_or_label))
+    return pkcs11(library_name(), slot_or_label, pin(), token=token)
 
 
 @app.route("/<slot_or_label>/objects", methods=['GET'])
 def _slot_keys(slot_or_label):
-    res = {}
-    with pkcs11(library_name(), slot_or_label, pin()) as si:
-        res['session'] = si.session.getSessionInfo().to_dict()
-        res['objects'] = []
-        for this in si.session.findObjects():
-            try:
-                attrs = si.get_object_friendly_attrs(this)
-                res['objects'].append(attrs)
-            except Exception as ex:
-                logger.error('Failed fetching attributes for object, error: {!s}'.format(ex))
-    return jsonify(res)
+    """
+    List a page of the objects on the token, optionally only those of a class (eg private_key or certificate)
+    and/or with a label. Pass the 'next' cursor from the response as cursor to get the next page - it names
+    the token the listing is from, so the following pages come from the same token.
+    """
+    template, object_class = _object_template()
+    token, offset = None, 0
+    if request.args.get('cursor'):
+        token, offset = request.args['cursor'].rsplit(':', 1)
+        offset = int(offset)
+    limit = min(int(request.args.get('limit', app.config.get('OBJECTS_PAGE_SIZE', 100))),
+                app.config.get('OBJECTS_MAX_PAGE_SIZE', 1000))
+    if offset < 0 or limit < 1:
+        raise ValueError("cursor and limit must be positive")
+    with _cursor_session(slot_or_label, token) as si:
+        session_info = si.session.getSessionInfo().to_dict()
+        handles, more = si.find_objects(template, offset=offset, limit=limit)
+        objects = si.get_objects_friendly_attrs(handles, object_class)
+        cursor = '{!s}:{:d}'.format(si.serial, offset + limit) if more else None
+    head = '{"session": %s, "objects": [' % json.dumps(session_info)
+
+    def _generate():  # the session is back in the pool - stream the page one object at a time
+        yield head
+        first = True
+        for attrs in objects:
+            if attrs is None:
+                continue
+            yield ('' if first else ', ') + json.dumps(attrs)
+            first = False
+        yield '], "next": %s}\n' % json.dumps(cursor)
+
+    return Response(_generate(), mimetype='application/json')
 
 
 @app.route("/", methods=['GET'])
 def _token():
-    lib = load_library(library_name())
-    r = dict()
-    token_labels = dict()
-    slots = []
-    for slot in lib.getSlotList():
+    name = library_name()
+    if isinstance(name, six.string_types):
+        t = tokens(load_library(name))
+        return _conditional(jsonify(dict(labels=t['labels'], slots=t['slots'])))
+    res = []
+    for module, weight in name:
         try:
-            ti = lib.getTokenInfo(slot)
-            lst = token_labels.setdefault(ti.label.strip(), [])
-            lst.append(slot)
-            slots.append(slot)
-        except Exception as ex:
-            logger.warning(ex)
-    r['labels'] = token_labels
-    r['slots'] = slots
-    return jsonify(r)
+            t = tokens(load_library(module))
+            res.append(dict(library=module, weight=weight, labels=t['labels'], slots=t['slots']))
+        except (PyKCS11Error, LibraryUnavailable) as ex:
+            res.append(dict(library=module, weight=weight, error=str(ex)))
+    return _conditional(jsonify(dict(libraries=res)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+"""
+ASGI front end for pyeleven. Serve it with any ASGI server, eg:
+
+    # uvicorn pyeleven.asgi:app
+
+The routes are those of the Flask app in pyeleven. Connections are handled on the event loop while
+the blocking PKCS#11 work for a request runs in a thread pool executor for its slot or token label,
+sized to the number of sessions the session pool may open for it. A label therefore never has more
+threads than sessions, and any number of slow clients can be connected without tying up a thread.
+"""
+import asyncio
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pyeleven import app as wsgi_app, library_name
+from pyeleven import pk11
+
+__author__ = 'leifj'
+
+logger = logging.getLogger(__name__)
+
+# first path segments that are not a slot or token label
+GLOBAL_ROUTES = ('', 'info', 'metrics', 'ready')
+
+# request bodies larger than this are read from the client by the executor thread as they are consumed
+MAX_BUFFER = wsgi_app.config.get('ASGI_MAX_BUFFER', 1024 * 1024)
+
+_lock = threading.Lock()
+_executors = dict()  # by the key of the session pool for the label
+_default_executor = ThreadPoolExecutor(max_workers=wsgi_app.config.get('ASGI_DEFAULT_THREADS', 4))
+# looks up the slots for labels not seen before and runs the requests for labels without slots, so that
+# neither keeps the global routes (/metrics, /ready) waiting
+_lookup_executor = ThreadPoolExecutor(max_workers=wsgi_app.config.get('ASGI_LOOKUP_THREADS', 2))
+
+
+def _budget(slot_or_label):
+    """
+    :return: the number of sessions the session pool for slot_or_label may open
+    """
+    return len(pk11.cluster_slots(library_name(), slot_or_label)) * pk11.settings['sessions_per_slot']
+
+
+def _cached_executor(slot_or_label):
+    """
+    :return: the executor for slot_or_label if it has one, without blocking
+    """
+    if slot_or_label in GLOBAL_ROUTES:
+        return _default_executor
+    with _lock:
+        return _executors.get(pk11.pool_key(library_name(), slot_or_label))
+
+
+def executor(slot_or_label):
+    """
+    :param slot_or_label: slot number or token label
+    :return: the executor running the blocking work for slot_or_label
+    """
+    ex = _cached_executor(slot_or_label)
+    if ex is None:
+        try:
+            size = _budget(slot_or_label)
+        except Exception as e:  # unknown label - let the app report the error
+            logger.debug('No executor for {!r}: {!s}'.format(slot_or_label, e))
+            return _lookup_executor
+        with _lock:
+            ex = _executors.setdefault(pk11.pool_key(library_name(), slot_or_label),
+                                       ThreadPoolExecutor(max_workers=size))
+        logger.debug('Using {:d} threads for {!r}'.format(size, slot_or_label))
+    return ex
+
+
+def shutdown():
+    with _lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for ex in executors:
+        ex.shutdown(wait=False)
+
+
+class _Input(io.RawIOBase):
+    """
+    wsgi.input reading the buffered start of the request body and then, from the executor thread,
+    the rest of it from the ASGI receive channel.
+    """
+
+    def __init__(self, loop, receive, body, more_body):
+        super(_Input, self).__init__()
+        self.loop = loop
+        self.receive = receive
+        self.buffer = body
+        self.more_body = more_body
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                raise IOError("client disconnected")
+            self.buffer = message.get('body', b'')
+            self.more_body = message.get('more_body', False)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def _environ(scope, stream):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': str(client[0]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.input_terminated': True,  # chunked bodies have no Content-Length, the stream ends with the body
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_%s' % name
+            environ[key] = "%s,%s" % (environ[key], value) if key in environ else value
+    return environ
+
+
+def _run(loop, send, environ):
+    """
+    Call the WSGI app in an executor thread, sending the response through the event loop as it is produced.
+    """
+    started = dict()
+
+    def _send(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = wsgi_app(environ, start_response)
+    try:
+        sent = False
+        for chunk in result:
+            if not chunk:
+                continue
+            if not sent:
+                _send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+                sent = True
+            _send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not sent:
+            _send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        _send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError("Unsupported ASGI scope type {!r}".format(scope['type']))
+
+    loop = asyncio.get_event_loop()  # the running loop - get_running_loop() needs python 3.7
+    chunks = []
+    size = 0
+    more_body = True
+    while more_body and size <= MAX_BUFFER:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        more_body = message.get('more_body', False)
+    body = b''.join(chunks)
+
+    segment = scope['path'].lstrip('/').split('/', 1)[0]
+    ex = _cached_executor(segment)
+    if ex is None:  # looking up the slots for a label may block
+        ex = await loop.run_in_executor(_lookup_executor, executor, segment)
+    environ = _environ(scope, io.BufferedReader(_Input(loop, receive, body, more_body)))
+    await loop.run_in_executor(ex, _run, loop, send, environ)
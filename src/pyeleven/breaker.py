@@ -0,0 +1,92 @@
+"""
+Circuit breaker keeping failing slots out of rotation
+"""
+import threading
+import time
+from collections import deque
+
+__author__ = 'leifj'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    A thread safe circuit breaker. While closed the outcome of the last window operations is recorded and
+    the breaker opens once at least min_requests of them are recorded and the failure rate reaches
+    failure_rate. An open breaker lets nothing through until reset_timeout seconds have passed, then it is
+    half-open and lets at most probes operations through. The breaker closes when a probe succeeds and
+    opens again when one fails.
+    """
+
+    def __init__(self, failure_rate=0.5, min_requests=3, window=10, reset_timeout=30, probes=1):
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.trips = 0
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened = 0
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def _current(self, now):
+        if self._state == OPEN and now - self._opened >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probing = 0
+        return self._state
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current(time.time())
+
+    def retry_after(self):
+        """
+        :return: seconds until an open breaker lets a probe through, 0 if it isn't open
+        """
+        with self._lock:
+            if self._current(time.time()) != OPEN:
+                return 0
+            return max(self._opened + self.reset_timeout - time.time(), 0)
+
+    def allow(self):
+        """
+        :return: True if an operation may be attempted - for a half-open breaker this takes one of the probes
+        """
+        with self._lock:
+            state = self._current(time.time())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probing < self.probes:
+                self._probing += 1
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self._current(time.time()) == HALF_OPEN:
+                self._state = CLOSED
+                self._outcomes.clear()
+            self._outcomes.append(True)
+
+    def failure(self):
+        with self._lock:
+            now = time.time()
+            state = self._current(now)
+            self._outcomes.append(False)
+            if state == HALF_OPEN:
+                self._trip(now)
+            elif state == CLOSED and len(self._outcomes) >= self.min_requests:
+                failures = self._outcomes.count(False)
+                if failures >= self.failure_rate * len(self._outcomes):
+                    self._trip(now)
+
+    def _trip(self, now):
+        self._state = OPEN
+        self._opened = now
+        self._outcomes.clear()
+        self.trips += 1
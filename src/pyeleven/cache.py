@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'leifj'
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """
+    A thread safe cache where each entry is valid for ttl seconds after it was loaded. Once an entry
+    is older than refresh_ahead * ttl it is reloaded in a background thread while the cached value
+    keeps being returned, so callers only wait for a load when an entry is missing or expired.
+    Set refresh_ahead to None when the load function can't be called from another thread.
+    A ttl of 0 disables caching. If ttl_for is given it is called with each loaded value and returns
+    the ttl for it instead, eg a shorter one for a value recording a failure.
+    """
+
+    def __init__(self, ttl=60, refresh_ahead=0.75, ttl_for=None):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.ttl_for = ttl_for
+        self.hits = 0
+        self.misses = 0
+        self._entries = dict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """
+        :param key: cache key
+        :param load: function returning the value for key when it is not cached - None is not cached
+        :return: the cached or loaded value
+        """
+        if not self.ttl:
+            return load()
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < entry[2]:
+                self.hits += 1
+                if self.refresh_ahead is not None and now - entry[0] >= entry[2] * self.refresh_ahead \
+                        and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    t = threading.Thread(target=self._refresh, args=(key, load))
+                    t.daemon = True
+                    t.start()
+                return entry[1]
+            self.misses += 1
+
+        value = load()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if not self.ttl or value is None:
+            return
+        ttl = self.ttl if self.ttl_for is None else min(self.ttl_for(value), self.ttl)
+        with self._lock:
+            self._entries[key] = (time.time(), value, ttl)
+
+    def invalidate(self, key=None):
+        """
+        Remove key from the cache, or all entries if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _refresh(self, key, load):
+        try:
+            self.put(key, load())
+        except Exception as ex:
+            logger.warning('Failed refreshing cache entry {!r}: {!s}'.format(key, ex))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class LRUCache(object):
+    """
+    A thread safe cache of at most maxsize entries, each valid for ttl seconds after it was added. The least
+    recently used entry is dropped to make room for a new one. A maxsize or ttl of 0 disables caching.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: the value cached for key or None
+        """
+        if not self.maxsize or not self.ttl:
+            return None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or time.time() - entry[0] >= self.ttl:
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # most recently used last
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if not self.maxsize or not self.ttl or value is None:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Remove key from the cache, or all entries if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,230 @@
+"""
+Micro-batching dispatcher: concurrent signing requests for the same key are queued and signed in
+small batches by worker threads, each using a session it keeps while there is work in the queue.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from pyeleven import metrics
+from pyeleven.pk11 import slot_failure
+from pyeleven.pool import PoolFull
+
+__author__ = 'leifj'
+
+logger = logging.getLogger(__name__)
+
+batch_size = metrics.Histogram('pyeleven_dispatch_batch_size', 'Requests signed per dispatcher batch', ['label'],
+                               buckets=(1, 2, 4, 8, 16, 32, 64))
+
+
+class _Label(object):
+    """
+    The queued requests for a label, by key, their number and the number of workers signing them
+    """
+
+    def __init__(self):
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.workers = 0
+        self.taken = deque(maxlen=64)  # when requests were recently taken for signing, for the drain rate
+
+    def retry_after(self):
+        """
+        :return: seconds until the queued requests are expected to have been taken at the recent rate, None if
+        too few were taken to tell
+        """
+        if len(self.taken) < 2:
+            return None
+        elapsed = max(self.taken[-1], time.time()) - self.taken[0]
+        if elapsed <= 0:
+            return None
+        return (self.queued + 1) * elapsed / (len(self.taken) - 1)
+
+
+class Dispatcher(object):
+    """
+    Queue signing requests per (label, keyname, key type) for a set of workers per label.
+
+    A worker waits for a request, collects up to max_batch - 1 more for the same key arriving within max_linger
+    seconds, allocates a session and looks up the key once and signs the batch. It keeps signing whatever is
+    queued for the label on the same session and returns the session to the pool when there is no more work.
+    Each label has at most workers(label) workers - as many as the sessions it may use - shared by all its
+    keys. A key is looked up before requests for it are queued, so only existing keys get a queue, and queues
+    are dropped when they are empty. Workers exit after idle_timeout seconds without work. The workers keep their
+    sessions so requests wait in the queues rather than for the session pool - once max_waiting requests are
+    queued for a label, more fail straight away with pool.PoolFull.
+
+    :param session: function(label) returning a context manager yielding a SessionInfo (eg pk11.pkcs11)
+    :param find_key: function(si, label, keyname, key_type=None) returning the key and certificate or raising an
+    exception
+    :param sign: function(si, key, keyname, data, mech) returning the signature
+    :param workers: function(label) returning the number of workers for a label - the sessions it may use
+    :param max_batch: maximum number of requests signed in a batch
+    :param max_linger: seconds to wait for more requests before signing a batch
+    :param idle_timeout: seconds a worker waits for work before it exits
+    :param max_waiting: requests that may be queued for a label before more are turned away, None for no limit
+    """
+
+    def __init__(self, session, find_key, sign, workers, max_batch=16, max_linger=0.002, idle_timeout=60,
+                 max_waiting=None):
+        self.session = session
+        self.find_key = find_key
+        self.sign = sign
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_linger = max_linger
+        self.idle_timeout = idle_timeout
+        self.max_waiting = max_waiting
+        self._labels = dict()
+        self._known = set()
+        self._stopped = False
+        self._lock = threading.Condition(threading.Lock())
+
+    def submit(self, label, keyname, mech, data, key_type=None):
+        """
+        :param key_type: CKK of the key mech needs, None for any key with keyname
+        :return: a Future for the (signature, certificate, token serial number) of data signed using keyname on label
+        """
+        future = Future()
+        key = (keyname, key_type)
+        try:
+            self._check(label, key)
+            n = self.workers(label)  # may look up the slots for label - don't hold the lock
+        except Exception as ex:  # unknown label or key - no queue and no workers for it
+            future.set_exception(ex)
+            return future
+        with self._lock:
+            if self._stopped:
+                future.set_exception(RuntimeError("Dispatcher is shut down"))
+                return future
+            state = self._labels.get(label)
+            if state is None:
+                state = self._labels[label] = _Label()
+            if self.max_waiting is not None and state.queued >= self.max_waiting:
+                future.set_exception(PoolFull("{:d} requests already queued for {!r}".format(state.queued, label),
+                                              retry_after=state.retry_after()))
+                return future
+            state.queues.setdefault(key, deque()).append((future, mech, data))
+            state.queued += 1
+            if state.workers < n:
+                state.workers += 1
+                logger.debug('Starting dispatch worker {:d} of {:d} for {!r}'.format(state.workers, n, label))
+                t = threading.Thread(target=self._work, args=(label, state))
+                t.daemon = True
+                t.start()
+            self._lock.notify_all()
+        return future
+
+    def _check(self, label, key):
+        """
+        Look up the (keyname, key type) once, in the calling thread, before the first request for it is queued.
+        """
+        with self._lock:
+            if (label, key) in self._known:
+                return
+        with self.session(label) as si:
+            self.find_key(si, label, key[0], key_type=key[1])
+        with self._lock:
+            self._known.add((label, key))
+
+    def shutdown(self):
+        """
+        Stop the workers once they have signed the requests already queued.
+        """
+        with self._lock:
+            self._stopped = True
+            self._lock.notify_all()
+
+    def _take(self, state, key=None):
+        """
+        Take up to max_batch queued requests for key, or for the key that has waited longest if key
+        is None. Must be called holding the lock.
+
+        :return: the (keyname, key type) and the requests - None and [] if there are none
+        """
+        if key is None:
+            if not state.queues:
+                return None, []
+            key = next(iter(state.queues))
+        q = state.queues.get(key)
+        if not q:
+            return key, []
+        items = [q.popleft() for _ in range(0, min(len(q), self.max_batch))]
+        state.queued -= len(items)
+        now = time.time()
+        state.taken.extend([now] * len(items))
+        del state.queues[key]
+        if q:  # the rest waits behind the other keys
+            state.queues[key] = q
+        return key, items
+
+    def _batch(self, state, key, items, linger):
+        """
+        :return: items and the requests for key arriving within linger seconds, up to max_batch, that
+        are still pending
+        """
+        deadline = time.time() + linger
+        with self._lock:
+            while len(items) < self.max_batch:
+                more = self._take(state, key)[1]
+                items.extend(more[:self.max_batch - len(items)])
+                remaining = deadline - time.time()
+                if len(items) >= self.max_batch or remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+        return [item for item in items if item[0].set_running_or_notify_cancel()]
+
+    def _wait(self, label, state):
+        """
+        Wait for work for label.
+
+        :return: the (keyname, key type) and requests to sign, or None and [] if the worker should exit
+        """
+        with self._lock:
+            deadline = time.time() + self.idle_timeout
+            while True:
+                key, items = self._take(state)
+                if items:
+                    return key, items
+                remaining = deadline - time.time()
+                if self._stopped or remaining <= 0:
+                    state.workers -= 1
+                    if state.workers == 0 and not state.queues and self._labels.get(label) is state:
+                        del self._labels[label]
+                    return None, []
+                self._lock.wait(remaining)
+
+    def _work(self, label, state):
+        while True:
+            key, items = self._wait(label, state)
+            if key is None:
+                return
+            batch = self._batch(state, key, items, self.max_linger)
+            if not batch:
+                continue
+            try:
+                with self.session(label) as si:
+                    while batch:
+                        keyname, kt = key
+                        handle, cert = self.find_key(si, label, keyname, key_type=kt)
+                        batch_size.observe(len(batch), label=label)
+                        while batch:
+                            future, mech, data = batch.pop(0)
+                            try:
+                                signed = self.sign(si, handle, keyname, data, mech)
+                            except Exception as ex:
+                                future.set_exception(ex)
+                                if slot_failure(ex):
+                                    raise
+                                continue
+                            future.set_result((signed, cert, si.serial))
+                        with self._lock:  # more work for the label - keep the session
+                            key, items = self._take(state)
+                        batch = [item for item in items if item[0].set_running_or_notify_cancel()]
+            except Exception as ex:  # no session, no key or a failing slot - fail the rest of the batch
+                logger.warning('Dispatch to {!r}/{!r} failed: {!s}'.format(label, key, ex))
+                for future, mech, data in batch:
+                    future.set_exception(ex)
@@ -0,0 +1,115 @@
+"""
+Minimal process-wide metrics in the Prometheus text exposition format
+"""
+import threading
+
+__author__ = 'leifj'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format(name, labels, value):
+    if labels:
+        name = "%s{%s}" % (name, ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels))
+    return "%s %s" % (name, repr(float(value)))
+
+
+class Metric(object):
+    type = 'untyped'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.values = dict()
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def header(self):
+        return ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.type)]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self):
+        return [_format(self.name, self._labels(key), value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            counts, n, total = self.values.get(key, ([0] * len(self.buckets), 0, 0.0))
+            counts = [c + 1 if value <= b else c for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, n + 1, total + value)
+
+    def lines(self):
+        res = []
+        for key, (counts, n, total) in sorted(self.values.items()):
+            labels = self._labels(key)
+            for b, c in zip(self.buckets, counts):
+                res.append(_format(self.name + '_bucket', labels + [('le', repr(float(b)))], c))
+            res.append(_format(self.name + '_bucket', labels + [('le', '+Inf')], n))
+            res.append(_format(self.name + '_sum', labels, total))
+            res.append(_format(self.name + '_count', labels, n))
+        return res
+
+
+def register_collector(collect):
+    """
+    Register a function called when metrics are rendered. It should return a list of
+    (name, type, description, samples) tuples. Each sample is a (labels, value) or, for the _sum and
+    _count of a summary, a (suffix, labels, value) tuple where labels is a list of (name, value) tuples.
+    """
+    with _lock:
+        _collectors.append(collect)
+
+
+def render():
+    """
+    :return: all metrics in the Prometheus text exposition format
+    :rtype: str
+    """
+    res = []
+    with _lock:
+        metrics = list(_metrics)
+        collectors = list(_collectors)
+        for m in metrics:
+            res.extend(m.header())
+            res.extend(m.lines())
+    for collect in collectors:
+        for name, type, description, samples in collect():
+            res.append("# HELP %s %s" % (name, description))
+            res.append("# TYPE %s %s" % (name, type))
+            for sample in samples:
+                suffix = ''
+                if len(sample) == 3:
+                    suffix, sample = sample[0], sample[1:]
+                res.append(_format(name + suffix, sample[0], sample[1]))
+    return "\n".join(res) + "\n"
@@ -0,0 +1,564 @@
+"""
+A pure python stand-in for PyKCS11Lib for testing and load testing pyeleven without an HSM. Use it by setting
+PKCS11MODULE to 'mock' (or 'mock:<name>' to keep several apart) - load_library() then returns a MockLibrary
+configured by register() (or MOCK_PKCS11 in config.py) instead of loading a PKCS#11 module.
+
+The library emulates what pyeleven uses of PyKCS11: slots with tokens, sessions, login, object search,
+attributes and single and multi-part signing - with configurable latency per operation, session limits per
+slot, a cap on the number of operations the device works on at once and injected failures.
+
+Signatures aren't real: they are derived from the key and the data using SHA-256 so that they are
+deterministic, have the size of a real signature and are the same for a hash-and-sign mechanism as for the
+prehashed DigestInfo (or hash) signed using RSAPKCS1 (or ECDSA). They can't be verified.
+"""
+import hashlib
+import random
+import threading
+import time
+from collections import Counter, deque
+
+import six
+import PyKCS11
+from PyKCS11.LowLevel import CKA_ID, \
+    CKA_LABEL, \
+    CKA_CLASS, \
+    CKA_KEY_TYPE, \
+    CKA_VALUE, \
+    CKA_SIGN, \
+    CKA_PRIVATE, \
+    CKA_TOKEN, \
+    CKO_PRIVATE_KEY, \
+    CKO_CERTIFICATE, \
+    CKK_RSA, \
+    CKK_EC, \
+    CKK_EC_EDWARDS, \
+    CKR_OK, \
+    CKR_SLOT_ID_INVALID, \
+    CKR_SESSION_COUNT, \
+    CKR_SESSION_CLOSED, \
+    CKR_SESSION_HANDLE_INVALID, \
+    CKR_DEVICE_REMOVED, \
+    CKR_PIN_INCORRECT, \
+    CKR_OBJECT_HANDLE_INVALID, \
+    CKR_KEY_TYPE_INCONSISTENT, \
+    CKR_MECHANISM_INVALID, \
+    CKR_DATA_LEN_RANGE, \
+    CKR_OPERATION_ACTIVE, \
+    CKR_OPERATION_NOT_INITIALIZED
+
+from pyeleven.utils import DIGEST_INFO_PREFIX
+
+__author__ = 'leifj'
+
+# library names handled by this module instead of being loaded as a PKCS#11 module
+PREFIX = 'mock'
+
+# operations latency and failures can be configured for
+OPERATIONS = ('open', 'close', 'login', 'find', 'attributes', 'sign')
+
+DEFAULT_MECHANISMS = ('CKM_RSA_PKCS', 'CKM_SHA1_RSA_PKCS', 'CKM_SHA224_RSA_PKCS', 'CKM_SHA256_RSA_PKCS',
+                      'CKM_SHA384_RSA_PKCS', 'CKM_SHA512_RSA_PKCS', 'CKM_ECDSA', 'CKM_ECDSA_SHA1',
+                      'CKM_ECDSA_SHA224', 'CKM_ECDSA_SHA256', 'CKM_ECDSA_SHA384', 'CKM_ECDSA_SHA512', 'CKM_EDDSA')
+
+# key label -> key type: an RSA key like the one the tests use and an EC key
+DEFAULT_KEYS = {'test': 'RSA', 'ec': 'EC'}
+
+# key type name -> CKK and signature size in bytes (RSA 2048, P-256, Ed25519)
+_KEY_TYPES = {'RSA': (CKK_RSA, 256), 'EC': (CKK_EC, 64), 'EC_EDWARDS': (CKK_EC_EDWARDS, 64)}
+
+# mechanism -> key type it needs and the hash applied before signing
+_MECHANISMS = {
+    'CKM_RSA_PKCS': (CKK_RSA, None),
+    'CKM_SHA1_RSA_PKCS': (CKK_RSA, 'sha1'),
+    'CKM_SHA224_RSA_PKCS': (CKK_RSA, 'sha224'),
+    'CKM_SHA256_RSA_PKCS': (CKK_RSA, 'sha256'),
+    'CKM_SHA384_RSA_PKCS': (CKK_RSA, 'sha384'),
+    'CKM_SHA512_RSA_PKCS': (CKK_RSA, 'sha512'),
+    'CKM_ECDSA': (CKK_EC, None),
+    'CKM_ECDSA_SHA1': (CKK_EC, 'sha1'),
+    'CKM_ECDSA_SHA224': (CKK_EC, 'sha224'),
+    'CKM_ECDSA_SHA256': (CKK_EC, 'sha256'),
+    'CKM_ECDSA_SHA384': (CKK_EC, 'sha384'),
+    'CKM_ECDSA_SHA512': (CKK_EC, 'sha512'),
+    'CKM_EDDSA': (CKK_EC_EDWARDS, None),
+}
+
+# errors after which the session can't be used anymore
+_SESSION_ERRORS = (CKR_SESSION_HANDLE_INVALID, CKR_SESSION_CLOSED, CKR_DEVICE_REMOVED)
+
+_registry = dict()
+_registry_lock = threading.Lock()
+
+
+def is_mock(lib_name):
+    """
+    :param lib_name: PKCS11MODULE
+    :return: True if lib_name names a mock library
+    """
+    return isinstance(lib_name, six.string_types) and (lib_name == PREFIX or lib_name.startswith(PREFIX + ':'))
+
+
+def register(lib_name, **kwargs):
+    """
+    Create the MockLibrary load_library(lib_name) returns. Must be called before the library is first loaded.
+
+    :param lib_name: 'mock' or 'mock:<name>'
+    :param kwargs: MockLibrary arguments
+    :return: MockLibrary
+    """
+    if not is_mock(lib_name):
+        raise ValueError("{!r} isn't a mock library name".format(lib_name))
+    with _registry_lock:
+        lib = MockLibrary(**kwargs)
+        _registry[lib_name] = lib
+        return lib
+
+
+def library(lib_name):
+    """
+    :param lib_name: 'mock' or 'mock:<name>'
+    :return: the MockLibrary registered for lib_name, a MockLibrary with the defaults if none is
+    """
+    with _registry_lock:
+        if lib_name not in _registry:
+            _registry[lib_name] = MockLibrary()
+        return _registry[lib_name]
+
+
+def _latency(spec):
+    """
+    :param spec: seconds, or a (distribution, parameters...) tuple: ('fixed', s), ('uniform', a, b),
+    ('normal', mu, sigma), ('lognormal', mu, sigma) or ('exponential', mean)
+    :return: a function of a random.Random returning a delay in seconds
+    """
+    if spec is None:
+        return lambda rnd: 0
+    if isinstance(spec, (int, float)):
+        return lambda rnd: spec
+    name, params = spec[0], tuple(spec[1:])
+    if name == 'fixed':
+        return lambda rnd: params[0]
+    if name == 'uniform':
+        return lambda rnd: rnd.uniform(*params)
+    if name == 'normal':
+        return lambda rnd: max(0, rnd.normalvariate(*params))
+    if name == 'lognormal':
+        return lambda rnd: rnd.lognormvariate(*params)
+    if name == 'exponential':
+        return lambda rnd: rnd.expovariate(1.0 / params[0])
+    raise ValueError("Unknown latency distribution {!r}".format(name))
+
+
+def _rv(rv):
+    """
+    :param rv: CKR value or name, eg 'CKR_DEVICE_ERROR'
+    :return: the CKR value
+    """
+    if isinstance(rv, six.string_types):
+        return PyKCS11.CKR[rv]
+    return rv
+
+
+def _handle(o):
+    return o.value() if hasattr(o, 'value') else int(o)
+
+
+def _normalize(value):
+    if isinstance(value, (bytes, bytearray, list, tuple, PyKCS11.ckbytelist)):
+        return tuple(bytearray(value))
+    return value
+
+
+def _expand(secret, data, size):
+    """
+    :return: size bytes derived from secret and data
+    """
+    out = b''
+    counter = 0
+    while len(out) < size:
+        out += hashlib.sha256(secret + six.int2byte(counter & 0xff) + data).digest()
+        counter += 1
+    return out[:size]
+
+
+class _Token(object):
+
+    def __init__(self, label, serial, keys):
+        self.label = label
+        self.serial = serial
+        self.objects = dict()
+        for n, (keyname, key_type) in enumerate(sorted(keys.items())):
+            ckk = _KEY_TYPES[key_type][0]
+            key_id = (n + 1,)
+            handle = 2 * n + 1
+            self.objects[handle] = {CKA_CLASS: CKO_PRIVATE_KEY, CKA_KEY_TYPE: ckk, CKA_LABEL: keyname, CKA_ID: key_id,
+                                    CKA_SIGN: True, CKA_PRIVATE: True, CKA_TOKEN: True}
+            self.objects[handle + 1] = {CKA_CLASS: CKO_CERTIFICATE, CKA_LABEL: keyname, CKA_ID: key_id,
+                                        CKA_TOKEN: True, CKA_VALUE: tuple(bytearray(_certificate(keyname)))}
+
+    def match(self, template):
+        template = [(a, _normalize(v)) for a, v in template]
+        return [h for h, attrs in sorted(self.objects.items())
+                if all(a in attrs and _normalize(attrs[a]) == v for a, v in template)]
+
+
+def _certificate(keyname):
+    """
+    :return: a placeholder for the certificate of keyname - the bytes aren't a certificate
+    """
+    return b'mock certificate for ' + keyname.encode('utf-8')
+
+
+class _Info(object):
+    """
+    Slot or token info - attributes and to_dict() like PyKCS11's CK_SLOT_INFO and CK_TOKEN_INFO
+    """
+
+    def __init__(self, **kwargs):
+        self._fields = kwargs
+        self.__dict__.update(kwargs)
+
+    def to_dict(self):
+        return dict(self._fields)
+
+
+class MockSession(object):
+    """
+    Stands in for both PyKCS11.Session and the session handle: like PyKCS11.Session it has lib (for the
+    low level C_* calls) and session (the handle passed to them).
+    """
+
+    def __init__(self, lib, slot, handle):
+        self.lib = lib
+        self.slot = slot
+        self.handle = handle
+        self.session = self
+        self.closed = False
+        self.logged_in = False
+        self.find = None
+        self.sign_operation = None
+
+    def __repr__(self):
+        return 'MockSession[slot={:d},handle={:d}]'.format(self.slot, self.handle)
+
+    def _check(self, op):
+        self.lib._operation(op, self)
+
+    def login(self, pin, user_type=None):
+        self._check('login')
+        if self.lib.pin is not None and pin != self.lib.pin:
+            raise PyKCS11.PyKCS11Error(CKR_PIN_INCORRECT)
+        self.logged_in = True
+
+    def logout(self):
+        self.logged_in = False
+
+    def closeSession(self):
+        if self.closed:
+            raise PyKCS11.PyKCS11Error(CKR_SESSION_HANDLE_INVALID)
+        rv = self.lib._call('close', self.slot)
+        self.lib._close(self)  # closed even if closing fails
+        if rv != CKR_OK:
+            raise PyKCS11.PyKCS11Error(rv)
+
+    def getSessionInfo(self):
+        state = 'CKS_RW_USER_FUNCTIONS' if self.logged_in else 'CKS_RW_PUBLIC_SESSION'
+        return _Info(slotID=self.slot, state=state, flags=['CKF_RW_SESSION', 'CKF_SERIAL_SESSION'], ulDeviceError=0)
+
+    def _template2ckattrlist(self, template):
+        return list(template)
+
+    def findObjects(self, template=()):
+        self._check('find')
+        objects = []
+        for h in self.lib.tokens[self.slot].match(template):
+            o = PyKCS11.CK_OBJECT_HANDLE(self)
+            o.assign(h)
+            objects.append(o)
+        return objects
+
+    def getAttributeValue(self, o, attrs, allAsBinary=False):
+        self._check('attributes')
+        attributes = self.lib.tokens[self.slot].objects.get(_handle(o))
+        if attributes is None:
+            raise PyKCS11.PyKCS11Error(CKR_OBJECT_HANDLE_INVALID)
+        # like PyKCS11 attributes the object doesn't have are None
+        return [attributes.get(a) for a in attrs]
+
+    def sign(self, key, data, mecha=PyKCS11.MechanismRSAPKCS1):
+        self._check('sign')
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        rv, signature = self.lib._sign(self, key, mecha.to_native().mechanism, bytes(bytearray(data)))
+        if rv != CKR_OK:
+            raise PyKCS11.PyKCS11Error(rv)
+        return PyKCS11.ckbytelist(signature)
+
+
+class MockLibrary(object):
+    """
+    A fake PyKCS11Lib.
+
+    :param tokens: token label of each slot
+    :param keys: key label -> key type ('RSA', 'EC' or 'EC_EDWARDS') of the keys on every token, each with a
+    placeholder certificate
+    :param mechanisms: CKM names of the mechanisms every slot supports
+    :param pin: user pin, None accepts any pin
+    :param latency: operation (one of OPERATIONS or '*' for all others) -> seconds or distribution, see _latency()
+    :param slot_latency: slot -> factor all latencies on the slot are multiplied by, eg to make one slot slow
+    :param failures: operation (or '*') -> list of (CKR value or name, probability) - the operation fails
+    with the first error drawn
+    :param max_sessions: sessions that can be open on each slot at once, more fail with CKR_SESSION_COUNT
+    :param concurrency: operations the device works on at once, others wait for their turn
+    :param seed: seed for the latency and failure draws
+    """
+
+    def __init__(self, tokens=('test', 'test'), keys=None, mechanisms=DEFAULT_MECHANISMS, pin=None, latency=None,
+                 slot_latency=None, failures=None, max_sessions=None, concurrency=None, seed=None):
+        self.lib = self
+        self.pin = pin
+        self.keys = dict(keys or DEFAULT_KEYS)
+        self.tokens = [_Token(label, 'mock{:012d}'.format(slot), self.keys) for slot, label in enumerate(tokens)]
+        self.mechanisms = list(mechanisms)
+        self.latency = dict((op, _latency(spec)) for op, spec in (latency or {}).items())
+        self.slot_latency = dict(slot_latency or {})
+        self.failures = dict((op, [(_rv(rv), p) for rv, p in errors]) for op, errors in (failures or {}).items())
+        self.max_sessions = max_sessions
+        self.calls = Counter()
+        self.sessions = Counter()
+        self._injected = dict()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._handles = 0
+        self._capacity = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.initialized = False
+
+    def __repr__(self):
+        return 'MockLibrary[slots={:d}]'.format(len(self.tokens))
+
+    def inject(self, op, rv, count=1, slot=None):
+        """
+        Make the next count calls of op (on slot, or any slot) fail with rv.
+
+        :param op: one of OPERATIONS
+        :param rv: CKR value or name, eg CKR_SESSION_HANDLE_INVALID
+        :param count: number of calls to fail
+        :param slot: slot number or None for any slot
+        """
+        with self._lock:
+            self._injected.setdefault(op, deque()).extend([(_rv(rv), slot)] * count)
+
+    def _failure(self, op, slot):
+        with self._lock:
+            injected = self._injected.get(op)
+            if injected:
+                for i, (rv, s) in enumerate(injected):
+                    if s is None or s == slot:
+                        del injected[i]
+                        return rv
+            for rv, p in self.failures.get(op, self.failures.get('*', [])):
+                if self._random.random() < p:
+                    return rv
+        return CKR_OK
+
+    def _delay(self, op, slot):
+        latency = self.latency.get(op, self.latency.get('*'))
+        if latency is None:
+            return 0
+        with self._lock:
+            delay = latency(self._random)
+        return delay * self.slot_latency.get(slot, 1)
+
+    def _call(self, op, slot):
+        """
+        Count, delay and (maybe) fail an operation on slot while holding a place in the device.
+
+        :return: CKR_OK or the error the operation fails with
+        """
+        self.calls[op] += 1
+        self.calls['{!s}{:d}'.format(op, slot)] += 1
+        if self._capacity is not None:
+            self._capacity.acquire()
+        try:
+            delay = self._delay(op, slot)
+            if delay > 0:
+                time.sleep(delay)
+            return self._failure(op, slot)
+        finally:
+            if self._capacity is not None:
+                self._capacity.release()
+
+    def _operation(self, op, session):
+        """
+        :raise PyKCS11.PyKCS11Error: if the session is closed or the operation fails
+        """
+        if session.closed:
+            raise PyKCS11.PyKCS11Error(CKR_SESSION_HANDLE_INVALID)
+        rv = self._call(op, session.slot)
+        if rv in _SESSION_ERRORS:
+            self._close(session)
+        if rv != CKR_OK:
+            raise PyKCS11.PyKCS11Error(rv)
+
+    def _low_level(self, op, session):
+        try:
+            self._operation(op, session)
+        except PyKCS11.PyKCS11Error as ex:
+            return ex.value
+        return CKR_OK
+
+    def _close(self, session):
+        with self._lock:
+            if not session.closed:
+                session.closed = True
+                self.sessions[session.slot] -= 1
+
+    def _sign(self, session, key, mech, data=None, digest=None):
+        """
+        :param digest: for a hash-and-sign mechanism the hash of the data instead of data
+        :return: CKR value and the signature of data by key using mech
+        """
+        name = PyKCS11.CKM.get(mech)
+        if name not in self.mechanisms or name not in _MECHANISMS:
+            return CKR_MECHANISM_INVALID, None
+        ckk, hash_name = _MECHANISMS[name]
+        attributes = self.tokens[session.slot].objects.get(_handle(key))
+        if attributes is None or attributes[CKA_CLASS] != CKO_PRIVATE_KEY:
+            return CKR_OBJECT_HANDLE_INVALID, None
+        if attributes[CKA_KEY_TYPE] != ckk:
+            return CKR_KEY_TYPE_INCONSISTENT, None
+        if hash_name is not None:
+            if digest is None:
+                digest = hashlib.new(hash_name, data).digest()
+            data = DIGEST_INFO_PREFIX[hash_name] + digest if ckk == CKK_RSA else digest
+        size = [s for c, s in _KEY_TYPES.values() if c == ckk][0]
+        if ckk == CKK_RSA and len(data) > size - 11:
+            return CKR_DATA_LEN_RANGE, None
+        secret = attributes[CKA_LABEL].encode('utf-8') + bytes(bytearray(attributes[CKA_ID]))
+        return CKR_OK, _expand(secret, data, size)
+
+    # PyKCS11Lib
+
+    def load(self, pkcs11dll_filename=None):
+        return self
+
+    def C_Initialize(self):
+        self.initialized = True
+        return CKR_OK
+
+    def C_Finalize(self):
+        self.initialized = False
+        return CKR_OK
+
+    def getSlotList(self, tokenPresent=False):
+        return list(range(len(self.tokens)))
+
+    def _token(self, slot):
+        if not 0 <= slot < len(self.tokens):
+            raise PyKCS11.PyKCS11Error(CKR_SLOT_ID_INVALID)
+        return self.tokens[slot]
+
+    def getSlotInfo(self, slot):
+        self._token(slot)
+        return _Info(slotDescription='pyeleven mock slot {:d}'.format(slot), manufacturerID='pyeleven',
+                     flags=['CKF_TOKEN_PRESENT'], hardwareVersion='0.0', firmwareVersion='0.0')
+
+    def getTokenInfo(self, slot):
+        token = self._token(slot)
+        return _Info(label=token.label.ljust(32), manufacturerID='pyeleven', model='mock',
+                     serialNumber=token.serial, flags=['CKF_TOKEN_INITIALIZED', 'CKF_USER_PIN_INITIALIZED'])
+
+    def getMechanismList(self, slot):
+        self._token(slot)
+        return list(self.mechanisms)
+
+    def openSession(self, slot, flags=0):
+        self._token(slot)
+        with self._lock:
+            if self.max_sessions is not None and self.sessions[slot] >= self.max_sessions:
+                raise PyKCS11.PyKCS11Error(CKR_SESSION_COUNT)
+            self.sessions[slot] += 1
+            self._handles += 1
+            session = MockSession(self, slot, self._handles)
+        try:
+            rv = self._call('open', slot)
+        except Exception:
+            self._close(session)
+            raise
+        if rv != CKR_OK:
+            self._close(session)
+            raise PyKCS11.PyKCS11Error(rv)
+        return session
+
+    def closeSession(self, session):
+        session.closeSession()
+
+    # the low level calls pyeleven makes: they return a CKR value instead of raising
+
+    def C_FindObjectsInit(self, session, template):
+        rv = self._low_level('find', session)
+        if rv == CKR_OK:
+            if session.find is not None:
+                return CKR_OPERATION_ACTIVE
+            session.find = deque(self.tokens[session.slot].match(template))
+        return rv
+
+    def C_FindObjects(self, session, result):
+        if session.closed:
+            return CKR_SESSION_HANDLE_INVALID
+        if session.find is None:
+            return CKR_OPERATION_NOT_INITIALIZED
+        handles = [session.find.popleft() for _ in range(min(len(result), len(session.find)))]
+        result.resize(len(handles))
+        for i, h in enumerate(handles):
+            result[i] = h
+        return CKR_OK
+
+    def C_FindObjectsFinal(self, session):
+        if session.find is None:
+            return CKR_OPERATION_NOT_INITIALIZED
+        session.find = None
+        return CKR_OK
+
+    def C_SignInit(self, session, mech, key):
+        if session.closed:
+            return CKR_SESSION_HANDLE_INVALID
+        if session.sign_operation is not None:
+            return CKR_OPERATION_ACTIVE
+        name = PyKCS11.CKM.get(mech.mechanism)
+        if name not in self.mechanisms or _MECHANISMS.get(name, (None, None))[1] is None:
+            return CKR_MECHANISM_INVALID  # only hash-and-sign mechanisms are multi-part
+        session.sign_operation = [mech.mechanism, key, hashlib.new(_MECHANISMS[name][1]), None]
+        return CKR_OK
+
+    def C_SignUpdate(self, session, data):
+        if session.closed:
+            return CKR_SESSION_HANDLE_INVALID
+        if session.sign_operation is None:
+            return CKR_OPERATION_NOT_INITIALIZED
+        session.sign_operation[2].update(bytes(bytearray(data)))
+        return CKR_OK
+
+    def C_SignFinal(self, session, signature):
+        """
+        Like the PKCS#11 function: called with an empty signature it returns the size of the signature and the
+        operation stays active, called again the signature is filled in and the operation ends.
+        """
+        if session.sign_operation is None:
+            return CKR_OPERATION_NOT_INITIALIZED
+        mech, key, h, signed = session.sign_operation
+        if signed is None:
+            rv = self._low_level('sign', session)
+            if rv == CKR_OK:
+                rv, signed = self._sign(session, key, mech, digest=h.digest())
+            if rv != CKR_OK:
+                session.sign_operation = None
+                return rv
+            session.sign_operation[3] = signed
+        if len(signature) == 0:
+            signature.resize(len(signed))
+            return CKR_OK
+        for i, b in enumerate(bytearray(signed)):
+            signature[i] = b
+        session.sign_operation = None
+        return CKR_OK
@@ -1,10 +1,16 @@
+import atexit
 import six
 import threading
 
-from pyeleven.pool import ObjectPool, allocation
-from pyeleven.utils import intarray2bytes, cert_der2pem, PKCS11Exception
-from random import SystemRandom
-from operator import eq, lt
+from pyeleven import metrics, mock, scheduler
+from pyeleven.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from pyeleven.cache import TTLCache, LRUCache
+from pyeleven.pool import ObjectPool, NoCapacity, allocation
+from pyeleven.utils import intarray2bytes, cert_der2pem, cert_fingerprint, PKCS11Exception, SlotsUnavailable, \
+    LibraryUnavailable, NotFound
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+import math
 import time
 import logging
 import PyKCS11
@@ -12,10 +18,25 @@ from PyKCS11.LowLevel import CKA_ID, \
     CKA_LABEL, \
     CKA_CLASS, \
     CKO_PRIVATE_KEY, \
+    CKO_PUBLIC_KEY, \
+    CKO_SECRET_KEY, \
     CKO_CERTIFICATE, \
     CKK_RSA, \
+    CKK_EC, \
+    CKK_EC_EDWARDS, \
     CKA_KEY_TYPE, \
-    CKA_VALUE
+    CKA_VALUE, \
+    CKR_OK, \
+    CKR_CRYPTOKI_ALREADY_INITIALIZED, \
+    CKR_GENERAL_ERROR, \
+    CKR_FUNCTION_FAILED, \
+    CKR_DEVICE_ERROR, \
+    CKR_DEVICE_MEMORY, \
+    CKR_DEVICE_REMOVED, \
+    CKR_SESSION_CLOSED, \
+    CKR_SESSION_HANDLE_INVALID, \
+    CKR_TOKEN_NOT_PRESENT, \
+    CKR_TOKEN_NOT_RECOGNIZED
 
 __author__ = 'leifj'
 
@@ -31,76 +52,349 @@ all_attributes.remove(PyKCS11.LowLevel.CKA_COEFFICIENT)
 all_attributes = [e for e in all_attributes if isinstance(e, int)]
 
 logger = logging.getLogger(__name__)
-thread_data = threading.local()
+
+# Modules, sessions, pools and slot breakers are shared by all threads in the process and protected by _lock
+_lock = threading.RLock()
+_module_registry = dict()
+_session_registry = dict()
+_pool_registry = dict()
+_breaker_registry = dict()
+_stats_registry = dict()
+_weight_registry = dict()
+_load_failures = dict()  # library name -> (time to try loading it again, LibraryUnavailable)
+
+settings = dict(
+    sessions_per_slot=4,  # maximum number of sessions kept open on each slot
+    label_cache_ttl=60,  # seconds to cache the token label to slot mapping
+    key_cache_ttl=300,  # seconds to cache key ids and certificates
+    pool_timeout=30,  # seconds to wait for a free session, None waits forever
+    max_waiting=None,  # requests that may wait for a session per label before more are turned away, None for no limit
+    inventory_ttl=60,  # seconds to cache the mechanisms, slot info and token info of each slot
+    inventory_error_ttl=5,  # seconds to cache them when fetching any of them failed
+    load_decay=10,  # time constant in seconds for the recent load used to pick sessions
+    breaker_failure_rate=0.5,  # failure rate among recent operations on a slot that takes it out of rotation
+    breaker_min_requests=3,  # operations on a slot recorded before its failure rate is considered
+    breaker_window=10,  # number of recent operations on a slot the failure rate is computed over
+    breaker_reset_timeout=30,  # seconds a failing slot is left alone before a request probes it
+    slot_strategy='p2c',  # how to pick a slot, one of scheduler.STRATEGIES
+    latency_alpha=0.3,  # weight of the latest operation in the moving average of slot latency
+    signature_cache_size=0,  # signatures of deterministic mechanisms to cache, 0 disables the cache
+    signature_cache_ttl=300,  # seconds to cache a signature
+)
+
+
+def configure(**kwargs):
+    """
+    Update the process-wide pkcs11 settings. Settings only affect pools created after the call.
+    """
+    unknown = set(kwargs.keys()) - set(settings.keys())
+    if unknown:
+        raise ValueError("Unknown pkcs11 settings: {!s}".format(', '.join(sorted(unknown))))
+    if kwargs.get('slot_strategy', settings['slot_strategy']) not in scheduler.STRATEGIES:
+        raise ValueError("Unknown slot strategy {!r}".format(kwargs['slot_strategy']))
+    settings.update(kwargs)
+    _token_cache.ttl = settings['label_cache_ttl']
+    _key_cache.ttl = settings['key_cache_ttl']
+    _object_cache.ttl = settings['key_cache_ttl']
+    _cert_cache.ttl = settings['key_cache_ttl']
+    _public_key_cache.ttl = settings['key_cache_ttl']
+    _inventory_cache.ttl = settings['inventory_ttl']
+    _signature_cache.maxsize = settings['signature_cache_size']
+    _signature_cache.ttl = settings['signature_cache_ttl']
 
 
 def _modules():
-    if not hasattr(thread_data, 'modules'):
-        thread_data.modules = dict()
-    return thread_data.modules
+    return _module_registry
+
+
+def modules(library_name):
+    """
+    :param library_name: path to a PKCS#11 library or a list of them (a cluster) - each a path or a
+    (path, weight) pair
+    :return: tuple of (path, weight) pairs
+    """
+    if isinstance(library_name, six.string_types):
+        return (library_name, 1),
+    res = []
+    for module in library_name:
+        if isinstance(module, six.string_types):
+            module = (module, 1)
+        name, weight = module
+        if not weight > 0:
+            raise ValueError("Weight of {!r} must be positive".format(name))
+        res.append((name, weight))
+    if not res:
+        raise ValueError("No PKCS#11 library")
+    return tuple(res)
+
+
+def _cluster_key(library_name):
+    return library_name if isinstance(library_name, six.string_types) else modules(library_name)
+
+
+def pool_key(library_name, label):
+    """
+    :return: the key of the session pool for a label, as in pool_stats()
+    """
+    return _cluster_key(library_name), label
 
 
 def _sessions():
-    if not hasattr(thread_data, 'sessions'):
-        thread_data.sessions = dict()
-    return thread_data.sessions
+    return _session_registry
 
 
 def _pools():
-    if not hasattr(thread_data, 'pools'):
-        thread_data.pools = dict()
-    return thread_data.pools
+    return _pool_registry
+
+
+def _breakers():
+    return _breaker_registry
+
+
+def breaker(library_name, slot):
+    """
+    :return: the CircuitBreaker for slot in library_name
+    """
+    with _lock:
+        b = _breakers().get((library_name, slot))
+        if b is None:
+            b = CircuitBreaker(failure_rate=settings['breaker_failure_rate'],
+                               min_requests=settings['breaker_min_requests'],
+                               window=settings['breaker_window'],
+                               reset_timeout=settings['breaker_reset_timeout'])
+            _breakers()[(library_name, slot)] = b
+        return b
+
+
+def _slot_stats():
+    return _stats_registry
+
+
+def slot_stats(library_name, slot):
+    """
+    :return: the scheduler.SlotStats for slot in library_name, weighted by the weight of the library
+    """
+    with _lock:
+        stats = _slot_stats().get((library_name, slot))
+        if stats is None:
+            stats = scheduler.SlotStats(alpha=settings['latency_alpha'], decay=settings['load_decay'],
+                                        weight=_weight_registry.get(library_name, 1))
+            _slot_stats()[(library_name, slot)] = stats
+        return stats
+
+
+def choose(slots, stats=None):
+    """
+    :param slots: (library name, slot) pairs
+    :param stats: function returning the scheduler.SlotStats of a slot, slot_stats() by default
+    :return: one of slots chosen using the configured slot strategy
+    """
+    return scheduler.STRATEGIES[settings['slot_strategy']](slots, stats or (lambda ref: slot_stats(*ref)))
+
+
+def slot_name(library_name, slot):
+    """
+    :return: the name of a slot in metrics - the slot number, prefixed by the library if more than one is loaded
+    """
+    with _lock:
+        if len(_modules()) <= 1:
+            return slot
+    return '{!s}:{!s}'.format(library_name, slot)
 
 
 def reset():
-    _pools()
-    _sessions()
-    _modules()
-    thread_data.pools = dict()
-    thread_data.sessions = dict()
-    thread_data.modules = dict()
+    with _lock:
+        for sessions in list(_session_registry.values()):
+            for si in list(sessions):
+                if isinstance(si, SessionInfo):
+                    si.close()
+        _pool_registry.clear()
+        _session_registry.clear()
+        _breaker_registry.clear()
+        _stats_registry.clear()
+        _load_failures.clear()
+    invalidate_tokens()
+    invalidate_keys()
+    invalidate_inventory()
+    _object_cache.invalidate()
 
 
 def load_library(lib_name):
-    modules = _modules()
-    if lib_name not in modules:
-        logger.debug('loading load_library {!r}'.format(lib_name))
-        lib = PyKCS11.PyKCS11Lib()
-        # lib.load needs to be str for current python version
-        if six.PY2:
-            if not isinstance(lib_name, six.binary_type):
-                lib_name = lib_name.encode()
-        else:
-            if not isinstance(lib_name, six.text_type):
-                lib_name = lib_name.decode('utf-8')
-        lib.load(lib_name)
-        lib.lib.C_Initialize()
-        modules[lib_name] = lib
+    """
+    Load and initialize a PKCS#11 library. The library is loaded once per process and shared by all
+    threads - PyKCS11 initializes the module with CKF_OS_LOCKING_OK when it is loaded so the module
+    does its own locking. All loaded libraries are finalized by finalize() when the process exits.
+
+    A lib_name of 'mock' or 'mock:<name>' returns the pyeleven.mock.MockLibrary registered for it instead.
+
+    A library that fails to load isn't tried again for breaker_reset_timeout seconds.
+
+    :param lib_name: path to the PKCS#11 library
+    :return: PyKCS11Lib
+    :raise LibraryUnavailable: if loading the library failed less than breaker_reset_timeout seconds ago
+    """
+    with _lock:
+        modules = _modules()
+        if lib_name not in modules:
+            failed = _load_failures.get(lib_name)
+            if failed is not None:
+                retry_at, error = failed
+                if time.time() < retry_at:
+                    raise error
+                del _load_failures[lib_name]
+            try:
+                modules[lib_name] = _load_library(lib_name)
+            except PyKCS11.PyKCS11Error as ex:
+                logger.warning('Failed loading {!r}: {!s}'.format(lib_name, ex))
+                retry_after = settings['breaker_reset_timeout']
+                _load_failures[lib_name] = (time.time() + retry_after, LibraryUnavailable(
+                    'Loading {!r} failed: {!s}'.format(lib_name, ex), retry_after=retry_after))
+                raise
+
+        return modules[lib_name]
+
+
+def _load_library(lib_name):
+    logger.debug('loading load_library {!r}'.format(lib_name))
+    lib = mock.library(lib_name) if mock.is_mock(lib_name) else PyKCS11.PyKCS11Lib()
+    # lib.load needs to be str for current python version
+    name = lib_name
+    if six.PY2:
+        if not isinstance(name, six.binary_type):
+            name = name.encode()
+    else:
+        if not isinstance(name, six.text_type):
+            name = name.decode('utf-8')
+    lib.load(name)
+    rv = lib.lib.C_Initialize()
+    if rv not in (CKR_OK, CKR_CRYPTOKI_ALREADY_INITIALIZED):
+        raise PyKCS11.PyKCS11Error(rv)
+    return lib
+
+
+def finalize():
+    """
+    Close all sessions and finalize every loaded library. Registered to run once at process exit.
+    """
+    with _lock:
+        reset()
+        for lib_name, lib in list(_modules().items()):
+            logger.debug('finalizing library {!r}'.format(lib_name))
+            try:
+                lib.lib.C_Finalize()
+            except Exception as ex:
+                logger.warning('Failed finalizing library {!r}: {!s}'.format(lib_name, ex))
+        _modules().clear()
+
+
+atexit.register(finalize)
+
+
+class KeyInfo(object):
+    """
+    The parts of a private key and its certificate that are the same for every session on a token.
+    """
+
+    def __init__(self, key_id, cert_der=None, key_type=None):
+        self.key_id = key_id
+        self.key_type = key_type
+        self.cert_der = cert_der
+        self.cert_pem = cert_der2pem(cert_der) if cert_der is not None else None
+        self.cert_fingerprint = cert_fingerprint(cert_der) if cert_der is not None else None
+
+
+_key_cache = TTLCache(ttl=settings['key_cache_ttl'], refresh_ahead=None)
 
-    return modules[lib_name]
+# key types find_key looks up - keys are cached per (serial, keyname, key type)
+KEY_TYPES = (None, CKK_RSA, CKK_EC, CKK_EC_EDWARDS)
+
+
+# signatures made using deterministic mechanisms by (label, keyname, mechanism, hash of the data)
+_signature_cache = LRUCache(maxsize=settings['signature_cache_size'], ttl=settings['signature_cache_ttl'])
+
+# the handles of the objects matching a template by (library name, token serial, template) for paging
+_object_cache = LRUCache(maxsize=64, ttl=settings['key_cache_ttl'])
+
+# certificates by (label, token serial, keyname, key type) and the public keys in them by certificate fingerprint,
+# so that certificates can be served and signatures verified without a session
+_cert_cache = TTLCache(ttl=settings['key_cache_ttl'], refresh_ahead=None)
+_public_key_cache = TTLCache(ttl=settings['key_cache_ttl'], refresh_ahead=None)
+
+
+def signature_cache():
+    """
+    :return: the LRUCache of signatures made using deterministic mechanisms
+    """
+    return _signature_cache
+
+
+def cert_cache():
+    """
+    :return: the TTLCache of certificates (as KeyInfo) by label, token serial, keyname and key type
+    """
+    return _cert_cache
+
+
+def public_key_cache():
+    """
+    :return: the TTLCache of public keys by certificate fingerprint
+    """
+    return _public_key_cache
+
+
+def invalidate_keys(serial=None, keyname=None):
+    """
+    Drop cached key information for keyname on the token with the given serial number, or for all keys.
+    Cached signatures, certificates and public keys are dropped for all keys since they are cached by label
+    or by certificate rather than by token and keyname.
+    """
+    _signature_cache.invalidate()
+    _cert_cache.invalidate()
+    _public_key_cache.invalidate()
+    if serial is None and keyname is None:
+        _key_cache.invalidate()
+    else:
+        for key_type in KEY_TYPES:
+            _key_cache.invalidate((serial, keyname, key_type))
+
+
+def token_serial(lib, slot):
+    serial = tokens(lib)['serials'].get(slot)
+    if serial is None:
+        serial = lib.getTokenInfo(slot).serialNumber.strip()
+    return serial
 
 
 class SessionInfo(object):
-    def __init__(self, session, slot):
+    def __init__(self, session, slot, library_name=None, serial=None):
         self.session = session
         self.slot = slot
+        self.library_name = library_name
+        self.serial = serial
+        self.breaker = None  # the CircuitBreaker and scheduler.SlotStats of the slot, set by the pool
+        self.stats = None
         self.keys = {}
         self.use_count = 0
+        self.load = 0.0
+        self.last_used = time.time()
 
     @property
     def priority(self):
-        return self.use_count
+        """
+        The recent load on the session: the number of uses decayed with a time constant of
+        settings['load_decay'] seconds. The pool hands out the idle session with the lowest priority.
+        """
+        return self.load * math.exp((self.last_used - time.time()) / settings['load_decay'])
+
+    def bump(self):
+        self.load = self.priority + 1
+        self.last_used = time.time()
+        self.use_count += 1
 
     def __str__(self):
         return "SessionInfo[session=%s,slot=%d,use_count=%d,keys=%d]" % (
             self.session, self.slot, self.use_count, len(self.keys))
 
-    def __eq__(self, other):
-        return eq(self.use_count, other.use_count)
-
-    def __lt__(self, other):
-        return lt(self.use_count, other.use_count)
-
     def find_object(self, template):
         for o in self.session.findObjects(template):
             return o
@@ -110,8 +404,8 @@ class SessionInfo(object):
         attributes = self.session.getAttributeValue(o, attrs)
         return dict(zip(attrs, attributes))
 
-    def get_object_friendly_attrs(self, o):
-        attrs = [CKA_ID, CKA_LABEL, CKA_CLASS, CKA_KEY_TYPE]
+    def get_object_friendly_attrs(self, o, attrs=(CKA_ID, CKA_LABEL, CKA_CLASS, CKA_KEY_TYPE)):
+        attrs = list(attrs)
         attributes = self.session.getAttributeValue(o, attrs)
         res = {}
         for q, a in zip(attrs, attributes):
@@ -126,33 +420,207 @@ class SessionInfo(object):
                 res[name] = str(a)
         return res
 
-    def find_key(self, keyname, find_cert=True):
+    def find_objects(self, template=(), offset=0, limit=100, batch=64):
+        """
+        A page of the objects matching template. The first page (offset 0) searches the token for all of them
+        and keeps their handles for key_cache_ttl seconds, so the following pages are sliced from those instead
+        of searching through the objects before them again.
+
+        :param template: list of (attribute, value) tuples the objects must match
+        :param offset: number of matching objects to skip
+        :param limit: maximum number of objects to return
+        :param batch: maximum number of handles to fetch in each C_FindObjects call
+        :return: a list of at most limit object handles and True if there are more objects
+        """
+        key = (self.library_name, self.serial, tuple(template))
+        found = _object_cache.get(key) if offset else None
+        if found is None:
+            found = self._find_handles(template, batch)
+            _object_cache.put(key, found)
+        handles = []
+        for x in found[offset:offset + limit]:
+            handle = PyKCS11.CK_OBJECT_HANDLE(self.session)
+            handle.assign(x)
+            handles.append(handle)
+        return handles, len(found) > offset + limit
+
+    def _find_handles(self, template, batch):
+        """
+        C_FindObjects for all objects matching template, at most batch handles at a time
+
+        :return: tuple of handles
+        """
+        lib = self.session.lib
+        rv = lib.C_FindObjectsInit(self.session.session, self.session._template2ckattrlist(template))
+        if rv != CKR_OK:
+            raise PyKCS11.PyKCS11Error(rv)
+        found = []
+        try:
+            while True:
+                result = PyKCS11.LowLevel.ckulonglist(batch)
+                rv = lib.C_FindObjects(self.session.session, result)
+                if rv != CKR_OK:
+                    raise PyKCS11.PyKCS11Error(rv)
+                if len(result) == 0:
+                    break
+                found.extend(result)
+        finally:
+            lib.C_FindObjectsFinal(self.session.session)
+        return tuple(found)
+
+    def get_objects_friendly_attrs(self, objects, object_class=None):
+        """
+        Fetch the friendly attributes of a list of objects. CKA_KEY_TYPE is invalid for objects that
+        aren't keys which makes PyKCS11 fall back to fetching one attribute at a time, so it is only
+        asked for when the objects are known to be keys and otherwise fetched separately for keys.
+
+        :param objects: object handles
+        :param object_class: the CKA_CLASS of all the objects if known
+        :return: a list with a dict of attributes for each object - None if fetching them failed
+        """
+        keys = (CKO_PRIVATE_KEY, CKO_PUBLIC_KEY, CKO_SECRET_KEY)
+        if object_class in keys:
+            attrs = (CKA_ID, CKA_LABEL, CKA_CLASS, CKA_KEY_TYPE)
+        else:
+            attrs = (CKA_ID, CKA_LABEL, CKA_CLASS)
+        res = []
+        for o in objects:
+            try:
+                friendly = self.get_object_friendly_attrs(o, attrs)
+                if object_class is None and friendly.get('CKA_CLASS') in [str(k) for k in keys]:
+                    friendly.update(self.get_object_friendly_attrs(o, (CKA_KEY_TYPE,)))
+                res.append(friendly)
+            except Exception as ex:
+                logger.error('Failed fetching attributes for object, error: {!s}'.format(ex))
+                res.append(None)
+        return res
+
+    def find_key(self, keyname, find_cert=True, key_type=None):
+        """
+        Find the private key with CKA_LABEL keyname and its certificate. The key id and certificate
+        are cached for all sessions on the token so a new session only has to look up the key handle.
+
+        :param keyname: CKA_LABEL of the key
+        :param find_cert: return the certificate for the key
+        :param key_type: CKK_* type the key must have (eg CKK_RSA, CKK_EC) or None for a key of any type
+        :return: a (key handle, certificate PEM) tuple or (None, None) if the key isn't found
+        """
         if keyname is None:
             raise PKCS11Exception('keyname can not be None')
-        if keyname not in self.keys:
-            key = self.find_object([(CKA_LABEL, keyname), (CKA_CLASS, CKO_PRIVATE_KEY), (CKA_KEY_TYPE, CKK_RSA)])
+
+        template = [(CKA_LABEL, keyname), (CKA_CLASS, CKO_PRIVATE_KEY)]
+        if key_type is not None:
+            template.append((CKA_KEY_TYPE, key_type))
+        kind = PyKCS11.CKK.get(key_type, 'any')
+        found = dict()
+
+        def _load():
+            key = self.find_object(template)
             if key is None:
-                logger.debug('Private RSA key with CKA_LABEL {!r} not found'.format(keyname))
+                return None
+            found['key'] = key
+            info = self._key_info(key, keyname)
+            if key_type is None:  # also serve lookups for the type the key turned out to have
+                _key_cache.put((self.serial, keyname, info.key_type), info)
+            return info
+
+        info = _key_cache.get((self.serial, keyname, key_type), _load)
+        if info is None:
+            logger.debug('Private key ({!s}) with CKA_LABEL {!r} not found'.format(kind, keyname))
+            return None, None
+
+        cached = self.keys.get((keyname, key_type))
+        if cached is None or cached[0] is not info:
+            key = found.get('key')
+            if key is None:
+                key = self.find_object(template + [(CKA_ID, info.key_id)])
+            if key is None:  # the key has gone away since it was cached
+                logger.debug('Private key ({!s}) with CKA_LABEL {!r} no longer found'.format(kind, keyname))
+                invalidate_keys(self.serial, keyname)
                 return None, None
-            cert_pem = None
-            if find_cert:
-                key_a = self.get_object_attributes(key, attrs = [CKA_ID])
-                logger.debug('Looking for certificate with CKA_ID {!r}'.format(key_a[CKA_ID]))
-                cert = self.find_object([(CKA_ID, key_a[CKA_ID]), (CKA_CLASS, CKO_CERTIFICATE)])
-                if cert is not None:
-                    cert_a = self.get_object_attributes(cert)
-                    cert_pem = cert_der2pem(intarray2bytes(cert_a[CKA_VALUE]))
-                    logger.debug('Certificate found:\n{!r}'.format(cert))
-                else:
-                    logger.warning('Found no certificate for key with keyname {!r}'.format(keyname))
-            self.keys[keyname] = (key, cert_pem)
-
-        return self.keys[keyname]
+            cached = (info, key)
+            self.keys[(keyname, key_type)] = cached
+            if key_type is None:  # the handle also serves lookups for the type the key turned out to have
+                self.keys[(keyname, info.key_type)] = cached
+
+        return cached[1], info.cert_pem if find_cert else None
+
+    def key_info(self, keyname, key_type=None):
+        """
+        :return: the KeyInfo for the key the last find_key(keyname, key_type=key_type) on this session found or None
+        """
+        cached = self.keys.get((keyname, key_type))
+        return cached[0] if cached is not None else None
+
+    def sign_stream(self, key, stream, mech, chunk_size=64 * 1024):
+        """
+        C_SignInit/C_SignUpdate/C_SignFinal - sign data read from stream in chunk_size pieces so that
+        no more than one chunk is held in memory. Only mechanisms that support multi-part signing can be used.
+
+        :param key: key handle
+        :param stream: file-like object with the data to sign
+        :param mech: PyKCS11.Mechanism
+        :param chunk_size: bytes to read from stream and send to the token at a time
+        :return: the signature
+        :rtype: ckbytelist
+        """
+        lib = self.session.lib
+        rv = lib.C_SignInit(self.session.session, mech.to_native(), key)
+        if rv != CKR_OK:
+            raise PyKCS11.PyKCS11Error(rv)
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            rv = lib.C_SignUpdate(self.session.session, PyKCS11.ckbytelist(chunk))
+            if rv != CKR_OK:
+                raise PyKCS11.PyKCS11Error(rv)
+        signature = PyKCS11.ckbytelist()
+        # first call gets the size of the signature, the second the signature
+        rv = lib.C_SignFinal(self.session.session, signature)
+        if rv != CKR_OK:
+            raise PyKCS11.PyKCS11Error(rv)
+        rv = lib.C_SignFinal(self.session.session, signature)
+        if rv != CKR_OK:
+            raise PyKCS11.PyKCS11Error(rv)
+        return signature
+
+    def _key_info(self, key, keyname):
+        attrs = self.get_object_attributes(key, attrs=[CKA_ID, CKA_KEY_TYPE])
+        key_id = attrs[CKA_ID]
+        logger.debug('Looking for certificate with CKA_ID {!r}'.format(key_id))
+        cert_der = None
+        cert = self.find_object([(CKA_ID, key_id), (CKA_CLASS, CKO_CERTIFICATE)])
+        if cert is not None:
+            cert_der = intarray2bytes(self.get_object_attributes(cert, attrs=[CKA_VALUE])[CKA_VALUE])
+            logger.debug('Certificate found:\n{!r}'.format(cert))
+        else:
+            logger.warning('Found no certificate for key with keyname {!r}'.format(keyname))
+        return KeyInfo(key_id, cert_der, attrs[CKA_KEY_TYPE])
 
     @staticmethod
-    def open(lib, slot, pin=None):
-        sessions = _sessions()
-        if slot not in sessions:
+    def open(lib, slot, pin=None, library_name=None):
+        """
+        Open and (if a pin is given) login a new session on slot. Sessions are registered per (library, slot)
+        and no more than settings['sessions_per_slot'] are kept open on any one slot.
+
+        :param lib: PyKCS11Lib
+        :param slot: slot number
+        :param pin: user pin
+        :param library_name: name of the library used as registry key
+        :return: SessionInfo
+        :raise NoCapacity: if as many sessions as allowed are open on the slot
+        """
+        key = (library_name, slot)
+        with _lock:
+            sessions = _sessions().setdefault(key, [])
+            if len(sessions) >= settings['sessions_per_slot']:
+                raise NoCapacity('Session limit reached for slot {!r}'.format(slot))
+            reservation = object()  # hold a place while the session is opened
+            sessions.append(reservation)
+
+        try:
+            serial = token_serial(lib, slot)
             session = lib.openSession(slot)
             if pin is not None:
                 try:
@@ -161,43 +629,90 @@ class SessionInfo(object):
                     logger.debug('Login failed: {!r}'.format(ex))
                     if 'CKR_USER_ALREADY_LOGGED_IN' not in str(ex):
                         raise
-            si = SessionInfo(session=session, slot=slot)
-            sessions[slot] = si
-        logger.debug('opened session for {!r}:{:d}'.format(lib, slot))
-        return sessions[slot]
+        except Exception:
+            with _lock:
+                sessions.remove(reservation)
+            raise
 
-    @staticmethod
-    def close_slot(slot):
-        sessions = _sessions()
-        if slot in sessions:
-            del sessions[slot]
+        si = SessionInfo(session=session, slot=slot, library_name=library_name, serial=serial)
+        with _lock:
+            sessions.remove(reservation)
+            sessions.append(si)
+        logger.debug('opened session for {!r}:{:d} ({:d} open)'.format(lib, slot, len(sessions)))
+        return si
 
     def close(self):
-        SessionInfo.close_slot(self.slot)
+        with _lock:
+            sessions = _sessions().get((self.library_name, self.slot), [])
+            if self in sessions:
+                sessions.remove(self)
+        try:
+            self.session.closeSession()
+        except Exception as ex:
+            logger.debug('Failed closing session for slot {!r}: {!s}'.format(self.slot, ex))
 
 
-def _find_slot(label, lib):
+def _scan_tokens(lib):
     """
-    :param label: Token label
-    :type label: str
     :param lib: PyKCS11Lib
     :type lib: PyKCS11.PyKCS11Lib
-    :return: Slots with given token label
-    :rtype: list
+    :return: dict with the slots that have a token, a map from token label to slots and slot to token serial
+    :rtype: dict
     """
+    labels = dict()
+    serials = dict()
     slots = []
 
     for slot in lib.getSlotList():
         try:
             token_info = lib.getTokenInfo(slot)
-            if label == token_info.label.strip():
-                slots.append(int(slot))
+            labels.setdefault(token_info.label.strip(), []).append(int(slot))
+            serials[int(slot)] = token_info.serialNumber.strip()
+            slots.append(int(slot))
         except PyKCS11.PyKCS11Error as ex:
             logger.warning(ex)
 
+    return dict(labels=labels, slots=slots, serials=serials)
+
+
+_token_cache = TTLCache(ttl=settings['label_cache_ttl'])
+
+
+def tokens(lib, refresh=False):
+    """
+    Slots and token labels for lib, cached for settings['label_cache_ttl'] seconds.
+
+    :param lib: PyKCS11Lib
+    :type lib: PyKCS11.PyKCS11Lib
+    :param refresh: bypass the cache
+    :return: dict with the slots that have a token and a map from token label to slots
+    :rtype: dict
+    """
+    if refresh:
+        _token_cache.invalidate(lib)
+    return _token_cache.get(lib, lambda: _scan_tokens(lib))
+
+
+def invalidate_tokens(lib=None):
+    _token_cache.invalidate(lib)
+
+
+def _find_slot(label, lib):
+    """
+    :param label: Token label
+    :type label: str
+    :param lib: PyKCS11Lib
+    :type lib: PyKCS11.PyKCS11Lib
+    :return: Slots with given token label
+    :rtype: list
+    """
+    slots = tokens(lib)['labels'].get(label)
+    if not slots:  # the token may have been added since the last scan
+        slots = tokens(lib, refresh=True)['labels'].get(label)
+
     if not slots:
-        raise PKCS11Exception('No slot for token label \"{}\" found'.format(label))
-    return slots
+        raise NotFound('No slot for token label \"{}\" found'.format(label))
+    return list(slots)
 
 
 def slots_for_label(label, lib):
@@ -208,51 +723,437 @@ def slots_for_label(label, lib):
         return _find_slot(label, lib)
 
 
-seed = SystemRandom()
+def cluster_slots(library_name, label):
+    """
+    The slots with a token label across the libraries of a cluster. A library that can't be loaded or
+    has no such token is left out so that the rest keep serving the label. It is tried again next time,
+    or after breaker_reset_timeout seconds if it couldn't be loaded.
+    A slot number matches that slot in every library that has it.
+
+    :param library_name: path to a PKCS#11 library or a list of them, see modules()
+    :param label: token label or slot number
+    :return: list of (library name, slot) pairs
+    :raise NotFound: if no library has a slot for label
+    """
+    if isinstance(library_name, six.string_types):
+        return [(library_name, slot) for slot in slots_for_label(label, load_library(library_name))]
+    res = []
+    for name, weight in modules(library_name):
+        try:
+            lib = load_library(name)
+            slots = slots_for_label(label, lib)
+            if isinstance(label, int) or label.isdigit():
+                slots = [slot for slot in slots if slot in tokens(lib)['slots']]
+        except LibraryUnavailable as ex:
+            logger.debug('Skipping {!r}: {!s}'.format(name, ex))
+            continue
+        except (PKCS11Exception, PyKCS11.PyKCS11Error) as ex:
+            logger.warning('No slot for {!r} in {!r}: {!s}'.format(label, name, ex))
+            continue
+        res.extend((name, slot) for slot in slots)
+    if not res:
+        raise NotFound('No slot for token label \"{}\" found'.format(label))
+    return res
+
+
+def label_tokens(library_name, label):
+    """
+    The tokens with a label across the libraries of a cluster.
+
+    :param library_name: path to a PKCS#11 library or a list of them, see modules()
+    :param label: token label or slot number
+    :return: OrderedDict from token serial number to the first (library name, slot) pair it is in
+    :raise NotFound: if no library has a slot for label
+    """
+    res = OrderedDict()
+    for name, slot in cluster_slots(library_name, label):
+        res.setdefault(token_serial(load_library(name), slot), (name, slot))
+    return res
+
+
+def _scan_slot(lib, slot):
+    """
+    :return: dict with the mechanisms, slot info and token info of a slot - each an error dict if it can't be fetched
+    """
+    r = dict()
+    try:
+        r['mechanisms'] = lib.getMechanismList(slot)
+    except (PyKCS11.PyKCS11Error, KeyError, ValueError, IOError) as ex:
+        r['mechanisms'] = {'error': str(ex)}
+    try:
+        r['slot'] = lib.getSlotInfo(slot).to_dict()
+    except (PyKCS11.PyKCS11Error, KeyError, ValueError, IOError) as ex:
+        r['slot'] = {'error': str(ex)}
+    try:
+        r['token'] = lib.getTokenInfo(slot).to_dict()
+    except (PyKCS11.PyKCS11Error, KeyError, ValueError, IOError) as ex:
+        r['token'] = {'error': str(ex)}
+    return r
+
+
+def _inventory_ttl(r):
+    """
+    :return: the ttl for the inventory of a slot - short if part of it couldn't be fetched, so it is scanned again soon
+    """
+    failed = any(isinstance(v, dict) and 'error' in v for v in r.values())
+    return settings['inventory_error_ttl'] if failed else settings['inventory_ttl']
+
+
+_inventory_cache = TTLCache(ttl=settings['inventory_ttl'], ttl_for=_inventory_ttl)
+
+
+def inventory(lib, slot, refresh=False):
+    """
+    Mechanisms, slot info and token info for a slot, cached for settings['inventory_ttl'] seconds (or
+    settings['inventory_error_ttl'] if fetching any of them failed) and refreshed in the background before
+    they expire.
+
+    :param lib: PyKCS11Lib
+    :param slot: slot number
+    :param refresh: bypass the cache
+    :rtype: dict
+    """
+    if refresh:
+        _inventory_cache.invalidate((lib, slot))
+    return _inventory_cache.get((lib, slot), lambda: _scan_slot(lib, slot))
+
+
+def invalidate_inventory():
+    _inventory_cache.invalidate()
+
+
+def supports_mechanism(lib, label, mech_name):
+    """
+    :param lib: PyKCS11Lib
+    :param label: token label or slot number
+    :param mech_name: CKM_* name of a mechanism
+    :return: False if none of the slots for label list mech_name among their mechanisms - slots that can't
+    list their mechanisms are assumed to support it
+    """
+    return _supports_mechanism([(lib, slot) for slot in slots_for_label(label, lib)], mech_name)
+
+
+def cluster_supports_mechanism(library_name, label, mech_name):
+    """
+    Like supports_mechanism for the slots with label across the libraries of a cluster.
+
+    :param library_name: path to a PKCS#11 library or a list of them, see modules()
+    """
+    return _supports_mechanism([(load_library(name), slot) for name, slot in cluster_slots(library_name, label)],
+                               mech_name)
+
+
+def _supports_mechanism(slots, mech_name):
+    for lib, slot in slots:
+        mechanisms = inventory(lib, slot)['mechanisms']
+        if not isinstance(mechanisms, list) or mech_name in mechanisms:
+            return True
+    return False
+
+
+session_open_failures = metrics.Counter('pyeleven_session_open_failures_total',
+                                        'Failures opening or logging in a session', ['slot'])
+slot_refills = metrics.Counter('pyeleven_slot_refills_total',
+                               'Slots added to the slots a session pool spreads its sessions over', ['label'])
+
+
+def _session_count(library_name, slot):
+    with _lock:
+        return len(_sessions().get((library_name, slot), []))
+
+
+# return values meaning the slot rather than the request is at fault
+SLOT_FAILURES = frozenset([CKR_DEVICE_ERROR, CKR_DEVICE_MEMORY, CKR_DEVICE_REMOVED, CKR_SESSION_CLOSED,
+                           CKR_SESSION_HANDLE_INVALID, CKR_TOKEN_NOT_PRESENT, CKR_TOKEN_NOT_RECOGNIZED])
+
+# errors that often only concern the operation - worth retrying but not held against the slot
+TRANSIENT_FAILURES = frozenset([CKR_GENERAL_ERROR, CKR_FUNCTION_FAILED])
+
+
+def slot_failure(ex):
+    """
+    :return: True if ex is an error from the token indicating that the slot is failing
+    """
+    return isinstance(ex, PyKCS11.PyKCS11Error) and ex.value in SLOT_FAILURES
+
+
+def transient_failure(ex):
+    """
+    :return: True if ex is an error from the token that an operation failed which may succeed if tried again
+    """
+    return isinstance(ex, PyKCS11.PyKCS11Error) and ex.value in TRANSIENT_FAILURES
+
+
+def _choose_slot(slots):
+    """
+    Pick a slot to open a session on. A slot whose breaker lets a probe through is picked first so that
+    quarantined slots are tried again, otherwise a slot with a closed breaker chosen by the slot strategy.
+
+    :param slots: (library name, slot) pairs
+    :raise SlotsUnavailable: if every slot is quarantined
+    """
+    closed = []
+    others = []
+    for ref in slots:
+        (closed if breaker(*ref).state == CLOSED else others).append(ref)
+    scheduler.shuffle(others)
+    for ref in others:
+        if breaker(*ref).allow():
+            logger.info('probing slot {!r}'.format(ref))
+            return ref
+    if closed:
+        return choose(closed)
+    retry_after = min(breaker(*ref).retry_after() for ref in others)
+    raise SlotsUnavailable('All slots are failing, retry in {:.0f}s'.format(retry_after), retry_after=retry_after)
+
+
+def _reclaim(slots):
+    """
+    Close an idle session on one of slots held by any pool, so that a session can be opened there for another.
+
+    :param slots: (library name, slot) pairs
+    :return: True if a session was closed
+    """
+    with _lock:  # not held while taking the lock of a pool
+        pools = list(_pools().values())
+    for pool in pools:
+        if pool.evict(lambda si: (si.library_name, si.slot) in slots):
+            return True
+    return False
+
+
+@contextmanager
+def _guarded(pool, token=None):
+    """
+    Like allocation but records the session as load on its slot for the slot strategy and the outcome in
+    its breaker - slot failures from the token count as failures, anything else means the token is responding.
+    The latency of the slot is recorded by whoever times the token operations (the signing in the app), not
+    here where it would include everything done while holding the session.
+    """
+    with allocation(pool, token) as si:
+        b = breaker(si.library_name, si.slot)
+        stats = slot_stats(si.library_name, si.slot)
+        stats.start()
+        try:
+            yield si
+        except Exception as ex:
+            if slot_failure(ex):
+                b.failure()
+            else:
+                b.success()
+            raise
+        finally:
+            stats.finish()
+        b.success()
+
 
+def pkcs11(library_name, label, pin=None, max_slots=None, token=None):
+    """
+    Allocate a session on a slot with the given token label (or slot number) from a pool shared by all
+    threads in the process. Use as a context manager - the session is lent exclusively to the caller
+    and returned to the pool on exit. Slots that keep failing are taken out of rotation by their
+    circuit breaker and probed again after breaker_reset_timeout seconds.
 
-def pkcs11(library_name, label, pin=None, max_slots=None):
-    pools = _pools()
-    sessions = _sessions()
+    With a list of libraries (a cluster of HSMs holding the same keys) the pool spreads the sessions over
+    the slots with the label in all of them, choosing slots in proportion to the library weights, and
+    keeps serving the label from the rest when a library or its slots fail.
 
+    :param library_name: PKCS#11 library to load, or a list of them - see modules()
+    :param label: token label or slot number
+    :param pin: user pin
+    :param max_slots: maximum number of slots to spread sessions over (all slots with the label by default -
+    the pool grows and shrinks as libraries gain or lose the label)
+    :param token: serial number of the token to allocate a session on, None for any token with the label
+    :return: a context manager yielding a SessionInfo
+    :raise NotFound: if no slot with the label has the token
+    """
+    limit = max_slots
     if max_slots is None:
-        max_slots = len(slots_for_label(label, load_library(library_name)))
+        max_slots = len(cluster_slots(library_name, label))
 
     def _del(*args, **kwargs):
         si = args[0]
         sd = kwargs['slots']
-        if si.slot in sd:
-            del sd[si.slot]
+        ref = (si.library_name, si.slot)
+        if ref in sd:
+            del sd[ref]
         si.close()
 
     def _bump(si):
-        si.use_count += 1
+        si.bump()
+
+    # the pool calls _healthy and _select holding its lock - they use the breaker and stats of the session
+    # rather than breaker() and slot_stats() which take _lock
+    def _healthy(si):
+        return si.breaker.state == CLOSED
+
+    def _select(idle):  # pick the slot using the slot strategy, then the least loaded session on it
+        by_slot = dict()
+        for si in idle:
+            by_slot.setdefault((si.library_name, si.slot), []).append(si)
+        ref = choose(list(by_slot.keys()), lambda r: by_slot[r][0].stats)
+        return min(by_slot[ref], key=lambda si: si.priority)
 
     def _get(*args, **kwargs):
-        lib = load_library(library_name)
         sd = kwargs['slots']
+        kind = kwargs.get('kind')
 
-        def _refill():  # if sd is getting a bit light - fill it back up
-            if len(sd) < max_slots:
-                for slot in slots_for_label(label, lib):
-                    logger.debug('found slot {!r} for label {!r} during refill'.format(slot, label))
-                    sd[slot] = True
+        def _refill():  # add the slots that have the label now, including those of libraries that just gained it
+            if limit is not None and len(sd) >= limit:
+                return
+            for ref in cluster_slots(library_name, label):
+                if ref not in sd and (limit is None or len(sd) < limit):
+                    logger.debug('found slot {!r} for label {!r} during refill'.format(ref, label))
+                    slot_refills.inc(label=label)
+                    sd[ref] = True
 
-        retry = 10
-        while retry > 0:
+        tried = set()
+        error = None
+        while True:
             _refill()
-            k = list(sd.keys())
-            random_slot = seed.choice(k)
+            refs = list(sd.keys())
+            if kind is not None:  # only the slots holding the token asked for
+                refs = [(name, slot) for name, slot in refs if token_serial(load_library(name), slot) == kind]
+                if not refs:
+                    raise NotFound('No token {!r} with label {!r}'.format(kind, label))
+            k = [ref for ref in refs if ref not in tried and _session_count(*ref) < settings['sessions_per_slot']]
+            if not k:
+                if error is not None:
+                    raise error
+                full = [ref for ref in refs if ref not in tried]
+                if _reclaim(full):  # the sessions on a slot are shared by all pools with sessions on it
+                    continue
+                raise NoCapacity('No slot with free sessions for label {!r}'.format(label))
+            ref = _choose_slot(k)
+            tried.add(ref)
+            name, slot = ref
+            lib = load_library(name)
             try:
-                return SessionInfo.open(lib, random_slot, pin)
+                si = SessionInfo.open(lib, slot, pin, library_name=name)
+            except NoCapacity:  # another pool took the last session on the slot - not a failure of the slot
+                continue
             except Exception as ex:  # on first suspicion of failure - force the slot to be recreated
-                if random_slot in sd:
-                    del sd[random_slot]
-                SessionInfo.close_slot(random_slot)
-                time.sleep(0.2)  # TODO - make retry delay configurable
-                logger.error('Failed opening session (retry: {!r}): {!s}'.format(retry, ex))
-                retry -= 1
-                if not retry:
-                    raise
-
-    return allocation(pools.setdefault(label, ObjectPool(_get, _del, _bump, maxSize=max_slots, slots=dict())))
+                session_open_failures.inc(slot=slot_name(name, slot))
+                breaker(name, slot).failure()
+                if ref in sd:
+                    del sd[ref]
+                invalidate_tokens(lib)
+                logger.error('Failed opening session on slot {!r}: {!s}'.format(ref, ex))
+                error = ex
+                continue
+            si.breaker = breaker(name, slot)
+            si.stats = slot_stats(name, slot)
+            return si
+
+    key = pool_key(library_name, label)
+    with _lock:
+        pool = _pools().get(key)
+        created = pool is None
+        if created:
+            if not isinstance(library_name, six.string_types):  # a single library keeps the weight of its cluster
+                _weight_registry.update(modules(library_name))
+            pool = ObjectPool(_get, _del, _bump,
+                              maxSize=max_slots * settings['sessions_per_slot'],
+                              timeout=settings['pool_timeout'],
+                              max_waiting=settings['max_waiting'],
+                              accept=_healthy,
+                              select=_select,
+                              kind_of=lambda si: si.serial,
+                              slots=dict())
+            _pools()[key] = pool
+    if not created and limit is None:  # not holding _lock - the pool takes its own lock
+        pool.resize(max_slots * settings['sessions_per_slot'])
+
+    return _guarded(pool, token)
+
+
+def warm_up(library_name, label, keynames=(), pin=None, sessions=None):
+    """
+    Open and log in sessions for a label and look up keys and certificates on each of them so that
+    requests don't have to. The sessions are returned to the pool.
+
+    :param library_name: PKCS#11 library to load, or a list of them - see modules()
+    :param label: token label or slot number
+    :param keynames: keys to look up on each session
+    :param pin: user pin
+    :param sessions: number of sessions to open (as many as the pool may hold by default)
+    :return: the number of sessions opened or reused
+    :raise NotFound: if a key isn't found
+    """
+    limit = len(cluster_slots(library_name, label)) * settings['sessions_per_slot']
+    if sessions is None or sessions > limit:
+        sessions = limit
+
+    with ExitStack() as held:  # keep the sessions allocated so the pool has to open new ones
+        for n in range(0, sessions):
+            si = held.enter_context(pkcs11(library_name, label, pin))
+            for keyname in keynames:
+                key, cert = si.find_key(keyname)
+                if key is None:
+                    raise NotFound("Key {!s} not found on slot {!r}".format(keyname, si.slot))
+    return sessions
+
+
+def pool_stats():
+    """
+    :return: statistics for each session pool keyed by (library name, label)
+    :rtype: dict
+    """
+    with _lock:
+        pools = list(_pools().items())
+    return dict((key, pool.stats()) for key, pool in pools)
+
+
+def _by_key(items):
+    """
+    :return: (key, value) items in a stable order - keys mix labels and slot numbers, and paths and clusters
+    """
+    return sorted(items, key=lambda item: repr(item[0]))
+
+
+def _collect_metrics():
+    pools = _by_key(pool_stats().items())
+    gauges = [('in_use', 'Sessions allocated from the pool'),
+              ('idle', 'Idle sessions in the pool'),
+              ('waiting', 'Requests waiting for a session'),
+              ('max_size', 'Maximum number of sessions in the pool')]
+    counters = [('allocs', 'Session allocations from the pool'),
+                ('created', 'Sessions created by the pool'),
+                ('destroyed', 'Sessions dropped by the pool after an error'),
+                ('timeouts', 'Requests that timed out waiting for a session'),
+                ('rejected', 'Requests turned away because too many were waiting for a session')]
+    res = []
+    for stat, description in gauges:
+        res.append(('pyeleven_pool_%s' % stat, 'gauge', description,
+                    [([('label', label)], s[stat]) for (lib, label), s in pools]))
+    for stat, description in counters:
+        res.append(('pyeleven_pool_%s_total' % stat, 'counter', description,
+                    [([('label', label)], s[stat]) for (lib, label), s in pools]))
+    wait = []
+    for (lib, label), s in pools:
+        wait.append(('_sum', [('label', label)], s['wait_time']))
+        wait.append(('_count', [('label', label)], s['allocs']))
+    res.append(('pyeleven_pool_wait_seconds', 'summary', 'Time spent waiting for a session', wait))
+    with _lock:
+        breakers = _by_key(_breakers().items())
+    states = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    res.append(('pyeleven_slot_breaker_state', 'gauge', 'Slot circuit breaker state (0 closed, 1 half-open, 2 open)',
+                [([('slot', slot_name(lib, slot))], states[b.state]) for (lib, slot), b in breakers]))
+    res.append(('pyeleven_slot_breaker_trips_total', 'counter', 'Times a slot was taken out of rotation',
+                [([('slot', slot_name(lib, slot))], b.trips) for (lib, slot), b in breakers]))
+    with _lock:
+        stats = _by_key(_slot_stats().items())
+    res.append(('pyeleven_slot_outstanding', 'gauge', 'Sessions in use on the slot',
+                [([('slot', slot_name(lib, slot))], st.outstanding) for (lib, slot), st in stats]))
+    res.append(('pyeleven_slot_latency_seconds', 'gauge', 'Moving average of the time signing on the slot takes',
+                [([('slot', slot_name(lib, slot))], st.latency) for (lib, slot), st in stats]))
+    caches = [('labels', _token_cache), ('keys', _key_cache), ('inventory', _inventory_cache),
+              ('signatures', _signature_cache), ('certs', _cert_cache), ('public_keys', _public_key_cache)]
+    res.append(('pyeleven_cache_hits_total', 'counter', 'Cache lookups answered from the cache',
+                [([('cache', name)], c.hits) for name, c in caches]))
+    res.append(('pyeleven_cache_misses_total', 'counter', 'Cache lookups that had to be loaded',
+                [([('cache', name)], c.misses) for name, c in caches]))
+    return res
+
+
+metrics.register_collector(_collect_metrics)
@@ -1,17 +1,53 @@
 # -*- coding:utf-8 -*-
 
+import logging
+import time
+from collections import deque
 from contextlib import contextmanager
+from threading import Condition
 
-import six
+logger = logging.getLogger(__name__)
 
-if six.PY2:
-    import Queue as Q
-else:
-    import queue as Q
+# seconds to suggest waiting before trying again when neither the drain rate nor a timeout tells how long
+DEFAULT_RETRY_AFTER = 1
+
+# seconds to wait before trying to create an object again after create raised NoCapacity
+RETRY_CREATE = 0.05
+
+
+class PoolTimeout(Exception):
+    """Raised when no object becomes available in the pool before the allocation timeout"""
+
+    def __init__(self, message, retry_after=None):
+        super(PoolTimeout, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class PoolFull(PoolTimeout):
+    """Raised without waiting when as many callers as the pool admits are already waiting for an object"""
+    pass
+
+
+class NoCapacity(Exception):
+    """Raised by create when something the pool shares with others has run out - alloc waits and tries again"""
+    pass
 
 
 class ObjectPool(object):
-    """A simple thread safe object pool"""
+    """
+    A thread safe object pool holding at most maxSize objects. Objects are created one at a time when
+    no idle object is available and the pool isn't full, otherwise alloc waits for an object to be freed
+    - for at most timeout seconds if a timeout is set. The idle object with the lowest priority (the
+    least recently loaded) is allocated first unless a select function choosing among the idle objects
+    is given. Idle objects for which the optional accept function returns False are destroyed instead
+    of being allocated. If max_waiting is set, alloc fails straight away with PoolFull when that many
+    callers are already waiting. If create raises NoCapacity, alloc waits as if the pool were full and
+    tries again every RETRY_CREATE seconds until the timeout.
+
+    With a kind_of function returning the kind of an object, alloc can ask for an object of a given kind:
+    only idle objects of that kind are allocated, an idle object of another kind is destroyed to make room
+    when the pool is full, and create is called with the kind as keyword argument kind (None for any kind).
+    """
 
     def __init__(self, create, destroy, bump, *args, **kwargs):
         super(ObjectPool, self).__init__()
@@ -21,27 +57,209 @@ class ObjectPool(object):
         self.args = args
         self.kwargs = kwargs
         self.maxSize = int(kwargs.get("maxSize", 1))
-        self.queue = Q.PriorityQueue()
+        self.timeout = kwargs.get("timeout", None)
+        self.accept = kwargs.get("accept", None)
+        self.select = kwargs.get("select", None) or _least_loaded
+        self.max_waiting = kwargs.get("max_waiting", None)
+        self.kind_of = kwargs.get("kind_of", None)
+        self.cond = Condition()
+        self.idle = []
+        self.in_use = 0  # allocated objects, including those being created
+        self.waiting = 0
+        self.allocs = 0
+        self.created = 0
+        self.destroyed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self._released = deque(maxlen=64)  # when objects were recently returned, for the drain rate
+
+    @property
+    def size(self):
+        return len(self.idle) + self.in_use
+
+    def alloc(self, timeout=None, kind=None):
+        """
+        :param timeout: seconds to wait for an object, the timeout of the pool by default
+        :param kind: the kind of object to allocate (see kind_of), None for any
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        admitted = False
+        create_at = None  # when to try creating an object again after create had no capacity
+        while True:
+            rejected = []
+            try:
+                with self.cond:
+                    self.waiting += 1
+                    try:
+                        while True:
+                            if self.accept is not None:
+                                for obj in [o for o in self.idle if not self.accept(o)]:
+                                    self.idle.remove(obj)
+                                    self.destroyed += 1
+                                    rejected.append(obj)
+                            idle = self.idle if kind is None else [o for o in self.idle if self.kind_of(o) == kind]
+                            if idle:
+                                obj = self.select(idle)
+                                self.idle.remove(obj)
+                                self.in_use += 1
+                                self._allocated(time.time() - start)
+                                return obj
+                            may_create = create_at is None or time.time() >= create_at
+                            if may_create and self.idle and self.size >= self.maxSize:  # only other kinds idle
+                                obj = self.idle.pop(0)
+                                self.destroyed += 1
+                                rejected.append(obj)
+                            if may_create and self.size < self.maxSize:  # create a new object outside of the lock
+                                self.in_use += 1
+                                waited = time.time() - start
+                                break
+                            if not admitted:  # only turn callers away before they start waiting
+                                if self.max_waiting is not None and self.waiting > self.max_waiting:
+                                    self.rejected += 1
+                                    raise PoolFull("{:d} callers already waiting for the pool".format(
+                                        self.waiting - 1), retry_after=self._retry_after())
+                                admitted = True
+                            remaining = None
+                            if timeout is not None:
+                                remaining = start + timeout - time.time()
+                                if remaining <= 0:
+                                    self.timeouts += 1
+                                    raise PoolTimeout("No object available in pool after {:.3f}s".format(timeout),
+                                                      retry_after=self._retry_after())
+                            if create_at is not None:  # nothing signals when there is capacity again
+                                poll = max(create_at - time.time(), 0)
+                                remaining = poll if remaining is None else min(remaining, poll)
+                            self.cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+            finally:
+                for obj in rejected:
+                    self._destroy(obj)
+
+            try:
+                obj = self.create(*self.args, **dict(self.kwargs, kind=kind))
+            except NoCapacity as ex:
+                logger.debug('No capacity to create an object: {!s}'.format(ex))
+                with self.cond:
+                    self.in_use -= 1
+                    self.cond.notify()
+                create_at = time.time() + RETRY_CREATE
+                continue
+            except Exception:
+                with self.cond:
+                    self.in_use -= 1
+                    self.cond.notify()
+                raise
+            with self.cond:
+                self.created += 1
+                self._allocated(waited)
+            return obj
 
-    def alloc(self):
-        if self.queue.qsize() < self.maxSize and self.queue.empty():
-            n = self.maxSize - self.queue.qsize()
-            for i in range(0, n):  # try to allocate enough objects to fill to maxSize
-                obj = self.create(*self.args, **self.kwargs)
-                #print("allocated %s" % obj)
-                self.queue.put(obj)
-        return self.queue.get()
+    def resize(self, max_size):
+        """
+        Change the number of objects the pool holds at most. A smaller pool lets the objects in it above
+        the new size be used until they are destroyed.
+
+        :param max_size: the new maxSize
+        """
+        with self.cond:
+            if max_size != self.maxSize:
+                logger.debug('resizing pool from {:d} to {:d}'.format(self.maxSize, max_size))
+                self.maxSize = int(max_size)
+                self.cond.notify_all()
+
+    def _allocated(self, waited):
+        self.allocs += 1
+        self.wait_time += waited
 
     def free(self, obj):
-        self.queue.put(obj)
+        with self.cond:
+            self.in_use -= 1
+            self.idle.append(obj)
+            self._released.append(time.time())
+            self.cond.notify()
+
+    def evict(self, match):
+        """
+        Destroy an idle object for which match returns True, to release what it holds for others to use.
+
+        :return: True if an object was destroyed
+        """
+        with self.cond:
+            found = [o for o in self.idle if match(o)]
+            if not found:
+                return False
+            obj = found[0]
+            self.idle.remove(obj)
+            self.destroyed += 1
+            self.cond.notify()
+        self._destroy(obj)
+        return True
 
     def invalidate(self, obj):
-        self.destroy(obj, *self.args, **self.kwargs)
+        with self.cond:
+            self.in_use -= 1
+            self.destroyed += 1
+            self._released.append(time.time())
+            self.cond.notify()
+        self._destroy(obj)
+
+    def drain_rate(self):
+        """
+        :return: objects returned to the pool per second recently, None if too few were returned to tell
+        """
+        with self.cond:
+            return self._drain_rate()
+
+    def _drain_rate(self):
+        if len(self._released) < 2:
+            return None
+        elapsed = max(self._released[-1], time.time()) - self._released[0]
+        if elapsed <= 0:
+            return None
+        return (len(self._released) - 1) / elapsed
+
+    def _retry_after(self):
+        """
+        :return: seconds until the callers waiting now are expected to have been served at the recent
+        drain rate, or the allocation timeout (DEFAULT_RETRY_AFTER without one) if the rate isn't known
+        """
+        rate = self._drain_rate()
+        if rate is None:
+            return self.timeout if self.timeout else DEFAULT_RETRY_AFTER
+        return (self.waiting + 1) / rate
+
+    def _destroy(self, obj):
+        try:
+            self.destroy(obj, *self.args, **self.kwargs)
+        except Exception as ex:
+            logger.warning('Failed destroying {!r}: {!s}'.format(obj, ex))
+
+    def stats(self):
+        with self.cond:
+            return dict(max_size=self.maxSize,
+                        size=self.size,
+                        in_use=self.in_use,
+                        idle=len(self.idle),
+                        waiting=self.waiting,
+                        allocs=self.allocs,
+                        created=self.created,
+                        destroyed=self.destroyed,
+                        timeouts=self.timeouts,
+                        rejected=self.rejected,
+                        wait_time=self.wait_time)
+
+
+def _least_loaded(idle):
+    return min(idle, key=lambda o: getattr(o, 'priority', 0))
 
 
 @contextmanager
-def allocation(pool):
-    obj = pool.alloc()
+def allocation(pool, kind=None):
+    obj = pool.alloc(kind=kind)
     try:
         yield obj
     except Exception as e:
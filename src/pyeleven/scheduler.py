@@ -0,0 +1,116 @@
+"""
+Slot selection strategies using per-slot load and latency statistics
+"""
+import math
+import random
+import threading
+import time
+
+__author__ = 'leifj'
+
+# slot choice doesn't need to be unpredictable - avoid an OS entropy read for each choice
+_random = random.Random()
+
+
+class SlotStats(object):
+    """
+    Thread safe load and latency statistics for a slot: the number of outstanding operations and an
+    exponentially weighted moving average of their latency. The average fades towards 0 with a time
+    constant of decay seconds when the slot isn't used, so a slot that was slow is eventually tried again.
+    A slot with a higher weight is expected to handle proportionally more operations.
+    """
+
+    def __init__(self, alpha=0.3, decay=10, weight=1):
+        self.alpha = alpha
+        self.decay = decay
+        self.weight = weight
+        self.outstanding = 0
+        self.count = 0
+        self._ewma = 0.0
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def latency(self):
+        with self._lock:
+            return self._ewma * math.exp((self._updated - time.time()) / self.decay)
+
+    def start(self):
+        with self._lock:
+            self.outstanding += 1
+
+    def finish(self):
+        with self._lock:
+            self.outstanding -= 1
+
+    def observe(self, elapsed):
+        """
+        Add the latency of an operation on the slot to the moving average.
+        """
+        with self._lock:
+            self.count += 1
+            now = time.time()
+            if self.count == 1:
+                self._ewma = elapsed
+            else:
+                current = self._ewma * math.exp((self._updated - now) / self.decay)
+                self._ewma = self.alpha * elapsed + (1 - self.alpha) * current
+            self._updated = now
+
+    def cost(self):
+        """
+        :return: the expected wait for another operation on the slot - the latency times the outstanding operations
+        divided by the weight
+        """
+        return self.latency * (self.outstanding + 1) / self.weight
+
+
+def _weighted(slots, stats):
+    weights = [stats(slot).weight for slot in slots]
+    r = _random.uniform(0, sum(weights))
+    for slot, weight in zip(slots, weights):
+        r -= weight
+        if r <= 0:
+            return slot
+    return slots[-1]
+
+
+def _cheapest(slots, stats, key):
+    costs = [(key(slot), slot) for slot in slots]
+    best = min(cost for cost, slot in costs)
+    return _weighted([slot for cost, slot in costs if cost == best], stats)
+
+
+def random_slot(slots, stats):
+    return _weighted(slots, stats)
+
+
+def least_outstanding(slots, stats):
+    return _cheapest(slots, stats, lambda slot: float(stats(slot).outstanding) / stats(slot).weight)
+
+
+def least_latency(slots, stats):
+    return _cheapest(slots, stats, lambda slot: stats(slot).cost())
+
+
+def power_of_two(slots, stats):
+    if len(slots) < 2:
+        return slots[0]
+    a = _weighted(slots, stats)
+    b = _weighted([slot for slot in slots if slot != a], stats)
+    return a if stats(a).cost() <= stats(b).cost() else b
+
+
+# strategy name -> function(slots, stats) choosing one of the (non-empty) list of slots where stats(slot) is
+# its SlotStats
+# - ties, and the slots p2c compares, are drawn in proportion to the slot weights
+STRATEGIES = {
+    'random': random_slot,
+    'least_outstanding': least_outstanding,
+    'ewma': least_latency,
+    'p2c': power_of_two,
+}
+
+
+def shuffle(items):
+    _random.shuffle(items)
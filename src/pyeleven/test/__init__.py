@@ -35,20 +35,32 @@ OPENSC_TOOL = _find_alts(['/usr/bin/opensc-tool'])
 SOFTHSM = _find_alts(['/usr/bin/softhsm', '/usr/bin/softhsm2-util'])
 OPENSSL = _find_alts(['/usr/bin/openssl'])
 
-if OPENSSL is None:
-    raise unittest.SkipTest("OpenSSL not installed")
 
-if SOFTHSM is None:
-    raise unittest.SkipTest("SoftHSM not installed")
-
-if OPENSC_TOOL is None:
-    raise unittest.SkipTest("OpenSC not installed")
+def _missing():
+    """
+    :return: why the SoftHSM tests can't run or None if they can
+    """
+    if OPENSSL is None:
+        return "OpenSSL not installed"
+    if SOFTHSM is None:
+        return "SoftHSM not installed"
+    if OPENSC_TOOL is None:
+        return "OpenSC not installed"
+    if PKCS11_TOOL is None:
+        return "pkcs11-tool not installed"
+    if P11_ENGINE is None:
+        return "libengine-pkcs11-openssl is not installed"
+    return None
 
-if PKCS11_TOOL is None:
-    raise unittest.SkipTest("pkcs11-tool not installed")
 
-if P11_ENGINE is None:
-    raise unittest.SkipTest("libengine-pkcs11-openssl is not installed")
+def require_softhsm():
+    """
+    Skip the calling test module (or test) unless the tools TemporarySoftHSM needs are installed. Tests that
+    don't use a token - eg using the mock library - run regardless.
+    """
+    reason = _missing()
+    if reason is not None:
+        raise unittest.SkipTest(reason)
 
 
 class TemporarySoftHSM(object):
@@ -57,12 +69,13 @@ class TemporarySoftHSM(object):
 
     @classmethod
     def get_instance(cls):
+        require_softhsm()
         if cls._instance is None:
             cls._instance = cls()
             atexit.register(cls._instance.clean_up)
         return cls._instance
 
-    def __init__(self):
+    def __init__(self, token_labels=('test', 'test')):
         self.p11_test_files = []
 
         self.softhsm_conf = self._tf()
@@ -70,9 +83,9 @@ class TemporarySoftHSM(object):
         self.signer_cert_pem = self._tf()
         self.openssl_conf = self._tf()
 
-        # Initialize twice for two slots
-        self.setup_hsm(token_label='test')
-        self.setup_hsm(token_label='test')
+        # One token per label - by default twice for two slots labelled test
+        for token_label in token_labels:
+            self.setup_hsm(token_label=token_label)
 
     def setup_hsm(self, token_label):
         if not P11_MODULE:
@@ -186,6 +199,17 @@ class TemporarySoftHSM(object):
                      '--write-object', signer_cert_der,
                      '--pin', 'secret1'])
 
+            logger.debug("Generating EC key pair in token")
+            self._p([PKCS11_TOOL,
+                     '--module', P11_MODULE,
+                     '--login',
+                     '--id', 'ec01',
+                     '--token-label', token_label,
+                     '--label', 'ec',
+                     '--keypairgen',
+                     '--key-type', 'EC:prime256v1',
+                     '--pin', 'secret1'])
+
         except Exception as ex:
             traceback.print_exc()
             logger.warning("PKCS11 tests disabled: unable to initialize test token: %s" % ex)
@@ -0,0 +1,234 @@
+"""
+Signing benchmark against SoftHSM. Measures signatures per second and latency percentiles over a
+matrix of modes, thread counts, slots per label, payload sizes and mechanisms:
+
+    # PYTHONPATH=src python -m pyeleven.test.benchmark --output before.json
+    # PYTHONPATH=src python -m pyeleven.test.benchmark --output after.json --compare before.json
+
+The 'p11' mode measures pk11.pkcs11() + find_key + sign, the 'flask' mode the same signature made
+end to end through the Flask app test client. Each configuration uses its own token label with the
+requested number of slots. Run it from a directory with a config.py (eg the top of the source tree).
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from pyeleven import pk11
+from pyeleven.test import P11_MODULE, TemporarySoftHSM
+from pyeleven.test.utils import ThreadPool
+from pyeleven.utils import mechanism, intarray2bytes, PKCS11Exception
+
+__author__ = 'leifj'
+
+logger = logging.getLogger(__name__)
+
+PIN = 'secret1'
+KEYNAME = 'test'
+
+# RSAPKCS1 signs the data as is so it has to fit in the (1024 bit) test key
+MAX_RAW_PAYLOAD = 100
+
+
+def _label(slots):
+    return 'bench%d' % slots
+
+
+def _csv(convert=str):
+    return lambda value: [convert(v) for v in value.split(',') if v]
+
+
+def percentile(values, p):
+    """
+    :param values: sorted list of values
+    :param p: percentile (0-100)
+    :return: the nearest-rank percentile of values or None if values is empty
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank - 1, 0), len(values) - 1)]
+
+
+def _p11_sign(label, data, mech):
+    with pk11.pkcs11(P11_MODULE, label, PIN) as si:
+        key, _ = si.find_key(KEYNAME, find_cert=False)
+        if key is None:
+            raise PKCS11Exception("Key %s not found" % KEYNAME)
+        return intarray2bytes(si.session.sign(key, data, mechanism(mech)))
+
+
+_local = threading.local()
+
+
+def _flask_sign(label, data, mech):
+    from pyeleven import app
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client = _local.client = app.test_client()
+    rv = client.post("/%s/%s/rawsign?mech=%s" % (label, KEYNAME, mech),
+                     content_type='application/octet-stream',
+                     data=data)
+    if rv.status_code != 200:
+        raise PKCS11Exception("HTTP %d: %s" % (rv.status_code, rv.data))
+    return rv.data
+
+
+MODES = dict(p11=_p11_sign, flask=_flask_sign)
+
+
+def run(mode, threads, slots, size, mech, count):
+    """
+    Make count signatures (after one warm-up signature per thread) using threads threads.
+
+    :return: a dict with the configuration and the measured rate and latencies (in seconds)
+    """
+    sign = MODES[mode]
+    label = _label(slots)
+    data = os.urandom(size)
+    latencies = []
+    errors = []
+
+    def _task():
+        start = time.time()
+        try:
+            sign(label, data, mech)
+        except Exception as ex:
+            errors.append(str(ex))
+            return
+        latencies.append(time.time() - start)
+
+    tp = ThreadPool(threads)
+    for i in range(0, threads):
+        tp.add_task(_task)
+    tp.wait_completion()
+    del latencies[:]
+    del errors[:]
+
+    ts = time.time()
+    for i in range(0, count):
+        tp.add_task(_task)
+    tp.wait_completion()
+    elapsed = time.time() - ts
+
+    latencies.sort()
+    if errors:
+        logger.warning('{:d} errors in {!s} run, first: {!s}'.format(len(errors), mode, errors[0]))
+    return dict(mode=mode,
+                threads=threads,
+                slots=slots,
+                size=size,
+                mech=mech,
+                count=count,
+                errors=len(errors),
+                seconds=elapsed,
+                rate=len(latencies) / elapsed if elapsed > 0 else None,
+                mean=sum(latencies) / len(latencies) if latencies else None,
+                p50=percentile(latencies, 50),
+                p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99))
+
+
+def matrix(args):
+    for mode in args.modes:
+        for mech in args.mechs:
+            for size in args.sizes:
+                if mech == 'RSAPKCS1' and size > MAX_RAW_PAYLOAD:
+                    continue
+                for slots in args.slots:
+                    for threads in args.threads:
+                        yield mode, threads, slots, size, mech
+
+
+def _key(result):
+    return tuple(result[k] for k in ('mode', 'threads', 'slots', 'size', 'mech'))
+
+
+def compare(results, baseline):
+    """
+    :return: lines comparing the rate and p99 latency of results with those of the same configuration in baseline
+    """
+    before = dict((_key(r), r) for r in baseline['results'])
+    lines = ["%-6s %7s %5s %7s %-14s %10s %10s %8s %8s" % ('mode', 'threads', 'slots', 'size', 'mech',
+                                                          'rate', 'baseline', 'rate %', 'p99 %')]
+    for r in results:
+        b = before.get(_key(r))
+        if b is None or not b['rate'] or not r['rate']:
+            continue
+        p99 = 100.0 * (r['p99'] - b['p99']) / b['p99'] if b['p99'] and r['p99'] else 0.0
+        lines.append("%-6s %7d %5d %7d %-14s %10.1f %10.1f %+7.1f%% %+7.1f%%" % (
+            r['mode'], r['threads'], r['slots'], r['size'], r['mech'], r['rate'], b['rate'],
+            100.0 * (r['rate'] - b['rate']) / b['rate'], p99))
+    return lines
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pyeleven signing benchmark")
+    parser.add_argument('--modes', type=_csv(), default=['p11', 'flask'])
+    parser.add_argument('--threads', type=_csv(int), default=[1, 4, 16])
+    parser.add_argument('--slots', type=_csv(int), default=[1, 2])
+    parser.add_argument('--sizes', type=_csv(int), default=[32, 1024, 65536])
+    parser.add_argument('--mechs', type=_csv(), default=['RSAPKCS1', 'SHA256RSAPKCS'])
+    parser.add_argument('--count', type=int, default=500, help="signatures per configuration")
+    parser.add_argument('--output', help="write the results as JSON to this file instead of stdout")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    token_labels = []
+    for slots in args.slots:
+        token_labels.extend([_label(slots)] * slots)
+    softhsm = TemporarySoftHSM(token_labels=token_labels)
+    os.environ['SOFTHSM2_CONF'] = softhsm.softhsm_conf
+
+    from pyeleven import app
+    app.config['PKCS11MODULE'] = P11_MODULE
+    app.config['PKCS11PIN'] = PIN
+
+    results = []
+    try:
+        for mode, threads, slots, size, mech in matrix(args):
+            result = run(mode, threads, slots, size, mech, args.count)
+            sys.stderr.write("%(mode)s threads=%(threads)d slots=%(slots)d size=%(size)d mech=%(mech)s: "
+                             "%(rate).1f/s p50=%(p50).4fs p99=%(p99).4fs errors=%(errors)d\n" % result
+                             if result['rate'] else "%r\n" % result)
+            results.append(result)
+    finally:
+        pk11.finalize()
+        softhsm.clean_up()
+
+    report = dict(meta=dict(revision=_revision(),
+                            time=time.time(),
+                            python=platform.python_version(),
+                            platform=platform.platform(),
+                            sessions_per_slot=pk11.settings['sessions_per_slot'],
+                            count=args.count),
+                  results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        sys.stderr.write("\n".join(compare(results, baseline)) + "\n")
+
+
+if __name__ == '__main__':
+    main()
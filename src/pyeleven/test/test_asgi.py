@@ -0,0 +1,94 @@
+"""
+Testing the ASGI front end against the mock PKCS#11 library by calling the ASGI app directly
+"""
+import asyncio
+from base64 import b64encode
+from unittest import TestCase
+
+from flask import json
+
+from pyeleven import mock
+from pyeleven.pk11 import reset, pool_key
+
+__author__ = 'leifj'
+
+
+def _call(app, method, path, body=b'', headers=(), chunk_size=None):
+    """
+    :return: the status, headers and body of the response of the ASGI app to a request
+    """
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] if chunk_size else [body]
+    messages = []
+
+    async def receive():
+        if chunks:
+            chunk = chunks.pop(0)
+            return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        messages.append(message)
+
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode('latin-1'),
+             'http_version': '1.1',
+             'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]}
+    loop = asyncio.new_event_loop()  # not asyncio.run, which needs python 3.7
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+    start = messages[0]
+    return start['status'], dict(start['headers']), b''.join(m.get('body', b'') for m in messages[1:])
+
+
+class ASGITestCase(TestCase):
+
+    def setUp(self):
+        from .. import app
+        from .. import asgi
+        reset()
+        self.asgi = asgi
+        self.config = dict(app.config)
+        self.name = 'mock:asgi-{!s}'.format(self._testMethodName)
+        mock.register(self.name)
+        app.config['TESTING'] = False  # errors are responses, as for an ASGI server
+        app.config['PKCS11MODULE'] = self.name
+        app.config['PKCS11PIN'] = 'secret1'
+
+    def tearDown(self):
+        from .. import app
+        self.asgi.shutdown()
+        reset()
+        app.config.clear()
+        app.config.update(self.config)
+
+    def test_sign(self):
+        body = json.dumps(dict(mech='RSAPKCS1', data=b64encode(b'test').decode('utf-8'))).encode('utf-8')
+        status, headers, data = _call(self.asgi.app, 'POST', '/test/test/sign', body,
+                                      headers=[('Content-Type', 'application/json')])
+        self.assertEqual(status, 200)
+        self.assertIn('signed', json.loads(data))
+        self.assertIn(pool_key(self.name, 'test'), self.asgi._executors)
+
+    def test_stream(self):
+        self.asgi.MAX_BUFFER = 1024
+        try:
+            status, headers, data = _call(self.asgi.app, 'POST', '/test/test/rawsign?mech=SHA256RSAPKCS',
+                                          b'x' * 10000, headers=[('Content-Type', 'application/octet-stream')],
+                                          chunk_size=1000)
+        finally:
+            self.asgi.MAX_BUFFER = 1024 * 1024
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data), 256)
+
+    def test_executors(self):
+        self.assertIs(self.asgi.executor('metrics'), self.asgi._default_executor)
+        self.assertIs(self.asgi.executor('test'), self.asgi.executor('test'))
+        self.assertIsNot(self.asgi.executor('test'), self.asgi.executor('0'))
+        self.assertIs(self.asgi.executor('missing'), self.asgi._lookup_executor)
+        status, headers, data = _call(self.asgi.app, 'GET', '/missing')
+        self.assertEqual(status, 500)
+        self.assertNotIn(pool_key(self.name, 'missing'), self.asgi._executors)
+        status, headers, data = _call(self.asgi.app, 'GET', '/metrics')
+        self.assertEqual(status, 200)
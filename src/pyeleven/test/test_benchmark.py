@@ -0,0 +1,26 @@
+"""
+Testing the benchmark helpers
+"""
+from unittest import TestCase
+
+from pyeleven.test.benchmark import percentile, compare
+
+__author__ = 'leifj'
+
+
+class TestBenchmark(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 11))
+        self.assertEqual(percentile(values, 50), 5)
+        self.assertEqual(percentile(values, 95), 10)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertIsNone(percentile([], 99))
+
+    def test_compare(self):
+        r = dict(mode='p11', threads=4, slots=2, size=32, mech='RSAPKCS1', rate=110.0, p99=0.01)
+        b = dict(r, rate=100.0, p99=0.02)
+        lines = compare([r], dict(results=[b]))
+        self.assertEqual(len(lines), 2)
+        self.assertIn('+10.0%', lines[1])
+        self.assertIn('-50.0%', lines[1])
@@ -0,0 +1,50 @@
+"""
+Testing the slot circuit breaker
+"""
+import time
+from unittest import TestCase
+
+from pyeleven.breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+__author__ = 'leifj'
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_trip(self):
+        b = CircuitBreaker(failure_rate=0.5, min_requests=4, window=10, reset_timeout=30)
+        b.failure()
+        b.failure()
+        b.success()
+        self.assertEqual(b.state, CLOSED)
+        b.failure()
+        self.assertEqual(b.state, OPEN)
+        self.assertFalse(b.allow())
+        self.assertEqual(b.trips, 1)
+        self.assertGreater(b.retry_after(), 0)
+
+    def test_window(self):
+        b = CircuitBreaker(failure_rate=0.5, min_requests=2, window=4)
+        for i in range(0, 10):
+            b.success()
+            b.success()
+            b.success()
+            b.failure()
+        self.assertEqual(b.state, CLOSED)
+
+    def test_probe(self):
+        b = CircuitBreaker(min_requests=1, reset_timeout=0.1, probes=1)
+        b.failure()
+        self.assertEqual(b.state, OPEN)
+        time.sleep(0.15)
+        self.assertEqual(b.state, HALF_OPEN)
+        self.assertTrue(b.allow())
+        self.assertFalse(b.allow())
+        b.failure()
+        self.assertEqual(b.state, OPEN)
+        self.assertEqual(b.trips, 2)
+        time.sleep(0.15)
+        self.assertTrue(b.allow())
+        b.success()
+        self.assertEqual(b.state, CLOSED)
+        self.assertTrue(b.allow())
@@ -0,0 +1,66 @@
+"""
+Testing the TTL and LRU caches
+"""
+import time
+from unittest import TestCase
+
+from pyeleven.cache import LRUCache, TTLCache
+
+__author__ = 'leifj'
+
+
+class TestTTLCache(TestCase):
+
+    def test_ttl_for(self):
+        c = TTLCache(ttl=60, refresh_ahead=None, ttl_for=lambda v: 0.05 if 'error' in v else 60)
+        loads = []
+
+        def _load(value):
+            loads.append(value)
+            return value
+
+        self.assertEqual(c.get('a', lambda: _load('ok')), 'ok')
+        self.assertEqual(c.get('b', lambda: _load('error')), 'error')
+        time.sleep(0.1)
+        self.assertEqual(c.get('a', lambda: _load('ok again')), 'ok')
+        self.assertEqual(c.get('b', lambda: _load('fixed')), 'fixed')
+        self.assertEqual(loads, ['ok', 'error', 'fixed'])
+
+
+class TestLRUCache(TestCase):
+
+    def test_lru(self):
+        c = LRUCache(maxsize=2, ttl=60)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.put('c', 3)  # b is the least recently used
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.hits, 3)
+        self.assertEqual(c.misses, 1)
+
+    def test_ttl(self):
+        c = LRUCache(maxsize=2, ttl=0.05)
+        c.put('a', 1)
+        self.assertEqual(c.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(len(c), 0)
+
+    def test_disabled(self):
+        c = LRUCache(maxsize=0, ttl=60)
+        c.put('a', 1)
+        self.assertIsNone(c.get('a'))
+
+    def test_invalidate(self):
+        c = LRUCache(maxsize=4, ttl=60)
+        c.put('a', 1)
+        c.put('b', 2)
+        c.invalidate('a')
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.get('b'), 2)
+        c.invalidate()
+        self.assertIsNone(c.get('b'))
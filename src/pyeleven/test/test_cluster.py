@@ -0,0 +1,85 @@
+"""
+Testing several PKCS#11 libraries behind one label using the mock library
+"""
+from unittest import TestCase
+
+from PyKCS11.LowLevel import CKR_DEVICE_ERROR
+
+from pyeleven import mock
+from pyeleven.pk11 import pkcs11, cluster_slots, cluster_supports_mechanism, modules, load_library, reset, \
+    configure, settings, invalidate_tokens, pool_stats
+from pyeleven.utils import PKCS11Exception, LibraryUnavailable
+
+__author__ = 'leifj'
+
+
+class TestCluster(TestCase):
+
+    def setUp(self):
+        reset()
+        self.saved = dict(settings)
+        configure(breaker_min_requests=1, breaker_failure_rate=0.5)
+        # libraries stay loaded - use new ones for each test
+        self.name_a = 'mock:{!s}-a'.format(self._testMethodName)
+        self.name_b = 'mock:{!s}-b'.format(self._testMethodName)
+        self.a = mock.register(self.name_a, tokens=('test',))
+        self.b = mock.register(self.name_b, tokens=('other', 'test'),
+                               mechanisms=('CKM_RSA_PKCS', 'CKM_SHA256_RSA_PKCS'))
+        self.cluster = [(self.name_a, 2), self.name_b]
+
+    def tearDown(self):
+        reset()
+        configure(**self.saved)
+
+    def test_modules(self):
+        self.assertEqual(modules('/usr/lib/p11.so'), (('/usr/lib/p11.so', 1),))
+        self.assertEqual(modules(self.cluster), ((self.name_a, 2), (self.name_b, 1)))
+        with self.assertRaises(ValueError):
+            modules([(self.name_a, 0)])
+
+    def test_cluster_slots(self):
+        self.assertEqual(cluster_slots(self.cluster, 'test'), [(self.name_a, 0), (self.name_b, 1)])
+        self.assertEqual(cluster_slots(self.cluster, '1'), [(self.name_b, 1)])
+        with self.assertRaises(PKCS11Exception):
+            cluster_slots(self.cluster, 'missing')
+        self.assertTrue(cluster_supports_mechanism(self.cluster, 'test', 'CKM_ECDSA'))
+        self.assertFalse(cluster_supports_mechanism(self.cluster, 'other', 'CKM_ECDSA'))
+
+    def test_spread(self):
+        with pkcs11(self.cluster, 'test') as first:
+            with pkcs11(self.cluster, 'test') as second:
+                with pkcs11(self.cluster, 'test') as third:
+                    used = set((si.library_name, si.slot) for si in (first, second, third))
+        self.assertTrue(used <= {(self.name_a, 0), (self.name_b, 1)})
+        self.assertEqual(load_library(self.name_a).sessions[0] + load_library(self.name_b).sessions[1], 3)
+
+    def test_failover(self):
+        self.a.failures['open'] = [(CKR_DEVICE_ERROR, 1.0)]
+        for i in range(0, 5):
+            with pkcs11(self.cluster, 'test') as si:
+                self.assertEqual(si.library_name, self.name_b)
+        self.assertEqual(self.b.calls['open1'], 1)
+
+    def test_gain_label(self):
+        configure(sessions_per_slot=2)
+        self.b.tokens[1].label = 'missing'
+        invalidate_tokens()
+        with pkcs11(self.cluster, 'test') as si:
+            self.assertEqual(si.library_name, self.name_a)
+        self.assertEqual(pool_stats()[(modules(self.cluster), 'test')]['max_size'], 2)
+        self.b.tokens[1].label = 'test'
+        invalidate_tokens()
+        with pkcs11(self.cluster, 'test') as first:
+            with pkcs11(self.cluster, 'test') as second:
+                with pkcs11(self.cluster, 'test') as third:
+                    used = set((si.library_name, si.slot) for si in (first, second, third))
+        self.assertIn((self.name_b, 1), used)
+        self.assertEqual(pool_stats()[(modules(self.cluster), 'test')]['max_size'], 4)
+
+    def test_load_failure(self):
+        missing = '/nonexistent/{!s}.so'.format(self._testMethodName)
+        cluster = [self.name_a, missing]
+        self.assertEqual(cluster_slots(cluster, 'test'), [(self.name_a, 0)])
+        with self.assertRaises(LibraryUnavailable):  # not loaded again before breaker_reset_timeout
+            load_library(missing)
+        self.assertEqual(cluster_slots(cluster, 'test'), [(self.name_a, 0)])
@@ -0,0 +1,107 @@
+"""
+Testing the micro-batching dispatcher
+"""
+import threading
+import time
+from contextlib import contextmanager
+from unittest import TestCase
+
+from pyeleven.dispatch import Dispatcher
+from pyeleven.pool import PoolFull
+
+__author__ = 'leifj'
+
+
+class _Session(object):
+
+    def __init__(self, label):
+        self.label = label
+        self.serial = 'serial'
+
+
+class TestDispatcher(TestCase):
+
+    def setUp(self):
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _session(self, label):
+        with self.lock:
+            self.sessions.append(label)
+        yield _Session(label)
+
+    def _find_key(self, si, label, keyname, key_type=None):
+        if keyname != 'test':
+            raise KeyError(keyname)
+        return 'key' if key_type is None else key_type, 'cert'
+
+    def _sign(self, si, key, keyname, data, mech):
+        if data == b'bad':
+            raise ValueError(data)
+        return data[::-1] if key == 'key' else key.encode('ascii') + data
+
+    def _dispatcher(self, **kwargs):
+        return Dispatcher(self._session, self._find_key, self._sign, lambda label: 2, **kwargs)
+
+    def test_sign(self):
+        d = self._dispatcher(max_linger=0.05)
+        futures = [d.submit('label', 'test', 'RSAPKCS1', b'data%d' % i) for i in range(0, 10)]
+        for i, f in enumerate(futures):
+            self.assertEqual(f.result(timeout=5), ((b'data%d' % i)[::-1], 'cert', 'serial'))
+        self.assertLess(len(self.sessions), 10)
+        d.shutdown()
+
+    def test_errors(self):
+        d = self._dispatcher()
+        bad = d.submit('label', 'test', 'RSAPKCS1', b'bad')
+        good = d.submit('label', 'test', 'RSAPKCS1', b'good')
+        self.assertRaises(ValueError, bad.result, 5)
+        self.assertEqual(good.result(timeout=5), (b'doog', 'cert', 'serial'))
+        self.assertRaises(KeyError, d.submit('label', 'nokey', 'RSAPKCS1', b'data').result, 5)
+        d.shutdown()
+
+    def test_max_waiting(self):
+        signing = threading.Event()
+        release = threading.Event()
+
+        def _sign(si, key, keyname, data, mech):
+            signing.set()
+            release.wait(5)
+            return data
+
+        d = Dispatcher(self._session, self._find_key, _sign, lambda label: 1, max_waiting=2)
+        first = d.submit('label', 'test', 'RSAPKCS1', b'first')
+        self.assertTrue(signing.wait(5))  # the only worker holds the session
+        queued = [d.submit('label', 'test', 'RSAPKCS1', b'data') for i in range(0, 2)]
+        with self.assertRaises(PoolFull):
+            d.submit('label', 'test', 'RSAPKCS1', b'data').result(timeout=0)
+        release.set()
+        for f in [first] + queued:
+            f.result(timeout=5)
+        d.submit('label', 'test', 'RSAPKCS1', b'data').result(timeout=5)  # queued again once the queue drained
+        d.shutdown()
+
+    def test_workers(self):
+        d = self._dispatcher(idle_timeout=0.5)
+        before = threading.active_count()
+        futures = [d.submit('label', keyname, 'RSAPKCS1', b'data') for keyname in ('test', 'nokey', 'other')] * 5
+        for f in futures:
+            try:
+                f.result(timeout=5)
+            except KeyError:
+                pass
+        # one set of workers for the label, none for keys that don't exist
+        self.assertLessEqual(threading.active_count() - before, 2)
+        self.assertEqual(list(d._labels['label'].queues.keys()), [])
+        time.sleep(1)
+        self.assertEqual(threading.active_count(), before)
+        self.assertNotIn('label', d._labels)
+
+    def test_key_type(self):
+        d = self._dispatcher()
+        rsa = d.submit('label', 'test', 'RSAPKCS1', b'data', key_type='rsa')
+        ec = d.submit('label', 'test', 'ECDSA', b'data', key_type='ec')
+        self.assertEqual(rsa.result(timeout=5), (b'rsadata', 'cert', 'serial'))
+        self.assertEqual(ec.result(timeout=5), (b'ecdata', 'cert', 'serial'))
+        d.shutdown()
@@ -3,12 +3,14 @@ Testing the PKCS#11 shim layer
 """
 import os
 import time
+import unittest
 from base64 import b64encode
 
 import six
 from flask import json
 from unittest import TestCase
 
+from pyeleven import verify
 from pyeleven.test import P11_MODULE, TemporarySoftHSM
 
 __author__ = 'leifj'
@@ -25,6 +27,13 @@ class FlaskTestCase(TestCase):
         app.config['PKCS11PIN'] = 'secret1'
         self.app = app.test_client()
 
+    def _slot(self):
+        """
+        :return: path prefix for a slot with the 'test' token - the two 'test' tokens hold different keys so
+        signatures are only compared when made on the same slot
+        """
+        return "/{!s}".format(json.loads(self.app.get("/").data)['labels']['test'][0])
+
     def test_info(self):
         rv = self.app.get("/info")
         self.assertIsNotNone(rv.data)
@@ -33,6 +42,17 @@ class FlaskTestCase(TestCase):
         self.assertIn('library', d)
         self.assertEqual(d['library'], P11_MODULE)
 
+    def test_ready(self):
+        from .. import app, start_warm_up
+        app.config['WARMUP'] = {'test': ['test']}
+        try:
+            start_warm_up().join(30)
+        finally:
+            del app.config['WARMUP']
+        rv = self.app.get("/ready")
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(json.loads(rv.data)['ready'])
+
     def test_sign(self):
         data = b64encode(b"test")
         if six.PY3:
@@ -46,6 +66,195 @@ class FlaskTestCase(TestCase):
         self.assertIn('slot', d)
         self.assertIn('signed', d)
 
+    def test_binary_sign(self):
+        rv = self.app.post("/test/test/sign?mech=RSAPKCS1",
+                           content_type='application/octet-stream',
+                           data=b"\xfftest")
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/octet-stream')
+        self.assertTrue(len(rv.data) > 0)
+        self.assertIn('X-PKCS11-Slot', rv.headers)
+        self.assertIn('X-PKCS11-Certificate', rv.headers)
+
+        rv = self.app.post("/test/test/rawsign",
+                           content_type='application/octet-stream',
+                           headers={'X-PKCS11-Mechanism': 'RSAPKCS1'},
+                           data=b"\xfftest")
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(len(rv.data) > 0)
+        self.assertNotIn('X-PKCS11-Certificate', rv.headers)
+
+    def test_ecdsa_sign(self):
+        rv = self.app.post("/test/ec/rawsign?mech=ECDSASHA256",
+                           content_type='application/octet-stream',
+                           data=b"test")
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(rv.data), 64)  # raw r||s for P-256
+
+        rv = self.app.post("/test/ec/rawsign?mech=ECDSASHA256&prehash=1&format=der",
+                           content_type='application/octet-stream',
+                           data=b"test")
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(six.indexbytes(rv.data, 0), 0x30)
+
+        rv = self.app.post("/test/ec/rawsign",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='ECDSA', data=b64encode(b"\x00" * 32).decode('utf-8'),
+                                                format='der')))
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('signed', json.loads(rv.data))
+
+    def test_prehash_sign(self):
+        import hashlib
+        slot = self._slot()
+        data = b64encode(b"test")
+        digest = b64encode(hashlib.sha256(b"test").digest())
+        if six.PY3:
+            data = data.decode('utf-8')
+            digest = digest.decode('utf-8')
+        rv = self.app.post(slot + "/test/rawsign",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='SHA256RSAPKCS', data=data, prehash=True)))
+        d = json.loads(rv.data)
+        self.assertIn('signed', d)
+        rv = self.app.post(slot + "/test/rawsign",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='SHA256RSAPKCS', digest=digest)))
+        self.assertEqual(json.loads(rv.data)['signed'], d['signed'])
+        rv = self.app.post(slot + "/test/rawsign",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='SHA256RSAPKCS', data=data)))
+        self.assertEqual(json.loads(rv.data)['signed'], d['signed'])
+        rv = self.app.post(slot + "/test/rawsign?mech=SHA256RSAPKCS&prehash=1",
+                           content_type='application/octet-stream',
+                           data=b"test")
+        self.assertEqual(b64encode(rv.data).decode('utf-8'), d['signed'])
+
+    def test_stream_sign(self):
+        from .. import app
+        slot = self._slot()
+        data = os.urandom(100 * 1024)
+        rv = self.app.post(slot + "/test/rawsign?mech=SHA256RSAPKCS",
+                           content_type='application/octet-stream',
+                           data=data)
+        self.assertEqual(rv.status_code, 200)
+        app.config['STREAM_THRESHOLD'] = 1024
+        app.config['STREAM_CHUNK_SIZE'] = 1000
+        try:
+            streamed = self.app.post(slot + "/test/rawsign?mech=SHA256RSAPKCS",
+                                     content_type='application/octet-stream',
+                                     data=data)
+        finally:
+            del app.config['STREAM_THRESHOLD']
+            del app.config['STREAM_CHUNK_SIZE']
+        self.assertEqual(streamed.status_code, 200)
+        self.assertEqual(streamed.data, rv.data)
+
+    def test_dispatch_sign(self):
+        from .. import app
+        slot = self._slot()
+        rv = self.app.post(slot + "/test/rawsign?mech=RSAPKCS1",
+                           content_type='application/octet-stream',
+                           data=b"test")
+        app.config['DISPATCH'] = True
+        try:
+            dispatched = self.app.post(slot + "/test/sign?mech=RSAPKCS1",
+                                       content_type='application/octet-stream',
+                                       data=b"test")
+        finally:
+            app.config['DISPATCH'] = False
+        self.assertEqual(dispatched.status_code, 200)
+        self.assertEqual(dispatched.data, rv.data)
+        self.assertIn('X-PKCS11-Certificate', dispatched.headers)
+
+    def test_batch_sign(self):
+        data = b64encode(b"test")
+        if six.PY3:
+            data = data.decode('utf-8')
+        rv = self.app.post("/test/test/batchsign",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='RSAPKCS1', data=[data, dict(data=data, mech='RSAPKCS1'),
+                                                                      dict(data=data, mech='NOSUCHMECH')])))
+        self.assertIsNotNone(rv.data)
+        d = json.loads(rv.data)
+        self.assertIsNotNone(d)
+        self.assertIn('slot', d)
+        self.assertIn('cert', d)
+        self.assertIn('signed', d)
+        self.assertEqual(len(d['signed']), 3)
+        self.assertIn('signed', d['signed'][0])
+        self.assertEqual(d['signed'][0], d['signed'][1])
+        self.assertIn('error', d['signed'][2])
+
+    def test_signature_cache(self):
+        from .. import pk11
+        pk11.configure(signature_cache_size=16)
+        try:
+            cache = pk11.signature_cache()
+            hits = cache.hits
+            rv = self.app.post("/test/test/rawsign?mech=SHA256RSAPKCS",
+                               content_type='application/octet-stream',
+                               data=b"cached")
+            cached = self.app.post("/test/test/sign?mech=SHA256RSAPKCS",
+                                   content_type='application/octet-stream',
+                                   data=b"cached")
+            self.assertEqual(cached.status_code, 200)
+            self.assertEqual(cached.data, rv.data)
+            self.assertIn('X-PKCS11-Certificate', cached.headers)
+            self.assertEqual(cache.hits, hits + 1)
+            pk11.invalidate_keys()
+            self.assertEqual(len(cache), 0)
+        finally:
+            pk11.configure(signature_cache_size=0)
+
+    @unittest.skipIf(not verify.available(), "cryptography is not installed")
+    def test_verify(self):
+        data = b64encode(b"test").decode('utf-8')
+        rv = self.app.post("/test/test/rawsign",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='SHA256RSAPKCS', data=data)))
+        signed = json.loads(rv.data)
+        signature = signed['signed']
+        rv = self.app.post("/test/test/verify",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='SHA256RSAPKCS', data=data, signature=signature)))
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(json.loads(rv.data)['valid'])
+        # both 'test' tokens have a key 'test' - verify using the one that signed
+        rv = self.app.post("/test/test/verify",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='SHA256RSAPKCS', data=data, signature=signature,
+                                                token=signed['token'])))
+        self.assertTrue(json.loads(rv.data)['valid'])
+
+        other = b64encode(b"other").decode('utf-8')
+        rv = self.app.post("/test/test/batchverify",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='SHA256RSAPKCS', data=[dict(data=data, signature=signature),
+                                                                           dict(data=other, signature=signature),
+                                                                           dict(data=data)])))
+        self.assertEqual(rv.status_code, 200)
+        d = json.loads(rv.data)
+        self.assertEqual(d['verified'][0], dict(valid=True))
+        self.assertEqual(d['verified'][1], dict(valid=False))
+        self.assertIn('error', d['verified'][2])
+
+    def test_metrics(self):
+        data = b64encode(b"test")
+        if six.PY3:
+            data = data.decode('utf-8')
+        self.app.post("/test/test/sign",
+                      content_type='application/json',
+                      data=json.dumps(dict(mech='RSAPKCS1', data=data)))
+        rv = self.app.get("/metrics")
+        self.assertEqual(rv.status_code, 200)
+        text = rv.data.decode('utf-8')
+        self.assertIn('# TYPE pyeleven_sign_seconds histogram', text)
+        self.assertIn('pyeleven_sign_total{', text)
+        self.assertIn('keyname="test"', text)
+        self.assertIn('pyeleven_pool_in_use{label="test"}', text)
+        self.assertIn('pyeleven_cache_hits_total{cache="keys"}', text)
+
     def test_bad_sign(self):
         exception_thrown = False
         try:
@@ -119,6 +328,33 @@ class FlaskTestCase(TestCase):
             self.assertIn('label', nfo['token'])
             self.assertIn('test', nfo['token']['label'])
 
+    def test_slot_info_etag(self):
+        rv = self.app.get("/test")
+        self.assertIn('ETag', rv.headers)
+        rv = self.app.get("/test", headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        rv = self.app.get("/")
+        rv = self.app.get("/", headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
+    def test_cert_fingerprint(self):
+        data = b64encode(b"test").decode('utf-8')
+        rv = self.app.post("/test/test/sign",
+                           content_type='application/json',
+                           data=json.dumps(dict(mech='RSAPKCS1', data=data, cert='fingerprint')))
+        self.assertEqual(rv.status_code, 200)
+        d = json.loads(rv.data)
+        self.assertNotIn('cert', d)
+        self.assertIn('cert_fingerprint', d)
+
+        rv = self.app.get("/test/test/cert")
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.data.startswith(b"-----BEGIN CERTIFICATE-----"))
+        self.assertEqual(rv.headers['X-PKCS11-Certificate-Fingerprint'], d['cert_fingerprint'])
+        self.assertIn('max-age', rv.headers['Cache-Control'])
+        rv = self.app.get("/test/test/cert", headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+
     def test_token_info(self):
         rv = self.app.get("/")
         assert rv.data
@@ -139,3 +375,17 @@ class FlaskTestCase(TestCase):
         self.assertIn('session', d)
         self.assertIn('objects', d)
         self.assertNotEqual(d['objects'], [])
+
+    def test_slot_objects_paged(self):
+        rv = self.app.get("/test/objects?class=private_key&label=test&limit=1")
+        d = json.loads(rv.data)
+        self.assertEqual(len(d['objects']), 1)
+        self.assertEqual(d['objects'][0]['CKA_LABEL'], 'test')
+        self.assertIn('CKA_KEY_TYPE', d['objects'][0])
+        self.assertIsNone(d['next'])
+        rv = self.app.get("/test/objects?limit=1")
+        d = json.loads(rv.data)
+        self.assertEqual(len(d['objects']), 1)
+        self.assertIsNotNone(d['next'])
+        rv = self.app.get("/test/objects?limit=1&cursor=%s" % d['next'])
+        self.assertEqual(len(json.loads(rv.data)['objects']), 1)
@@ -0,0 +1,145 @@
+"""
+Testing the mock PKCS#11 library
+"""
+import hashlib
+import io
+import threading
+import time
+from unittest import TestCase
+
+import PyKCS11
+from PyKCS11.LowLevel import CKA_LABEL, CKA_CLASS, CKO_PRIVATE_KEY, CKR_SESSION_COUNT, CKR_DEVICE_ERROR, \
+    CKR_SESSION_HANDLE_INVALID, CKR_KEY_TYPE_INCONSISTENT
+
+from pyeleven import mock
+from pyeleven.pk11 import load_library, SessionInfo, reset, inventory, configure, settings
+from pyeleven.utils import mechanism, prehash
+
+__author__ = 'leifj'
+
+
+class TestMockLibrary(TestCase):
+
+    def _key(self, session, label='test'):
+        return session.findObjects([(CKA_LABEL, label), (CKA_CLASS, CKO_PRIVATE_KEY)])[0]
+
+    def test_sign(self):
+        lib = mock.MockLibrary()
+        session = lib.openSession(0)
+        key = self._key(session)
+        signed = bytes(bytearray(session.sign(key, b'test', mechanism('SHA256RSAPKCS'))))
+        self.assertEqual(len(signed), 256)
+        self.assertEqual(signed, bytes(bytearray(session.sign(key, b'test', mechanism('SHA256RSAPKCS')))))
+        mech, data = prehash('SHA256RSAPKCS', data=b'test')
+        self.assertEqual(signed, bytes(bytearray(session.sign(key, data, mechanism(mech)))))
+        with self.assertRaises(PyKCS11.PyKCS11Error) as ctx:
+            session.sign(key, b'test', mechanism('ECDSA'))
+        self.assertEqual(ctx.exception.value, CKR_KEY_TYPE_INCONSISTENT)
+        self.assertEqual(len(session.sign(self._key(session, 'ec'), hashlib.sha256(b'test').digest(),
+                                          mechanism('ECDSA'))), 64)
+
+    def test_sign_stream(self):
+        lib = mock.MockLibrary()
+        si = SessionInfo(session=lib.openSession(0), slot=0)
+        key = self._key(si.session)
+        data = b'x' * 100000
+        signed = si.sign_stream(key, io.BytesIO(data), mechanism('SHA256RSAPKCS'), chunk_size=4096)
+        self.assertEqual(bytes(bytearray(signed)),
+                         bytes(bytearray(si.session.sign(key, data, mechanism('SHA256RSAPKCS')))))
+
+    def test_find_objects(self):
+        lib = mock.MockLibrary(keys={'k{:d}'.format(i): 'RSA' for i in range(10)})
+        si = SessionInfo(session=lib.openSession(0), slot=0)
+        handles, more = si.find_objects([(CKA_CLASS, CKO_PRIVATE_KEY)], offset=2, limit=5, batch=3)
+        self.assertEqual(len(handles), 5)
+        self.assertTrue(more)
+        self.assertEqual(si.get_object_friendly_attrs(handles[0])['CKA_LABEL'], 'k2')
+
+    def test_max_sessions(self):
+        lib = mock.MockLibrary(max_sessions=1)
+        session = lib.openSession(0)
+        with self.assertRaises(PyKCS11.PyKCS11Error) as ctx:
+            lib.openSession(0)
+        self.assertEqual(ctx.exception.value, CKR_SESSION_COUNT)
+        lib.openSession(1)
+        session.closeSession()
+        lib.openSession(0)
+
+    def test_inject(self):
+        lib = mock.MockLibrary()
+        session = lib.openSession(0)
+        key = self._key(session)
+        lib.inject('sign', 'CKR_DEVICE_ERROR', slot=1)
+        lib.inject('sign', CKR_SESSION_HANDLE_INVALID, slot=0)
+        with self.assertRaises(PyKCS11.PyKCS11Error) as ctx:
+            session.sign(key, b'test', mechanism('RSAPKCS1'))
+        self.assertEqual(ctx.exception.value, CKR_SESSION_HANDLE_INVALID)
+        # the session is gone
+        with self.assertRaises(PyKCS11.PyKCS11Error):
+            session.findObjects()
+        other = lib.openSession(1)
+        with self.assertRaises(PyKCS11.PyKCS11Error) as ctx:
+            other.sign(self._key(other), b'test', mechanism('RSAPKCS1'))
+        self.assertEqual(ctx.exception.value, CKR_DEVICE_ERROR)
+        other.sign(self._key(other), b'test', mechanism('RSAPKCS1'))
+
+    def test_failures(self):
+        lib = mock.MockLibrary(failures={'login': [('CKR_DEVICE_ERROR', 1.0)]}, seed=1)
+        session = lib.openSession(0)
+        with self.assertRaises(PyKCS11.PyKCS11Error) as ctx:
+            session.login('1234')
+        self.assertEqual(ctx.exception.value, CKR_DEVICE_ERROR)
+        self.assertEqual(lib.calls['login'], 1)
+
+    def test_latency(self):
+        lib = mock.MockLibrary(latency={'open': ('uniform', 0.05, 0.06)}, slot_latency={1: 2})
+        start = time.time()
+        lib.openSession(0)
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        start = time.time()
+        lib.openSession(1)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        with self.assertRaises(ValueError):
+            mock.MockLibrary(latency={'sign': ('pareto', 1)})
+
+    def test_concurrency(self):
+        lib = mock.MockLibrary(latency={'open': 0.1}, concurrency=1)
+        threads = [threading.Thread(target=lib.openSession, args=(slot,)) for slot in (0, 1)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_inventory_error(self):
+        reset()
+        saved = dict(settings)
+        configure(inventory_error_ttl=0.05)
+        try:
+            lib = mock.MockLibrary()
+            mechanisms = lib.getMechanismList
+            failures = [PyKCS11.PyKCS11Error(CKR_DEVICE_ERROR)]
+
+            def _mechanisms(slot):
+                if failures:
+                    raise failures.pop()
+                return mechanisms(slot)
+
+            lib.getMechanismList = _mechanisms
+            self.assertIn('error', inventory(lib, 0)['mechanisms'])
+            self.assertIn('error', inventory(lib, 0)['mechanisms'])  # cached
+            time.sleep(0.1)
+            self.assertIn('CKM_RSA_PKCS', inventory(lib, 0)['mechanisms'])
+        finally:
+            configure(**saved)
+            reset()
+
+    def test_load_library(self):
+        reset()
+        registered = mock.register('mock:test_load_library', tokens=('a', 'b', 'c'))
+        lib = load_library('mock:test_load_library')
+        self.assertIs(lib, registered)
+        self.assertTrue(lib.initialized)
+        self.assertEqual(lib.getSlotList(), [0, 1, 2])
+        self.assertEqual(lib.getTokenInfo(2).label.strip(), 'c')
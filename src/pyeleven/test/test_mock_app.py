@@ -0,0 +1,281 @@
+"""
+Testing the flask app against the mock PKCS#11 library: session pool, retries and slot breakers with
+injected failures
+"""
+import threading
+import time
+from base64 import b64encode
+from unittest import TestCase
+
+import six
+from PyKCS11 import PyKCS11Error
+from flask import json
+from PyKCS11.LowLevel import CKA_VALUE, CKR_DEVICE_ERROR, CKR_FUNCTION_FAILED, CKR_SESSION_HANDLE_INVALID
+
+from pyeleven import mock
+from pyeleven.pk11 import reset, configure, settings, breaker, pool_stats, warm_up, pkcs11, slot_stats, \
+    invalidate_keys
+from pyeleven.breaker import OPEN, CLOSED
+from pyeleven.utils import NotFound
+
+__author__ = 'leifj'
+
+
+def _body(mech='RSAPKCS1', data=b'test', **kwargs):
+    data = b64encode(data)
+    if six.PY3:
+        data = data.decode('utf-8')
+    return json.dumps(dict(mech=mech, data=data, **kwargs))
+
+
+class MockAppTestCase(TestCase):
+
+    def setUp(self):
+        from .. import app
+        reset()
+        self.settings = dict(settings)
+        self.config = dict(app.config)
+        # libraries stay loaded - use a new one for each test
+        self.name = 'mock:app-{!s}'.format(self._testMethodName)
+        self.lib = mock.register(self.name)
+        app.config['TESTING'] = True
+        app.config['PKCS11MODULE'] = self.name
+        app.config['PKCS11PIN'] = 'secret1'
+        self.app = app.test_client()
+
+    def tearDown(self):
+        from .. import app
+        reset()
+        configure(**self.settings)
+        app.config.clear()
+        app.config.update(self.config)
+
+    def _sign(self, label='test'):
+        return self.app.post("/{!s}/test/sign".format(label), content_type='application/json', data=_body())
+
+    def test_sign(self):
+        rv = self._sign()
+        self.assertEqual(rv.status_code, 200)
+        d = json.loads(rv.data)
+        self.assertEqual(len(d['signed']), len(b64encode(b'x' * 256)))
+        self.assertIn('cert', d)
+        self.assertEqual(self.lib.calls['sign'], 1)
+
+    def test_token(self):
+        serials = ['mock{:012d}'.format(slot) for slot in (0, 1)]
+        self.assertIn(json.loads(self._sign().data)['token'], serials)
+        rv = self.app.post("/test/test/sign?mech=RSAPKCS1", content_type='application/octet-stream', data=b'test')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(rv.headers['X-PKCS11-Token'], serials)
+
+    def test_cert(self):
+        self.lib.tokens[1].objects[4][CKA_VALUE] = tuple(bytearray(b'another certificate'))  # the cert of 'test'
+        for i in range(0, 10):
+            d = json.loads(self.app.post("/test/test/sign", content_type='application/json',
+                                         data=_body(cert='fingerprint')).data)
+            rv = self.app.get("/test/test/cert", query_string=dict(token=d['token']))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.headers['X-PKCS11-Certificate-Fingerprint'], d['cert_fingerprint'])
+        fingerprints = [self.app.get("/test/test/cert", query_string=dict(token=token))
+                        .headers['X-PKCS11-Certificate-Fingerprint'] for token in ('mock000000000000', None,
+                                                                                   'mock000000000001')]
+        self.assertEqual(fingerprints[0], fingerprints[1])  # the first token by default
+        self.assertNotEqual(fingerprints[0], fingerprints[2])
+        self.assertEqual(list(pool_stats().keys()), [(self.name, 'test')])  # sessions from the label pool
+
+    def test_cert_rotation(self):
+        first = self.app.get("/test/test/cert").headers['X-PKCS11-Certificate-Fingerprint']
+        self.lib.tokens[0].objects[4][CKA_VALUE] = tuple(bytearray(b'rotated certificate'))
+        self.assertEqual(self.app.get("/test/test/cert").headers['X-PKCS11-Certificate-Fingerprint'], first)
+        invalidate_keys()
+        self.assertNotEqual(self.app.get("/test/test/cert").headers['X-PKCS11-Certificate-Fingerprint'], first)
+
+    def test_metrics(self):
+        with pkcs11([(self.name, 2)], 'test', 'secret1'), pkcs11(self.name, 0, 'secret1'):
+            pass
+        self.assertEqual(self._sign().status_code, 200)
+        self.assertEqual(slot_stats(self.name, 1).weight, 2)  # the weight the cluster gave the library
+        rv = self.app.get("/metrics")
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'pyeleven_pool_allocs_total', rv.data)
+
+    def test_libraries(self):
+        from .. import app
+        missing = '/nonexistent/{!s}.so'.format(self._testMethodName)
+        app.config['PKCS11MODULE'] = [self.name, missing]
+        for i in range(0, 2):  # the second time the library isn't loaded again but still reported
+            rv = self.app.get("/")
+            self.assertEqual(rv.status_code, 200)
+            libraries = json.loads(rv.data)['libraries']
+            self.assertEqual([l['library'] for l in libraries], [self.name, missing])
+            self.assertIn('error', libraries[1])
+
+    def test_objects(self):
+        self.lib = mock.register(self.name, keys={'k{:02d}'.format(i): 'RSA' for i in range(0, 10)})
+        labels = []
+        cursor = ''
+        finds = None
+        while cursor is not None:
+            d = json.loads(self.app.get("/test/objects", query_string=dict(cursor=cursor, limit=3,
+                                                                           **{'class': 'private_key'})).data)
+            labels.extend(o['CKA_LABEL'] for o in d['objects'])
+            cursor = d['next']
+            if finds is None:  # the cursor names the token the listing is from
+                self.assertIn(cursor.rsplit(':', 1)[0], ['mock{:012d}'.format(slot) for slot in (0, 1)])
+                finds = self.lib.calls['find']
+        self.assertEqual(labels, ['k{:02d}'.format(i) for i in range(0, 10)])
+        self.assertEqual(self.lib.calls['find'], finds)  # only the first page searched the token
+        with self.assertRaises(ValueError):
+            self.app.get("/test/objects", query_string=dict(cursor='nosuchtoken:3'))
+
+    def test_slot_latency(self):
+        with pkcs11(self.name, 'test', 'secret1') as si:
+            stats = slot_stats(si.library_name, si.slot)
+            time.sleep(0.1)
+        self.assertEqual(stats.count, 0)  # holding a session is not a token operation
+        self.lib.latency['sign'] = lambda rnd: 0.02
+        self.assertEqual(self.app.post("/{!s}/test/sign".format(si.slot), content_type='application/json',
+                                       data=_body()).status_code, 200)
+        self.assertEqual(stats.count, 1)
+        self.assertGreaterEqual(stats.latency, 0.015)
+        self.assertLess(stats.latency, 0.1)
+
+    def test_concurrent_sessions(self):
+        configure(sessions_per_slot=2, pool_timeout=5)
+        reset()
+        mock.register(self.name, tokens=('test',) * 4)
+        done = []
+
+        def _use():
+            for i in range(0, 200):
+                with pkcs11(self.name, 'test', 'secret1'):
+                    pass
+            done.append(True)
+
+        threads = [threading.Thread(target=_use) for i in range(0, 16)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        deadline = time.time() + 20
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+        self.assertEqual(len(done), 16)
+
+    def test_shared_slots(self):
+        configure(sessions_per_slot=2, pool_timeout=5)
+        reset()
+        with pkcs11(self.name, 0, 'secret1'), pkcs11(self.name, 0, 'secret1'):
+            pass  # idle in the pool for slot 0, holding all the sessions slot 0 may have
+        held = [pkcs11(self.name, 'test', 'secret1') for i in range(0, 4)]
+        sessions = [h.__enter__() for h in held]  # the idle sessions of the other pool were closed for these
+        self.assertEqual(sorted(si.slot for si in sessions), [0, 0, 1, 1])
+        returned = held.pop([si.slot for si in sessions].index(0))
+        timer = threading.Timer(0.2, returned.__exit__, (None, None, None))
+        timer.start()
+        with pkcs11(self.name, 0, 'secret1') as si:  # waits for a session on slot 0 to be returned
+            self.assertEqual(si.slot, 0)
+        timer.join()
+        for h in held:
+            h.__exit__(None, None, None)
+
+    def test_warm_up(self):
+        import pyeleven
+        from .. import app
+        app.config['WARMUP'] = {'test': ['test']}
+        del pyeleven._warm_up_pid[:]  # as in a new process
+        self.app.get("/ready")
+        self.assertTrue(pyeleven._ready.wait(5))
+        self.assertEqual(self.app.get("/ready").status_code, 200)
+        self.assertEqual(sum(self.lib.sessions.values()), 2 * settings['sessions_per_slot'])
+
+    def test_warm_up_keys(self):
+        configure(sessions_per_slot=1)
+        reset()
+        self.assertEqual(warm_up(self.name, 'test', ['test'], 'secret1'), 2)
+        finds = self.lib.calls['find']
+        for i in range(0, 4):
+            self.assertEqual(self._sign().status_code, 200)
+        self.assertEqual(self.lib.calls['find'], finds)  # the keys were looked up on every session
+
+    def test_retry(self):
+        self.lib.inject('sign', CKR_DEVICE_ERROR, count=2)
+        rv = self._sign()
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.lib.calls['sign'], 3)
+        # the sessions that failed were dropped from the pool
+        self.assertEqual(pool_stats()[(self.name, 'test')]['destroyed'], 2)
+
+    def test_retries_counted(self):
+        import pyeleven
+        before = pyeleven.sign_retries.values.get(('PyKCS11Error',), 0)
+        self.lib.inject('sign', CKR_FUNCTION_FAILED, count=100)
+        with self.assertRaises(PyKCS11Error):
+            self._sign()
+        self.assertEqual(self.lib.calls['sign'], pyeleven.max_retry)
+        # the last attempt isn't retried
+        self.assertEqual(pyeleven.sign_retries.values[('PyKCS11Error',)] - before, pyeleven.max_retry - 1)
+
+    def test_batch_retry(self):
+        self.lib.inject('sign', CKR_DEVICE_ERROR)
+        data = b64encode(b'test').decode('utf-8')
+        rv = self.app.post("/test/test/batchsign", content_type='application/json',
+                           data=json.dumps(dict(mech='RSAPKCS1', data=[data, data])))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual([sorted(r.keys()) for r in json.loads(rv.data)['signed']], [['signed'], ['signed']])
+        self.assertEqual(pool_stats()[(self.name, 'test')]['destroyed'], 1)
+
+    def test_no_retry(self):
+        with self.assertRaises(NotFound):
+            self.app.post("/test/nosuchkey/sign", content_type='application/json', data=_body())
+        self.assertEqual(self.lib.calls['find'], 1)
+
+    def test_transient_failure(self):
+        configure(breaker_min_requests=1, breaker_window=2)
+        reset()
+        self.lib.inject('sign', CKR_FUNCTION_FAILED)
+        self.assertEqual(self._sign().status_code, 200)  # retried
+        self.assertEqual(self.lib.calls['sign'], 2)
+        self.assertEqual([breaker(self.name, slot).state for slot in (0, 1)], [CLOSED, CLOSED])
+
+    def test_session_invalid(self):
+        self.assertEqual(self._sign().status_code, 200)
+        self.lib.inject('sign', CKR_SESSION_HANDLE_INVALID)
+        self.assertEqual(self._sign().status_code, 200)
+        self.assertEqual(sum(self.lib.sessions.values()), 1)  # the invalid session is gone, a new one replaced it
+
+    def test_breaker(self):
+        configure(breaker_min_requests=2, breaker_window=4, breaker_reset_timeout=60, sessions_per_slot=1)
+        reset()
+        self.assertEqual(warm_up(self.name, 'test', sessions=2), 2)  # a session on each slot
+        self.lib.inject('sign', CKR_DEVICE_ERROR, count=100, slot=0)
+        for i in range(0, 20):
+            self.assertEqual(self._sign().status_code, 200)
+        self.assertEqual(breaker(self.name, 0).state, OPEN)
+        failed = self.lib.calls['sign0']
+        for i in range(0, 10):
+            self.assertEqual(self._sign().status_code, 200)
+        self.assertEqual(self.lib.calls['sign0'], failed)  # the failing slot is out of rotation
+
+    def test_all_slots_failing(self):
+        configure(breaker_min_requests=1, breaker_window=2, breaker_reset_timeout=60)
+        reset()
+        self.lib.inject('sign', CKR_DEVICE_ERROR, count=100)
+        rv = self._sign()
+        self.assertEqual(rv.status_code, 503)
+        self.assertIn('Retry-After', rv.headers)
+
+    def test_pool_timeout(self):
+        configure(sessions_per_slot=1, pool_timeout=0.05)
+        reset()
+        self.lib.latency['sign'] = lambda rnd: 0.5
+        codes = []
+
+        def _request():
+            codes.append(self.app.post("/0/test/sign", content_type='application/json', data=_body()).status_code)
+
+        threads = [threading.Thread(target=_request) for i in range(0, 3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(codes), [200, 503, 503])
@@ -6,6 +6,7 @@ from collections import Counter
 from unittest import TestCase
 
 import pkg_resources
+from PyKCS11.LowLevel import CKK_RSA, CKK_EC
 from retrying import retry
 
 from pyeleven import pk11
@@ -34,6 +35,39 @@ class TestPKCS11(TestCase):
         slots = pk11.slots_for_label('test', lib)
         self.assertEqual(len(slots), 2)
 
+    def test_library_shared_between_threads(self):
+        os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
+        lib = pk11.load_library(P11_MODULE)
+        libs = []
+        tp = ThreadPool(5)
+        for i in range(0, 10):
+            tp.add_task(lambda: libs.append(pk11.load_library(P11_MODULE)))
+        tp.wait_completion()
+        self.assertEqual(len(libs), 10)
+        for other in libs:
+            self.assertIs(other, lib)
+
+    def test_label_cache(self):
+        os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
+        lib = pk11.load_library(P11_MODULE)
+        t = pk11.tokens(lib)
+        self.assertIn('test', t['labels'])
+        self.assertIs(pk11.tokens(lib), t)
+        self.assertEqual(pk11.slots_for_label('test', lib), t['labels']['test'])
+        pk11.invalidate_tokens(lib)
+        self.assertIsNot(pk11.tokens(lib), t)
+        self.assertEqual(pk11.tokens(lib)['labels'], t['labels'])
+
+    def test_inventory(self):
+        os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
+        lib = pk11.load_library(P11_MODULE)
+        slot = pk11.slots_for_label('test', lib)[0]
+        nfo = pk11.inventory(lib, slot)
+        self.assertIn('CKM_RSA_PKCS', nfo['mechanisms'])
+        self.assertIs(pk11.inventory(lib, slot), nfo)
+        self.assertTrue(pk11.supports_mechanism(lib, 'test', 'CKM_RSA_PKCS'))
+        self.assertFalse(pk11.supports_mechanism(lib, 'test', 'CKM_NO_SUCH_MECHANISM'))
+
     def test_find_key(self):
         os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
         with pk11.pkcs11(P11_MODULE, 'test', "secret1") as si:
@@ -66,6 +100,49 @@ class TestPKCS11(TestCase):
         for k in hits.keys():
             self.assertGreater(hits[k], 30)
 
+    def test_key_cache(self):
+        os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
+        with pk11.pkcs11(P11_MODULE, 'test', "secret1") as si:
+            self.assertIsNotNone(si.serial)
+            key, cert = si.find_key('test', find_cert=False)
+            self.assertIsNotNone(key)
+            self.assertIsNone(cert)
+            info = pk11._key_cache.get((si.serial, 'test', None), lambda: None)
+            self.assertIsNotNone(info)
+            self.assertIsNotNone(info.cert_der)
+            key, cert = si.find_key('test')
+            self.assertEqual(cert, info.cert_pem)
+            pk11.invalidate_keys(si.serial, 'test')
+            key, cert = si.find_key('test')
+            self.assertIsNotNone(key)
+            self.assertEqual(cert, info.cert_pem)
+            self.assertEqual(si.find_key('doesnotexist'), (None, None))
+
+    def test_find_key_type(self):
+        os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
+        with pk11.pkcs11(P11_MODULE, 'test', "secret1") as si:
+            key, cert = si.find_key('test', key_type=CKK_RSA)
+            self.assertIsNotNone(key)
+            self.assertIsNotNone(cert)
+            self.assertEqual(si.find_key('test', key_type=CKK_EC), (None, None))
+            key, cert = si.find_key('ec', find_cert=False)
+            self.assertIsNotNone(key)
+            info = pk11._key_cache.get((si.serial, 'ec', CKK_EC), lambda: None)
+            self.assertIsNotNone(info)
+            self.assertEqual(info.key_type, CKK_EC)
+            key, _ = si.find_key('ec', find_cert=False, key_type=CKK_EC)
+            self.assertIsNotNone(key)
+            signed = si.session.sign(key, b'\x00' * 32, mechanism('ECDSA'))
+            self.assertEqual(len(signed), 64)
+
+    def test_warm_up(self):
+        os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
+        n = pk11.warm_up(P11_MODULE, 'test', ['test'], 'secret1', sessions=3)
+        self.assertEqual(n, 3)
+        stats = pk11.pool_stats()[(P11_MODULE, 'test')]
+        self.assertEqual(stats['idle'], 3)
+        self.assertRaises(pk11.PKCS11Exception, pk11.warm_up, P11_MODULE, 'test', ['doesnotexist'], 'secret1')
+
     def test_find_key_by_label(self):
         os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
         with pk11.pkcs11(P11_MODULE, 'test', "secret1") as si:
@@ -143,6 +220,25 @@ class TestPKCS11(TestCase):
         te = time.time()
         print("1000 signatures (p11 parallell): %2.3f sec (speed: %2.5f sec/s)" % (te - ts, (te - ts) / 1000))
 
+    def test_sessions_shared_between_threads(self):
+        os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
+
+        def _sign(msg):
+            with pk11.pkcs11(P11_MODULE, 'test', "secret1") as si:
+                key, _ = si.find_key('test', find_cert=False)
+                signed = intarray2bytes(si.session.sign(key, msg, mechanism('RSAPKCS1')))
+                self.assertIsNotNone(signed)
+
+        tp = ThreadPool(20)
+        for i in range(0, 200):
+            tp.add_task(_sign, "message %d" % i)
+        tp.wait_completion()
+        sessions = pk11._sessions()
+        self.assertNotEqual(sessions, {})
+        for (lib, slot), lst in sessions.items():
+            self.assertEqual(lib, P11_MODULE)
+            self.assertLessEqual(len(lst), pk11.settings['sessions_per_slot'])
+
     def test_stress_sign_parallell_20_with_failovers(self):
         os.environ['SOFTHSM2_CONF'] = self.softhsm.softhsm_conf
 
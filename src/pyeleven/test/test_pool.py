@@ -0,0 +1,170 @@
+"""
+Testing the object pool
+"""
+import threading
+import time
+from unittest import TestCase
+
+from pyeleven.pool import ObjectPool, PoolTimeout, PoolFull, NoCapacity, allocation, DEFAULT_RETRY_AFTER
+from pyeleven.test.utils import ThreadPool
+
+__author__ = 'leifj'
+
+
+class Thing(object):
+    def __init__(self, priority=0):
+        self.priority = priority
+
+
+class TestObjectPool(TestCase):
+
+    def setUp(self):
+        self.destroyed = []
+
+    def _pool(self, **kwargs):
+        return ObjectPool(lambda *args, **kw: Thing(), lambda obj, *args, **kw: self.destroyed.append(obj),
+                          lambda obj: None, **kwargs)
+
+    def test_lazy_create(self):
+        pool = self._pool(maxSize=3)
+        with allocation(pool) as obj:
+            self.assertIsNotNone(obj)
+            self.assertEqual(pool.stats()['size'], 1)
+        with allocation(pool) as other:
+            self.assertIs(other, obj)
+        self.assertEqual(pool.stats()['created'], 1)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_capacity(self):
+        pool = self._pool(maxSize=2, timeout=0.1)
+        a = pool.alloc()
+        b = pool.alloc()
+        self.assertIsNot(a, b)
+        self.assertRaises(PoolTimeout, pool.alloc)
+        stats = pool.stats()
+        self.assertEqual(stats['in_use'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        pool.free(a)
+        self.assertIs(pool.alloc(), a)
+
+    def test_invalidate(self):
+        pool = self._pool(maxSize=1, timeout=0.1)
+        try:
+            with allocation(pool) as obj:
+                raise ValueError("oops...")
+        except ValueError:
+            pass
+        self.assertEqual(self.destroyed, [obj])
+        self.assertEqual(pool.stats()['size'], 0)
+        with allocation(pool) as other:
+            self.assertIsNot(other, obj)
+
+    def test_least_loaded_first(self):
+        pool = self._pool(maxSize=2)
+        a = pool.alloc()
+        b = pool.alloc()
+        a.priority = 5
+        pool.free(a)
+        pool.free(b)
+        self.assertIs(pool.alloc(), b)
+
+    def test_select(self):
+        pool = self._pool(maxSize=2, select=lambda idle: max(idle, key=lambda o: o.priority))
+        a = pool.alloc()
+        b = pool.alloc()
+        a.priority = 5
+        pool.free(a)
+        pool.free(b)
+        self.assertIs(pool.alloc(), a)
+
+    def test_accept(self):
+        pool = self._pool(maxSize=2, accept=lambda obj: obj.priority >= 0)
+        a = pool.alloc()
+        a.priority = -1
+        pool.free(a)
+        b = pool.alloc()
+        self.assertIsNot(b, a)
+        self.assertEqual(self.destroyed, [a])
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_kind(self):
+        kinds = []
+
+        def _create(*args, **kwargs):
+            kinds.append(kwargs['kind'])
+            return Thing(priority=kwargs['kind'] or 0)
+
+        pool = ObjectPool(_create, lambda obj, *args, **kw: self.destroyed.append(obj), lambda obj: None,
+                          maxSize=2, kind_of=lambda obj: obj.priority)
+        a = pool.alloc(kind=1)
+        b = pool.alloc()
+        pool.free(a)
+        pool.free(b)
+        self.assertIs(pool.alloc(kind=1), a)
+        pool.free(a)
+        c = pool.alloc(kind=2)  # the pool is full - an idle object is dropped to make room
+        self.assertEqual(c.priority, 2)
+        self.assertEqual(len(self.destroyed), 1)
+        self.assertEqual(kinds, [1, None, 2])
+        self.assertEqual(pool.stats()['size'], 2)
+
+    def test_no_capacity(self):
+        capacity = [False, True]
+
+        def _create(*args, **kwargs):
+            if not capacity.pop(0):
+                raise NoCapacity("not yet")
+            return Thing()
+
+        pool = ObjectPool(_create, lambda obj, *args, **kw: None, lambda obj: None, maxSize=2, timeout=1)
+        self.assertIsNotNone(pool.alloc())  # created on the second try
+        self.assertEqual(pool.stats()['in_use'], 1)
+        capacity.append(False)
+        with self.assertRaises(PoolTimeout):
+            pool.alloc(timeout=0.01)
+        self.assertEqual(pool.stats()['in_use'], 1)
+
+    def test_max_waiting(self):
+        pool = self._pool(maxSize=1, timeout=5, max_waiting=1)
+        a = pool.alloc()
+        waiter = threading.Thread(target=lambda: pool.free(pool.alloc()))
+        waiter.start()
+        while pool.stats()['waiting'] < 1:
+            time.sleep(0.01)
+        try:
+            pool.alloc()
+            self.fail("PoolFull not raised")
+        except PoolFull as ex:
+            self.assertIsNotNone(ex.retry_after)
+        self.assertEqual(pool.stats()['rejected'], 1)
+        pool.free(a)
+        waiter.join()
+        self.assertIsNotNone(pool.drain_rate())
+
+    def test_retry_after(self):
+        pool = self._pool(maxSize=1, max_waiting=0)
+        a = pool.alloc()
+        try:
+            pool.alloc()
+            self.fail("PoolFull not raised")
+        except PoolFull as ex:  # no timeout and nothing returned yet
+            self.assertEqual(ex.retry_after, DEFAULT_RETRY_AFTER)
+        pool.free(a)
+
+    def test_parallel(self):
+        pool = self._pool(maxSize=3, timeout=10)
+        in_use = []
+
+        def _use():
+            with allocation(pool) as obj:
+                in_use.append(pool.stats()['in_use'])
+                time.sleep(0.01)
+
+        tp = ThreadPool(10)
+        for i in range(0, 50):
+            tp.add_task(_use)
+        tp.wait_completion()
+        self.assertEqual(len(in_use), 50)
+        self.assertLessEqual(max(in_use), 3)
+        self.assertLessEqual(pool.stats()['created'], 3)
+        self.assertEqual(pool.stats()['in_use'], 0)
@@ -0,0 +1,61 @@
+"""
+Testing the slot selection strategies
+"""
+from unittest import TestCase
+
+from pyeleven.scheduler import SlotStats, STRATEGIES
+
+__author__ = 'leifj'
+
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        self.stats = dict(fast=SlotStats(), slow=SlotStats())
+        for i in range(0, 5):
+            for slot, elapsed in (('fast', 0.001), ('slow', 0.1)):
+                self.stats[slot].start()
+                self.stats[slot].observe(elapsed)
+                self.stats[slot].finish()
+
+    def _choose(self, strategy, n=100):
+        return [STRATEGIES[strategy](['fast', 'slow'], self.stats.get) for i in range(0, n)]
+
+    def test_stats(self):
+        s = SlotStats(alpha=0.5)
+        s.start()
+        self.assertEqual(s.outstanding, 1)
+        s.observe(1.0)
+        s.finish()
+        s.start()
+        s.observe(0.0)
+        s.finish()
+        self.assertEqual(s.outstanding, 0)
+        self.assertEqual(s.count, 2)
+        self.assertAlmostEqual(s.latency, 0.5, places=2)
+
+    def test_latency(self):
+        self.assertEqual(set(self._choose('ewma')), {'fast'})
+        self.assertEqual(set(self._choose('p2c')), {'fast'})
+
+    def test_least_outstanding(self):
+        self.stats['fast'].start()
+        self.assertEqual(set(self._choose('least_outstanding')), {'slow'})
+
+    def test_random(self):
+        self.assertEqual(set(self._choose('random')), {'fast', 'slow'})
+
+    def test_single_slot(self):
+        for strategy in STRATEGIES:
+            self.assertEqual(STRATEGIES[strategy](['slow'], self.stats.get), 'slow')
+
+    def test_weight(self):
+        stats = dict(heavy=SlotStats(weight=3), light=SlotStats())
+        chosen = [STRATEGIES['random'](['heavy', 'light'], stats.get) for i in range(0, 1000)]
+        self.assertGreater(chosen.count('heavy'), 2 * chosen.count('light'))
+        for slot, elapsed in (('heavy', 0.1), ('light', 0.05)):
+            stats[slot].start()
+            stats[slot].observe(elapsed)
+            stats[slot].finish()
+        self.assertLess(stats['heavy'].cost(), stats['light'].cost())
+        self.assertEqual(set(STRATEGIES['ewma'](['heavy', 'light'], stats.get) for i in range(0, 100)), {'heavy'})
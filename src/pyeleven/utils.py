@@ -1,5 +1,7 @@
 import six
 import base64
+import hashlib
+from binascii import unhexlify
 import PyKCS11
 
 
@@ -7,6 +9,107 @@ class PKCS11Exception(Exception):
     pass
 
 
+class UnsupportedMechanism(PKCS11Exception):
+    """Raised when no slot for a token label supports the requested mechanism"""
+    pass
+
+
+class NotFound(PKCS11Exception):
+    """Raised when a token label, key or certificate doesn't exist - trying again won't find it"""
+    pass
+
+
+class SlotsUnavailable(PKCS11Exception):
+    """Raised when every slot for a label is taken out of rotation by its circuit breaker"""
+
+    def __init__(self, message, retry_after=0):
+        super(SlotsUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class LibraryUnavailable(PKCS11Exception):
+    """Raised when a PKCS#11 library that recently failed to load is used before it may be tried again"""
+
+    def __init__(self, message, retry_after=0):
+        super(LibraryUnavailable, self).__init__(message)
+        self.retry_after = retry_after
+
+
+# mechanisms PyKCS11 has no Mechanism* object for, by the name used in requests
+MECHANISMS = {
+    'SHA1RSAPKCS': PyKCS11.CKM_SHA1_RSA_PKCS,
+    'SHA224RSAPKCS': PyKCS11.CKM_SHA224_RSA_PKCS,
+    'SHA256RSAPKCS': PyKCS11.CKM_SHA256_RSA_PKCS,
+    'SHA384RSAPKCS': PyKCS11.CKM_SHA384_RSA_PKCS,
+    'SHA512RSAPKCS': PyKCS11.CKM_SHA512_RSA_PKCS,
+    'ECDSA': PyKCS11.CKM_ECDSA,
+    'ECDSASHA1': PyKCS11.CKM_ECDSA_SHA1,
+    'ECDSASHA224': PyKCS11.CKM_ECDSA_SHA224,
+    'ECDSASHA256': PyKCS11.CKM_ECDSA_SHA256,
+    'ECDSASHA384': PyKCS11.CKM_ECDSA_SHA384,
+    'ECDSASHA512': PyKCS11.CKM_ECDSA_SHA512,
+    'EDDSA': PyKCS11.CKM_EDDSA,
+}
+
+# the CKK_* key type each signing mechanism needs, by CKM_* name
+KEY_TYPES = {
+    'CKM_RSA_PKCS': PyKCS11.CKK_RSA,
+    'CKM_SHA1_RSA_PKCS': PyKCS11.CKK_RSA,
+    'CKM_SHA224_RSA_PKCS': PyKCS11.CKK_RSA,
+    'CKM_SHA256_RSA_PKCS': PyKCS11.CKK_RSA,
+    'CKM_SHA384_RSA_PKCS': PyKCS11.CKK_RSA,
+    'CKM_SHA512_RSA_PKCS': PyKCS11.CKK_RSA,
+    'CKM_ECDSA': PyKCS11.CKK_EC,
+    'CKM_ECDSA_SHA1': PyKCS11.CKK_EC,
+    'CKM_ECDSA_SHA224': PyKCS11.CKK_EC,
+    'CKM_ECDSA_SHA256': PyKCS11.CKK_EC,
+    'CKM_ECDSA_SHA384': PyKCS11.CKK_EC,
+    'CKM_ECDSA_SHA512': PyKCS11.CKK_EC,
+    'CKM_EDDSA': PyKCS11.CKK_EC_EDWARDS,
+}
+
+# mechanisms that always make the same signature for the same key and data, by CKM_* name
+DETERMINISTIC = (
+    'CKM_RSA_PKCS',
+    'CKM_SHA1_RSA_PKCS',
+    'CKM_SHA224_RSA_PKCS',
+    'CKM_SHA256_RSA_PKCS',
+    'CKM_SHA384_RSA_PKCS',
+    'CKM_SHA512_RSA_PKCS',
+    'CKM_EDDSA',
+)
+
+# signature encodings a request can ask for - tokens return ECDSA signatures as raw r||s
+SIGNATURE_FORMATS = ('raw', 'der')
+
+# how the certificate for a key can be returned with a signature
+CERT_FORMATS = ('pem', 'fingerprint')
+
+# hash-and-sign mechanisms that can be prehashed: the hash and the mechanism that signs the DigestInfo
+# (RSA) or the digest itself (ECDSA)
+PREHASH = {
+    'SHA1RSAPKCS': ('sha1', 'RSAPKCS1'),
+    'SHA224RSAPKCS': ('sha224', 'RSAPKCS1'),
+    'SHA256RSAPKCS': ('sha256', 'RSAPKCS1'),
+    'SHA384RSAPKCS': ('sha384', 'RSAPKCS1'),
+    'SHA512RSAPKCS': ('sha512', 'RSAPKCS1'),
+    'ECDSASHA1': ('sha1', 'ECDSA'),
+    'ECDSASHA224': ('sha224', 'ECDSA'),
+    'ECDSASHA256': ('sha256', 'ECDSA'),
+    'ECDSASHA384': ('sha384', 'ECDSA'),
+    'ECDSASHA512': ('sha512', 'ECDSA'),
+}
+
+# DER encoded DigestInfo up to the digest value, see RFC 8017 section 9.2
+DIGEST_INFO_PREFIX = {
+    'sha1': unhexlify('3021300906052b0e03021a05000414'),
+    'sha224': unhexlify('302d300d06096086480165030402040500041c'),
+    'sha256': unhexlify('3031300d060960864801650304020105000420'),
+    'sha384': unhexlify('3041300d060960864801650304020205000430'),
+    'sha512': unhexlify('3051300d060960864801650304020305000440'),
+}
+
+
 def intarray2bytes(x):
     if six.PY2:
         return ''.join(chr(i) for i in x)
@@ -14,20 +117,105 @@ def intarray2bytes(x):
 
 
 def mechanism(mech):
+    if mech in MECHANISMS:
+        return PyKCS11.Mechanism(MECHANISMS[mech], None)
     mn = "Mechanism%s" % mech
     return getattr(PyKCS11, mn)
 
 
+def prehash(mech, data=None, digest=None, stream=None, chunk_size=64 * 1024):
+    """
+    Hash data locally for a hash-and-sign mechanism so that only the hash is sent to the token.
+
+    :param mech: name of a mechanism in PREHASH, eg SHA256RSAPKCS
+    :param data: data to hash
+    :param digest: a hash the caller already computed, used instead of data
+    :param stream: file-like object to read and hash in chunk_size pieces, used instead of data
+    :return: the mechanism name and the data to sign with it
+    """
+    if mech not in PREHASH:
+        raise ValueError("mechanism {!s} can't be used with prehash".format(mech))
+    hash_name, sign_mech = PREHASH[mech]
+    h = hashlib.new(hash_name)
+    if digest is not None:
+        if len(digest) != h.digest_size:
+            raise ValueError("{!s} digest must be {:d} bytes".format(hash_name, h.digest_size))
+    elif stream is not None:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+        digest = h.digest()
+    else:
+        h.update(data)
+        digest = h.digest()
+    if sign_mech == 'RSAPKCS1':
+        digest = DIGEST_INFO_PREFIX[hash_name] + digest
+    return sign_mech, digest
+
+
+def key_type(mech):
+    """
+    :param mech: PyKCS11.Mechanism
+    :return: the CKK_* key type the mechanism signs with or None if it isn't known
+    """
+    return KEY_TYPES.get(mechanism_name(mech))
+
+
+def _der_length(n):
+    if n < 0x80:
+        return bytearray([n])
+    octets = bytearray()
+    while n:
+        octets.insert(0, n & 0xff)
+        n >>= 8
+    return bytearray([0x80 | len(octets)]) + octets
+
+
+def _der_integer(value):
+    value = bytearray(value).lstrip(b'\x00') or bytearray(1)
+    if value[0] & 0x80:  # keep it positive
+        value.insert(0, 0)
+    return bytearray([0x02]) + _der_length(len(value)) + value
+
+
+def ecdsa_raw2der(signature):
+    """
+    Convert an ECDSA signature from the PKCS#11 encoding - r and s concatenated, each the size of the
+    curve order - to the DER encoded Ecdsa-Sig-Value of RFC 3279 used by X.509 and most libraries.
+
+    :param signature: raw r||s signature
+    :return: DER encoded signature
+    """
+    signature = bytearray(signature)
+    if not signature or len(signature) % 2:
+        raise ValueError("raw ECDSA signature must be r||s of equal length")
+    n = len(signature) // 2
+    body = _der_integer(signature[:n]) + _der_integer(signature[n:])
+    return bytes(bytearray([0x30]) + _der_length(len(body)) + body)
+
+
+def mechanism_name(mech):
+    """
+    :param mech: PyKCS11.Mechanism
+    :return: the CKM_* name of the mechanism
+    """
+    m = mech.to_native().mechanism
+    return PyKCS11.CKM.get(m, str(m))
+
+
 def cert_der2pem(der):
     x = base64.standard_b64encode(der)
     if six.PY3:
         x = x.decode('utf-8')
-    r = "-----BEGIN CERTIFICATE-----\n"
-    while len(x) > 64:
-        r += x[0:64]
-        r += "\n"
-        x = x[64:]
-    r += x
-    r += "\n"
-    r += "-----END CERTIFICATE-----"
-    return r
+    lines = [x[i:i + 64] for i in range(0, len(x), 64)]
+    return "-----BEGIN CERTIFICATE-----\n" + "\n".join(lines) + "\n-----END CERTIFICATE-----"
+
+
+def cert_fingerprint(der):
+    """
+    :param der: DER encoded certificate
+    :return: the hex SHA-256 fingerprint of the certificate
+    """
+    return hashlib.sha256(der).hexdigest()
@@ -0,0 +1,106 @@
+"""
+Signature verification in the proxy process using the public key from a key's certificate. This needs
+the optional cryptography package (pip install pyeleven[verify]).
+"""
+import six
+
+from pyeleven.utils import ecdsa_raw2der, SIGNATURE_FORMATS
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, ec
+    from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+except ImportError:
+    x509 = None
+
+__author__ = 'leifj'
+
+# hash-and-sign mechanisms by the name used in requests: the hash name and the signature scheme
+_HASH_AND_SIGN = {
+    'SHA1RSAPKCS': ('SHA1', 'RSA'),
+    'SHA224RSAPKCS': ('SHA224', 'RSA'),
+    'SHA256RSAPKCS': ('SHA256', 'RSA'),
+    'SHA384RSAPKCS': ('SHA384', 'RSA'),
+    'SHA512RSAPKCS': ('SHA512', 'RSA'),
+    'ECDSASHA1': ('SHA1', 'ECDSA'),
+    'ECDSASHA224': ('SHA224', 'ECDSA'),
+    'ECDSASHA256': ('SHA256', 'ECDSA'),
+    'ECDSASHA384': ('SHA384', 'ECDSA'),
+    'ECDSASHA512': ('SHA512', 'ECDSA'),
+}
+
+# hashes by digest size, for ECDSA over a hash the caller computed
+_DIGEST_SIZES = {20: 'SHA1', 28: 'SHA224', 32: 'SHA256', 48: 'SHA384', 64: 'SHA512'}
+
+
+def available():
+    """
+    :return: True if the cryptography package is installed
+    """
+    return x509 is not None
+
+
+def public_key(cert_pem):
+    """
+    :param cert_pem: PEM encoded certificate
+    :return: the public key of the certificate
+    """
+    if isinstance(cert_pem, six.text_type):
+        cert_pem = cert_pem.encode('ascii')
+    return x509.load_pem_x509_certificate(cert_pem, default_backend()).public_key()
+
+
+def verify(key, mech, signature, data=None, digest=None, fmt=None):
+    """
+    Check a signature made by the token.
+
+    :param key: public key returned by public_key()
+    :param mech: mechanism name the data was signed with, eg SHA256RSAPKCS
+    :param signature: the signature
+    :param data: the signed data (for RSAPKCS1 and ECDSA what was sent to the token: the DigestInfo or hash)
+    :param digest: for a hash-and-sign mechanism, the hash of the signed data instead of data
+    :param fmt: encoding of an ECDSA signature, one of SIGNATURE_FORMATS or None for raw
+    :return: True if the signature is valid
+    """
+    fmt = fmt or 'raw'
+    if fmt not in SIGNATURE_FORMATS:
+        raise ValueError("Unknown signature format {!r}".format(fmt))
+    if (data is None) == (digest is None):
+        raise ValueError("exactly one of data and digest is needed to verify")
+    if digest is not None and mech not in _HASH_AND_SIGN:
+        raise ValueError("mechanism {!s} can't be used with digest".format(mech))
+
+    try:
+        if mech == 'RSAPKCS1':
+            return key.recover_data_from_signature(signature, padding.PKCS1v15(), None) == data
+        if mech == 'EDDSA':
+            key.verify(signature, data)
+            return True
+        if mech == 'ECDSA':
+            if len(data) not in _DIGEST_SIZES:
+                raise ValueError("ECDSA data must be a hash, not {:d} bytes".format(len(data)))
+            algorithm = Prehashed(getattr(hashes, _DIGEST_SIZES[len(data)])())
+            scheme = 'ECDSA'
+        elif mech in _HASH_AND_SIGN:
+            hash_name, scheme = _HASH_AND_SIGN[mech]
+            algorithm = getattr(hashes, hash_name)()
+            if digest is not None:
+                algorithm = Prehashed(algorithm)
+                data = digest
+        else:
+            raise ValueError("mechanism {!s} can't be verified".format(mech))
+
+        if scheme == 'RSA':
+            key.verify(signature, data, padding.PKCS1v15(), algorithm)
+        else:
+            if fmt == 'raw':
+                if not signature or len(signature) % 2:
+                    return False
+                signature = ecdsa_raw2der(signature)
+            key.verify(signature, data, ec.ECDSA(algorithm))
+        return True
+    except InvalidSignature:
+        return False